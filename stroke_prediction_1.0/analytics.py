@@ -0,0 +1,160 @@
+# This file calculates numbers for the dashboard page.
+# Instead of sending every patient to Python, MongoDB counts everything itself with one aggregation
+# ($facet runs a few smaller pipelines over the same patients, $bucket groups risk into ranges, $group counts).
+#
+# The result is kept in a small cache for DASHBOARD_CACHE_TTL seconds (default 300), so opening the dashboard
+# many times costs nothing. When patients are added, edited, deleted or imported the cache is cleared
+# (see patients_changed in db_operations.py), so the dashboard never shows old numbers.
+# The cache is in every worker process, so its key also has the patient versions of the page cache
+# (page_cache.py) - with PAGE_CACHE_BACKEND=sqlite a change made by another worker gives a new key.
+
+import os
+import threading
+import time
+from db_operations import on_patients_changed
+from page_cache import patient_versions
+from risk_scoring import AGE_THRESHOLD, GLUCOSE_THRESHOLD, SMOKING_STATUS
+
+DASHBOARD_CACHE_TTL = float(os.environ.get('DASHBOARD_CACHE_TTL', 300))
+
+# Risk ranges shown on the dashboard: 0-20%, 20-40%, 40-60%, 60-80%, 80-100%
+RISK_BUCKETS = [0, 0.2, 0.4, 0.6, 0.8, 1.0000001]
+
+# Patient with risk from this value is counted as high risk
+HIGH_RISK = 0.5
+
+
+# Very small cache - keeps values for ttl seconds, clear() removes everything
+class TTLCache:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self._values.pop(key, None)
+                return None
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            now = time.monotonic()
+            # Old keys are never read again, so expired values are removed here
+            for old in [old for old, entry in self._values.items() if entry[0] < now]:
+                del self._values[old]
+            self._values[key] = (now + self.ttl, value)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+dashboard_cache = TTLCache(DASHBOARD_CACHE_TTL)
+
+# Any change of patients clears dashboard numbers
+on_patients_changed(lambda ids: dashboard_cache.clear())
+
+
+# 1 if condition is true, 0 if not - used for counting patients with $sum
+def _count_if(condition):
+    return {'$sum': {'$cond': [condition, 1, 0]}}
+
+
+# Number of patients, average risk and high risk patients for every value of one field
+def _breakdown(field):
+    return [
+        {'$group': {
+            '_id': f'${field}',
+            'patients': {'$sum': 1},
+            'avg_risk': {'$avg': '$stroke_risk'},
+            'high_risk': _count_if({'$gte': ['$stroke_risk', HIGH_RISK]}),
+        }},
+        {'$sort': {'_id': 1}},
+    ]
+
+
+# The whole dashboard in one aggregation
+def dashboard_pipeline():
+    return [
+        {'$facet': {
+            'risk_distribution': [
+                {'$bucket': {
+                    'groupBy': '$stroke_risk',
+                    'boundaries': RISK_BUCKETS,
+                    'default': 'unknown',
+                    'output': {'patients': {'$sum': 1}},
+                }},
+            ],
+            'risk_factors': [
+                {'$group': {
+                    '_id': None,
+                    'patients': {'$sum': 1},
+                    'avg_risk': {'$avg': '$stroke_risk'},
+                    'hypertension': _count_if({'$eq': ['$hypertension', 1]}),
+                    'heart_disease': _count_if({'$eq': ['$heart_disease', 1]}),
+                    'over_60': _count_if({'$gt': ['$age', AGE_THRESHOLD]}),
+                    'high_glucose': _count_if({'$gt': ['$avg_glucose_level', GLUCOSE_THRESHOLD]}),
+                    'smokers': _count_if({'$eq': [{'$toLower': '$smoking_status'}, SMOKING_STATUS]}),
+                }},
+            ],
+            'by_gender': _breakdown('gender'),
+            'by_work_type': _breakdown('work_type'),
+            'by_residence_type': _breakdown('residence_type'),
+        }},
+    ]
+
+
+# Turn the aggregation result into numbers ready for the template (with % of all patients)
+def _format_dashboard(result):
+    factors = result['risk_factors'][0] if result['risk_factors'] else {'patients': 0, 'avg_risk': None}
+    total = factors['patients']
+
+    def share(count):
+        return count / total * 100 if total else 0.0
+
+    distribution = []
+    for bucket in result['risk_distribution']:
+        if bucket['_id'] == 'unknown':
+            label = 'No risk saved'
+        else:
+            position = RISK_BUCKETS.index(bucket['_id'])
+            label = f"{RISK_BUCKETS[position] * 100:.0f}-{min(RISK_BUCKETS[position + 1], 1) * 100:.0f}%"
+        distribution.append({'label': label, 'patients': bucket['patients'], 'share': share(bucket['patients'])})
+
+    prevalence = [
+        {'label': label, 'patients': factors.get(key, 0), 'share': share(factors.get(key, 0))}
+        for key, label in [('hypertension', 'Hypertension'), ('heart_disease', 'Heart disease'),
+                           ('over_60', f'Age over {AGE_THRESHOLD}'), ('high_glucose', f'Glucose over {GLUCOSE_THRESHOLD} mg/dL'),
+                           ('smokers', 'Smoking')]
+    ]
+
+    def rows(groups):
+        return [{'label': group['_id'] if group['_id'] is not None else 'Unknown',
+                 'patients': group['patients'],
+                 'avg_risk': group['avg_risk'] or 0.0,
+                 'high_risk': group['high_risk']} for group in groups]
+
+    return {
+        'total': total,
+        'avg_risk': factors.get('avg_risk') or 0.0,
+        'risk_distribution': distribution,
+        'risk_factors': prevalence,
+        'by_gender': rows(result['by_gender']),
+        'by_work_type': rows(result['by_work_type']),
+        'by_residence_type': rows(result['by_residence_type']),
+    }
+
+
+# Dashboard numbers - from cache if they are fresh, otherwise MongoDB calculates them again
+def get_dashboard(collection):
+    key = f'dashboard|{patient_versions()}'
+    stats = dashboard_cache.get(key)
+    if stats is None:
+        result = next(collection.aggregate(dashboard_pipeline()), None)
+        stats = _format_dashboard(result)
+        stats['calculated_at'] = time.strftime('%Y-%m-%d %H:%M:%S')
+        dashboard_cache.set(key, stats)
+    return stats
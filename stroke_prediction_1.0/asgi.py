@@ -0,0 +1,218 @@
+# ASGI entry point - the patient API answered by async functions, everything else by the normal Flask app.
+# Run with: uvicorn asgi:app --workers 1
+#
+# With gunicorn (wsgi.py) every request needs its own thread while it waits for MongoDB, so a worker with
+# 8 threads has at most 8 requests in progress. Here /api/patients runs on the event loop with
+# AsyncMongoClient (async_db.py), so one process keeps hundreds of requests in progress at the same time.
+#
+# GET    /api/patients               - one page of patients, the same filters, sort and after/before as /patients_list
+# POST   /api/patients               - add a patient (JSON), risk is calculated like in /add_patient
+# GET    /api/patients/<id>          - one patient
+# PUT    /api/patients/<id>          - change some fields of a patient (PATCH works too), risk is calculated again
+# DELETE /api/patients/<id>          - remove a patient
+# GET    /api/patients_dashboard     - numbers from the dashboard, calculated by MongoDB
+#
+# Every worker needs the same SECRET_KEY (environment variable or .env file), without it the app doesn't start.
+# Login is checked with the same session cookie as the Flask pages (also with SESSION_BACKEND=sqlite),
+# other addresses (HTML pages, login, import, ...) go to the Flask app unchanged.
+
+import io
+import json
+import asyncio
+from server_env import load_server_env
+
+# SECRET_KEY and other settings can be in .env, and it must be set, like for wsgi.py. It's read before the app modules,
+# because they read their settings when they are imported
+load_server_env()
+
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
+from pymongo.errors import DuplicateKeyError
+from werkzeug.wrappers import Request
+from asgiref.wsgi import WsgiToAsgi
+from main_app import create_app, list_filters_from_args, MAX_PATIENTS_PAGE_SIZE
+from db_operations import decode_page_cursor, check_patient_fields
+from session_store import SQLiteSessionInterface
+from risk_scoring import score_patients
+from analytics import dashboard_pipeline, _format_dashboard
+import async_db
+
+# Requests with a bigger body are refused
+MAX_BODY_BYTES = 64 * 1024
+
+
+# ObjectId is not JSON, so _id is sent as text
+def _patient_json(patient):
+    return {**patient, '_id': str(patient['_id'])}
+
+
+# werkzeug Request from the ASGI scope, so args, cookies and JSON are read the same way as in Flask
+def _request(scope, body):
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'],
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': (scope.get('server') or ('localhost', 80))[0],
+        'SERVER_PORT': str((scope.get('server') or ('localhost', 80))[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'CONTENT_LENGTH': str(len(body)),
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            environ[name] = value.decode('latin-1')
+        else:
+            environ[f'HTTP_{name}'] = value.decode('latin-1')
+    return Request(environ)
+
+
+# Patient fields from JSON, checked with the same rules as MongoDB uses (check_patient_fields in db_operations.py),
+# with risk calculated. Returns (patient, None) or (None, errors)
+def _checked_patient(data):
+    patient, errors = check_patient_fields(data)
+    if errors:
+        return None, errors
+    patient['stroke_risk'] = score_patients(patient)
+    return patient, None
+
+
+class PatientAPI:
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.wsgi = WsgiToAsgi(flask_app)
+        self.routes = {
+            '/api/patients': self.patients,
+            '/api/patients_dashboard': self.dashboard,
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+        if scope['type'] == 'http':
+            path = scope['path']
+            if path in self.routes:
+                return await self._answer(self.routes[path], scope, receive, send)
+            if path.startswith('/api/patients/') and path.count('/') == 3:
+                return await self._answer(self.patient, scope, receive, send, path.rsplit('/', 1)[1])
+        return await self.wsgi(scope, receive, send)
+
+    # AsyncMongoClient is closed when the server stops
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await async_db.close_async_client()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _answer(self, handler, scope, receive, send, *args):
+        body = b''
+        more = True
+        while more:
+            message = await receive()
+            body += message.get('body', b'')
+            more = message.get('more_body', False)
+            if len(body) > MAX_BODY_BYTES:
+                return await self._send(send, 413, {'error': 'Request is too big'})
+        request = _request(scope, body)
+
+        if not await self._logged_in(request):
+            return await self._send(send, 401, {'error': 'Please login first'})
+        try:
+            status, data = await handler(request, *args)
+        except Exception as e:
+            print(f"Error in {scope['path']}: {str(e)}")
+            status, data = 500, {'error': 'Something went wrong'}
+        await self._send(send, status, data)
+
+    # The session is read like Flask reads it - SQLite sessions in a thread, so the event loop doesn't wait
+    async def _logged_in(self, request):
+        interface = self.flask_app.session_interface
+        if isinstance(interface, SQLiteSessionInterface):
+            session = await asyncio.to_thread(interface.open_session, self.flask_app, request)
+        else:
+            session = interface.open_session(self.flask_app, request)
+        return session is not None and 'user_id' in session
+
+    async def _send(self, send, status, data):
+        body = json.dumps(data, default=str).encode()
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def patients(self, request):
+        if request.method == 'POST':
+            patient, errors = _checked_patient(request.get_json(silent=True))
+            if errors:
+                return 400, {'errors': errors}
+            try:
+                patient_id = await async_db.insert_patient(patient)
+            except DuplicateKeyError:
+                return 409, {'error': 'This patient is already in the database.'}
+            return 201, {'_id': str(patient_id), 'stroke_risk': patient['stroke_risk']}
+        if request.method != 'GET':
+            return 405, {'error': 'Method not allowed'}
+
+        page_size = request.args.get('page_size', self.flask_app.config['PATIENTS_PAGE_SIZE'], type=int)
+        page_size = max(1, min(page_size, MAX_PATIENTS_PAGE_SIZE))
+        query, sort, filters = list_filters_from_args(request.args)
+        after = request.args.get('after') or None
+        before = request.args.get('before') or None
+        try:
+            for cursor in (after, before):
+                if cursor is not None:
+                    decode_page_cursor(cursor, sort)
+        except (InvalidId, ValueError):
+            return 400, {'error': 'Wrong after or before'}
+
+        page = await async_db.list_patients(after=after, before=before, page_size=page_size, query=query, sort=sort)
+        return 200, {'patients': [_patient_json(patient) for patient in page['patients']],
+                     'next_cursor': page['next_cursor'], 'prev_cursor': page['prev_cursor'], 'filters': filters}
+
+    async def patient(self, request, patient_id):
+        try:
+            patient_id = ObjectId(patient_id)
+        except InvalidId:
+            return 404, {'error': 'Patient not found!'}
+
+        if request.method == 'GET':
+            patient = await async_db.get_patient(patient_id)
+            return (200, _patient_json(patient)) if patient else (404, {'error': 'Patient not found!'})
+
+        if request.method == 'DELETE':
+            if await async_db.delete_patient(patient_id):
+                return 200, {'deleted': str(patient_id)}
+            return 404, {'error': 'Patient not found!'}
+
+        if request.method in ('PUT', 'PATCH'):
+            patient = await async_db.get_patient(patient_id)
+            changes = request.get_json(silent=True)
+            if not patient:
+                return 404, {'error': 'Patient not found!'}
+            if not isinstance(changes, dict):
+                return 400, {'errors': ['Send the changed fields as a JSON object']}
+            # Fields that were not sent stay as they are, the whole patient is checked and scored again
+            updated, errors = _checked_patient({**patient, **changes})
+            if errors:
+                return 400, {'errors': errors}
+            try:
+                await async_db.update_patient(patient_id, updated)
+            except DuplicateKeyError:
+                return 409, {'error': 'Another patient with the same data is already in the database.'}
+            return 200, _patient_json({'_id': patient_id, **updated})
+
+        return 405, {'error': 'Method not allowed'}
+
+    async def dashboard(self, request):
+        if request.method != 'GET':
+            return 405, {'error': 'Method not allowed'}
+        results = await async_db.aggregate_patients(dashboard_pipeline())
+        return 200, _format_dashboard(results[0])
+
+
+app = PatientAPI(create_app())
@@ -0,0 +1,87 @@
+# Async access to the patients collection (pymongo AsyncMongoClient).
+# With the normal MongoClient a worker thread waits for every MongoDB answer and can't do anything else,
+# so the number of requests in progress is limited by the number of threads. With async functions one process
+# can wait for hundreds of MongoDB answers at the same time. asgi.py uses these functions for /api/patients.
+#
+# Queries are the same as in db_operations.py (patient_filter, keyset pages), and every change calls
+# patients_changed(), so caches and the snapshot know about it like with the normal functions.
+# Its listeners block (SQLite page cache, snapshot changes file), so they run in a thread, not on the event loop.
+
+import asyncio
+import threading
+from pymongo import AsyncMongoClient
+from db_setup import MONGO_URI, MONGO_POOL_OPTIONS, mongo_pool_stats
+import db_setup
+from metrics import mongo_command_timer
+from db_operations import patients_changed, page_find_arguments, page_result, PATIENT_LIST_FIELDS
+
+_async_client = None
+_async_client_lock = threading.Lock()
+
+
+# One AsyncMongoClient for the process, made the first time it's needed (inside the running event loop)
+def get_async_client():
+    global _async_client
+    if _async_client is None:
+        with _async_client_lock:
+            if _async_client is None:
+                _async_client = AsyncMongoClient(MONGO_URI, event_listeners=[mongo_pool_stats, mongo_command_timer],
+                                                 **MONGO_POOL_OPTIONS)
+    return _async_client
+
+
+# Use another client (benchmarks.py uses the database given with --mongo-uri)
+def set_async_client(client):
+    global _async_client
+    with _async_client_lock:
+        _async_client = client
+
+
+async def close_async_client():
+    global _async_client
+    with _async_client_lock:
+        client, _async_client = _async_client, None
+    if client is not None:
+        await client.close()
+
+
+def get_async_patients():
+    return get_async_client()[db_setup.MONGO_DB_NAME].patients
+
+
+async def get_patient(patient_id):
+    return await get_async_patients().find_one({'_id': patient_id})
+
+
+# One page of patients - the same arguments and result as get_patients_page in db_operations.py
+async def list_patients(after=None, before=None, page_size=50, query=None, sort='newest'):
+    cursor = before if before is not None else after
+    wanted, order = page_find_arguments(query, sort, cursor, forward=before is None)
+    rows = await get_async_patients().find(wanted, PATIENT_LIST_FIELDS).sort(order).limit(page_size + 1).to_list()
+    return page_result(rows, page_size, sort, after, before)
+
+
+async def insert_patient(patient_data):
+    result = await get_async_patients().insert_one(patient_data)
+    await asyncio.to_thread(patients_changed, [result.inserted_id])
+    return result.inserted_id
+
+
+# Returns True if the patient was found
+async def update_patient(patient_id, fields):
+    result = await get_async_patients().update_one({'_id': patient_id}, {'$set': fields})
+    if result.modified_count:
+        await asyncio.to_thread(patients_changed, [patient_id])
+    return result.matched_count > 0
+
+
+async def delete_patient(patient_id):
+    result = await get_async_patients().delete_one({'_id': patient_id})
+    if result.deleted_count:
+        await asyncio.to_thread(patients_changed, [patient_id])
+    return result.deleted_count > 0
+
+
+async def aggregate_patients(pipeline):
+    cursor = await get_async_patients().aggregate(pipeline)
+    return await cursor.to_list()
@@ -0,0 +1,392 @@
+# Benchmarks for the parts of the app that must stay fast.
+# I made them so I can see if a change makes the app slower, without a running MongoDB server:
+# by default the app runs on mongomock (MongoDB that lives inside Python) and a temporary SQLite file.
+#
+# It makes fake patients that look like data/data.csv.xls (10k, 100k and 1M by default) and measures:
+# CSV import - rows per second (--import-processes 4 - with 4 processes, see IMPORT_PROCESSES in dataset_import.py)
+# /patients_list, /patient_info and /add_patient - p50 and p99 time of one request, without the page cache
+#   (every request is made again), and the list and info pages also with it (*_cached - only cache hits)
+# risk scoring - patients per second
+# password hashing - logins per second (and per CPU core) for every hashing method and cost in --hash-methods
+# risk model - training time, accuracy on the test patients and scoring speed of the trained model (risk_model.py)
+#   compared with the rule, for --model-rows patients at once and for one patient
+# insert buffer (only with --mongo-uri) - patients per second and p99 when --threads callers save one patient
+#   at a time, with their own insert_one and through the insert buffer (insert_buffer.py)
+# async vs normal MongoDB functions (only with --mongo-uri) - requests per second and p99 when --in-flight
+#   requests run at once on one event loop (async_db.py), and the same with --threads threads like a gunicorn worker
+#
+# Results are saved to a JSON file, and an older file can be given with --compare to see what changed:
+# python benchmarks.py --sizes 10000 100000 --output new.json --compare old.json
+#
+# Remember that mongomock is much slower than real MongoDB and has no indexes, so numbers are for comparing
+# runs with each other, not with production. With --mongo-uri the same benchmarks run on a real MongoDB
+# (database stroke_benchmark, which is deleted first). mongomock must be installed: pip install mongomock
+
+import os
+import sys
+import json
+import time
+import random
+import platform
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+# Temporary SQLite file must be chosen before db_setup is imported
+_temp_dir = tempfile.mkdtemp(prefix='stroke_benchmark_')
+os.environ.setdefault('SQLITE_PATH', os.path.join(_temp_dir, 'users.db'))
+os.environ.setdefault('SECRET_KEY', 'benchmark')
+
+import numpy as np
+import pandas as pd
+import db_setup
+import dataset_import
+from risk_scoring import score_patients, set_risk_model
+import risk_model
+import password_hashing
+
+BENCHMARK_DB_NAME = 'stroke_benchmark'
+DEFAULT_SIZES = [10000, 100000, 1000000]
+DEFAULT_HASH_METHODS = ['pbkdf2:sha256:600000', 'scrypt:16384:8:1', 'scrypt:32768:8:1']
+
+# Values and how often they are in the Kaggle file
+GENDERS = (['Female', 'Male', 'Other'], [0.586, 0.414, 0.0002])
+WORK_TYPES = (['Private', 'Self-employed', 'children', 'Govt_job', 'Never_worked'], [0.572, 0.160, 0.134, 0.130, 0.004])
+RESIDENCE_TYPES = (['Urban', 'Rural'], [0.508, 0.492])
+SMOKING = (['never smoked', 'Unknown', 'formerly smoked', 'smokes'], [0.370, 0.302, 0.173, 0.155])
+
+
+def _choice(rng, values, count):
+    names, shares = values
+    shares = np.asarray(shares) / np.sum(shares)
+    return rng.choice(names, count, p=shares)
+
+
+# Fake patients with the same columns as data/data.csv.xls
+def generate_patients(count, seed=42):
+    rng = np.random.default_rng(seed)
+    bmi = np.round(rng.normal(28.9, 7.9, count).clip(10, 70), 1).astype(object)
+    bmi[rng.random(count) < 0.04] = 'N/A'
+    return pd.DataFrame({
+        'id': np.arange(1, count + 1),
+        'gender': _choice(rng, GENDERS, count),
+        'age': np.round(rng.uniform(0.08, 82, count), 0),
+        'hypertension': (rng.random(count) < 0.097).astype(int),
+        'heart_disease': (rng.random(count) < 0.054).astype(int),
+        'ever_married': _choice(rng, (['Yes', 'No'], [0.656, 0.344]), count),
+        'work_type': _choice(rng, WORK_TYPES, count),
+        'Residence_type': _choice(rng, RESIDENCE_TYPES, count),
+        'avg_glucose_level': np.round(rng.gamma(4.0, 26.5, count).clip(55, 272), 2),
+        'bmi': bmi,
+        'smoking_status': _choice(rng, SMOKING, count),
+        'stroke': (rng.random(count) < 0.049).astype(int),
+    })
+
+
+# The same patients as form data for /add_patient
+def _form_from_row(row):
+    return {
+        'gender': row['gender'] if row['gender'] != 'Other' else 'Male',
+        'age': str(row['age']),
+        'hypertension': str(row['hypertension']),
+        'heart_disease': str(row['heart_disease']),
+        'ever_married': row['ever_married'],
+        'work_type': row['work_type'],
+        'residence_type': row['Residence_type'],
+        'avg_glucose_level': str(row['avg_glucose_level']),
+        'bmi': str(row['bmi']) if row['bmi'] != 'N/A' else '25.0',
+        'smoking_status': row['smoking_status'],
+    }
+
+
+def _latency(times):
+    times = np.asarray(times) * 1000
+    return {'p50_ms': round(float(np.percentile(times, 50)), 3),
+            'p99_ms': round(float(np.percentile(times, 99)), 3),
+            'requests': len(times)}
+
+
+# Fresh, empty patients database for every size
+def _fresh_database(mongo_uri):
+    if mongo_uri:
+        from pymongo import MongoClient
+        client = MongoClient(mongo_uri)
+        client.drop_database(BENCHMARK_DB_NAME)
+        db_setup.set_mongo_client(client, BENCHMARK_DB_NAME)
+        db_setup.setup_mongodb()
+    else:
+        try:
+            import mongomock
+        except ImportError:
+            sys.exit('mongomock is needed for benchmarks without --mongo-uri: pip install mongomock')
+        db_setup.set_mongo_client(mongomock.MongoClient(), BENCHMARK_DB_NAME)
+        db_setup.setup_mongodb_indexes(db_setup.get_mongodb_connection().patients)
+    return db_setup.get_mongodb_connection().patients
+
+
+# processes > 1 imports with many processes (only with --mongo-uri, mongomock lives in one process)
+def bench_import(patients, csv_path, rows, processes=1, mongo_uri=None):
+    started = time.perf_counter()
+    summary = dataset_import.import_dataset(patients, csv_path, processes=processes if mongo_uri else 1, mongo_uri=mongo_uri)
+    seconds = time.perf_counter() - started
+    return {'rows': rows, 'inserted': summary['inserted'], 'processes': summary['processes'],
+            'seconds': round(seconds, 3), 'rows_per_sec': round(rows / seconds, 1)}
+
+
+def bench_scoring(df, repeats=5):
+    best = min(_timed(lambda: score_patients(df)) for _ in range(repeats))
+    return {'rows': len(df), 'seconds': round(best, 6), 'rows_per_sec': round(len(df) / best, 1)}
+
+
+def _timed(function):
+    started = time.perf_counter()
+    function()
+    return time.perf_counter() - started
+
+
+def bench_routes(patients, df, requests):
+    import main_app
+    import page_cache
+    app = main_app.create_app({'TESTING': True})
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = 1
+        session['user_name'] = 'benchmark'
+
+    ids = [str(doc['_id']) for doc in patients.find({}, {'_id': 1}).limit(1000)]
+    rows = df.sample(n=min(requests, len(df)), random_state=1).to_dict('records')
+    info_ids = [random.choice(ids) for _ in range(requests)]
+    results = {}
+    saved_cache = page_cache.page_cache
+    try:
+        # Without the cache - the same page again would only measure the cache
+        page_cache.set_page_cache(None)
+        results['patients_list'] = _latency([_timed(lambda: client.get('/patients_list')) for _ in range(requests)])
+        results['patient_info'] = _latency([_timed(lambda patient_id=patient_id: client.get(f'/patient_info/{patient_id}'))
+                                            for patient_id in info_ids])
+        results['add_patient'] = _latency([_timed(lambda row=row: client.post('/add_patient', data=_form_from_row(row)))
+                                           for row in rows])
+        # With the cache in memory - the pages are made once first, then the same requests are measured
+        page_cache.set_page_cache(page_cache.LRUCache(page_cache.PAGE_CACHE_MAX_ENTRIES, page_cache.PAGE_CACHE_MAX_BYTES))
+        client.get('/patients_list')
+        for patient_id in set(info_ids):
+            client.get(f'/patient_info/{patient_id}')
+        results['patients_list_cached'] = _latency([_timed(lambda: client.get('/patients_list')) for _ in range(requests)])
+        results['patient_info_cached'] = _latency([_timed(lambda patient_id=patient_id: client.get(f'/patient_info/{patient_id}'))
+                                                   for patient_id in info_ids])
+    finally:
+        page_cache.set_page_cache(saved_cache)
+    return results
+
+
+# The same reads (one patient, one page of the list) with async functions and with normal ones.
+# Async: in_flight requests at once on one event loop. Normal: threads threads, each waits for its own answer
+def bench_async(patients, requests, in_flight, threads, mongo_uri):
+    import asyncio
+    from pymongo import AsyncMongoClient
+    import async_db
+    from db_operations import get_patients_page
+
+    ids = [doc['_id'] for doc in patients.find({}, {'_id': 1}).limit(1000)]
+    jobs = [('patient', random.choice(ids)) if i % 2 else ('page', None) for i in range(requests)]
+
+    def sync_job(job):
+        started = time.perf_counter()
+        if job[0] == 'patient':
+            patients.find_one({'_id': job[1]})
+        else:
+            get_patients_page(patients, page_size=50)
+        return time.perf_counter() - started
+
+    async def async_job(job, limit):
+        async with limit:
+            started = time.perf_counter()
+            if job[0] == 'patient':
+                await async_db.get_patient(job[1])
+            else:
+                await async_db.list_patients(page_size=50)
+            return time.perf_counter() - started
+
+    async def run_async():
+        async_db.set_async_client(AsyncMongoClient(mongo_uri, maxPoolSize=in_flight))
+        try:
+            limit = asyncio.Semaphore(in_flight)
+            await asyncio.gather(*[async_job(job, limit) for job in jobs[:in_flight]])
+            started = time.perf_counter()
+            times = await asyncio.gather(*[async_job(job, limit) for job in jobs])
+            return times, time.perf_counter() - started
+        finally:
+            await async_db.close_async_client()
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(sync_job, jobs[:threads]))
+        started = time.perf_counter()
+        times = list(pool.map(sync_job, jobs))
+        seconds = time.perf_counter() - started
+    results['sync'] = {**_latency(times), 'threads': threads, 'requests_per_sec': round(requests / seconds, 1)}
+    times, seconds = asyncio.run(run_async())
+    results['async'] = {**_latency(times), 'in_flight': in_flight, 'requests_per_sec': round(requests / seconds, 1)}
+    return results
+
+
+# Many callers saving one patient at a time - each with its own insert_one, then through the insert buffer.
+# A separate collection without the dedupe index is used, so every patient is saved
+def bench_insert_buffer(df, threads, rows=5000):
+    from insert_buffer import InsertBuffer
+    collection = db_setup.get_mongodb_connection()['insert_benchmark']
+    patients, _ = dataset_import.clean_dataset(df.head(rows))
+    records = patients.to_dict('records')
+    results = {}
+    buffer = InsertBuffer(lambda: collection)
+    for name, insert in [('insert_one', lambda patient: collection.insert_one(patient).inserted_id),
+                         ('buffer', buffer.insert)]:
+        collection.drop()
+        copies = [dict(patient) for patient in records]
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            started = time.perf_counter()
+            times = list(pool.map(lambda patient: _timed(lambda: insert(patient)), copies))
+            seconds = time.perf_counter() - started
+        results[name] = {**_latency(times), 'threads': threads, 'rows_per_sec': round(len(copies) / seconds, 1)}
+    buffer.close()
+    collection.drop()
+    return results
+
+
+# Trained model against the rule: training time, test results (from the dataset) and how fast both score
+def bench_risk_model(rows, repeats=5):
+    model = risk_model.train_risk_model(risk_model.TRAINING_CSV)
+    patients, _ = dataset_import.clean_dataset(generate_patients(rows))
+    one = patients.iloc[0].to_dict()
+    results = {'training_seconds': model.artifact['training_seconds'], 'test_results': model.artifact['test_results']}
+    for name, active in [('rule', None), ('model', model)]:
+        set_risk_model(active)
+        best = min(_timed(lambda: score_patients(patients)) for _ in range(repeats))
+        single = min(_timed(lambda: [score_patients(one) for _ in range(1000)]) for _ in range(repeats)) / 1000
+        results[name] = {'rows': rows, 'rows_per_sec': round(rows / best, 1), 'one_patient_us': round(single * 1e6, 2)}
+    set_risk_model(None)
+    return results
+
+
+# Logins per second with one hashing method - many logins at once, like in the morning,
+# checked in the hashing process pool with one process for every CPU core
+def bench_logins(method, logins, workers=None):
+    workers = workers or os.cpu_count() or 1
+    password_hashing.configure_hashing(method=method, workers=workers)
+    saved = password_hashing.hash_password('benchmark-password')
+    with ThreadPoolExecutor(max_workers=workers * 2) as threads:
+        list(threads.map(lambda _: password_hashing.check_password(saved, 'benchmark-password'), range(workers)))
+        started = time.perf_counter()
+        results = list(threads.map(lambda _: password_hashing.check_password(saved, 'benchmark-password'), range(logins)))
+        seconds = time.perf_counter() - started
+    assert all(ok for ok, _ in results)
+    return {'logins': logins, 'workers': workers, 'seconds': round(seconds, 3),
+            'logins_per_sec': round(logins / seconds, 1),
+            'logins_per_sec_per_core': round(logins / seconds / workers, 1)}
+
+
+def run_hashing(methods, logins):
+    results = {}
+    for method in methods:
+        results[method] = bench_logins(method, logins)
+        print(f"{method}: {results[method]['logins_per_sec']} logins/sec "
+              f"({results[method]['logins_per_sec_per_core']} per core)")
+    password_hashing.configure_hashing(method=password_hashing.PASSWORD_HASH_METHOD,
+                                       workers=password_hashing.PASSWORD_HASH_WORKERS)
+    return results
+
+
+def run(sizes, requests, mongo_uri, import_processes=1, in_flight=200, threads=8):
+    db_setup.setup_sqlite()
+    results = {}
+    for size in sizes:
+        print(f"--- {size} patients ---")
+        df = generate_patients(size)
+        csv_path = os.path.join(_temp_dir, f'patients_{size}.csv')
+        df.to_csv(csv_path, index=False)
+
+        patients = _fresh_database(mongo_uri)
+        result = {'import': bench_import(patients, csv_path, size, import_processes, mongo_uri)}
+        print(f"import: {result['import']['rows_per_sec']} rows/sec")
+        result['routes'] = bench_routes(patients, df, requests)
+        for route, numbers in result['routes'].items():
+            print(f"{route}: p50 {numbers['p50_ms']} ms, p99 {numbers['p99_ms']} ms")
+        if mongo_uri:
+            result['insert_buffer'] = bench_insert_buffer(df, threads * 8)
+            for name, numbers in result['insert_buffer'].items():
+                print(f"{name}: {numbers['rows_per_sec']} rows/sec, p99 {numbers['p99_ms']} ms")
+            result['async'] = bench_async(patients, max(requests, in_flight * 2), in_flight, threads, mongo_uri)
+            for name, numbers in result['async'].items():
+                print(f"{name}: {numbers['requests_per_sec']} requests/sec, p99 {numbers['p99_ms']} ms")
+        result['scoring'] = bench_scoring(df)
+        print(f"scoring: {result['scoring']['rows_per_sec']} rows/sec")
+        results[str(size)] = result
+    return results
+
+
+# Every number from the results as "10000.import.rows_per_sec": value
+def _flatten(results, prefix=''):
+    flat = {}
+    for key, value in results.items():
+        name = f'{prefix}.{key}' if prefix else key
+        if isinstance(value, dict):
+            flat.update(_flatten(value, name))
+        elif isinstance(value, (int, float)):
+            flat[name] = value
+    return flat
+
+
+# Show old and new numbers side by side - for *_per_sec more is better, for *_ms less is better
+def compare(old, new):
+    old_flat, new_flat = _flatten(old['results']), _flatten(new['results'])
+    print(f"{'metric':<45}{'old':>14}{'new':>14}{'change':>10}")
+    for name, value in new_flat.items():
+        if name not in old_flat or not (name.endswith('_per_sec') or name.endswith('_ms')) or not old_flat[name]:
+            continue
+        change = (value - old_flat[name]) / old_flat[name] * 100
+        print(f"{name:<45}{old_flat[name]:>14}{value:>14}{change:>+9.1f}%")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Stroke Prediction benchmarks')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='numbers of fake patients')
+    parser.add_argument('--requests', type=int, default=200, help='requests for every page')
+    parser.add_argument('--output', default='benchmark_results.json', help='where to save results (JSON)')
+    parser.add_argument('--compare', help='older results file to compare with')
+    parser.add_argument('--mongo-uri', help='real MongoDB instead of mongomock')
+    parser.add_argument('--import-processes', type=int, default=1, help='processes for the CSV import (needs --mongo-uri)')
+    parser.add_argument('--in-flight', type=int, default=200, help='requests at once for the async benchmark (needs --mongo-uri)')
+    parser.add_argument('--threads', type=int, default=8, help='threads for the normal functions in the async benchmark')
+    parser.add_argument('--model-rows', type=int, default=100000, help='patients for the risk model benchmark (0 - skip)')
+    parser.add_argument('--hash-methods', nargs='+', default=DEFAULT_HASH_METHODS, help='password hashing methods to compare')
+    parser.add_argument('--logins', type=int, default=200, help='logins for every hashing method (0 - skip)')
+    args = parser.parse_args(argv)
+
+    results = run(args.sizes, args.requests, args.mongo_uri, args.import_processes, args.in_flight, args.threads)
+    if args.model_rows:
+        results['risk_model'] = bench_risk_model(args.model_rows)
+        for name in ('rule', 'model'):
+            numbers = results['risk_model'][name]
+            print(f"{name}: {numbers['rows_per_sec']} rows/sec, {numbers['one_patient_us']} us for one patient, "
+                  f"test AUC {results['risk_model']['test_results'][name]['auc']}")
+    if args.logins:
+        results['password_hashing'] = run_hashing(args.hash_methods, args.logins)
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'machine': platform.platform(),
+        'backend': 'mongodb' if args.mongo_uri else 'mongomock',
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results saved to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,475 @@
+# I moved the CSV import here from main_app.py, because importing became a bigger job than one route.
+# Before, the app checked every row with a Python loop and asked MongoDB twice for each patient (find_one + insert_one).
+# Now all checking and fixing of the data is done on whole columns at once with pandas/NumPy,
+# and patients are saved in batches with insert_many, so a big file needs only a few round-trips to MongoDB.
+#
+# Batch size can be changed with IMPORT_BATCH_SIZE environment variable (default 1000 patients per batch).
+#
+# The file is also read in pieces (chunks) of IMPORT_CHUNK_SIZE rows (default 50 000). Every chunk is checked,
+# scored and saved before the next one is read, so even a file of many GB needs only memory for one chunk.
+# Text columns with few different values (gender, work type, residence, smoking) are read as pandas categories,
+# which keeps every value only once in memory. IMPORT_CHUNK_SIZE=0 reads the whole file at once.
+#
+# Import only does the work that is needed (IMPORT_INCREMENTAL, on by default):
+# after every import the file size, change time and SHA-256 are saved in the import_state collection.
+# The same file again - import finishes straight away.
+# Rows added at the end of the file - only the new part of the file is read.
+# Rows changed - every patient remembers the file it came from (source), its CSV id (source_id) and a hash of
+# its CSV row (row_hash), so only new and changed rows are written to MongoDB, the rest is counted as unchanged.
+# A row is only the same patient for the same source - another file with the same ids adds its own patients.
+# Files without the id column use the row hash as the id: unchanged rows are found wherever they are in the file,
+# a changed row is added as a new patient (the old one stays), so no patient is overwritten by another row.
+#
+# Big files can be imported by many processes at once (IMPORT_PROCESSES, default 1 = no extra processes).
+# The file is split into parts by bytes (every part starts at the beginning of a line), every process
+# reads, cleans, scores and saves its parts with its own MongoClient, and the numbers of all parts are added up.
+# Processes get the risk model of the app when they start, so they score patients the same way as one process.
+# Files smaller than IMPORT_PARALLEL_MIN_MB (default 32) are always imported in one process, starting processes
+# would take longer than the import. Text fields with a new line inside quotes are not supported when splitting.
+
+import io
+import os
+import time
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError
+from risk_scoring import score_patients, current_risk_model, set_risk_model
+from db_setup import MONGO_URI, DEDUPE_INDEX, has_dedupe_index
+
+IMPORT_BATCH_SIZE = int(os.environ.get('IMPORT_BATCH_SIZE', 1000))
+IMPORT_CHUNK_SIZE = int(os.environ.get('IMPORT_CHUNK_SIZE', 50000))
+IMPORT_INCREMENTAL = os.environ.get('IMPORT_INCREMENTAL', '1') != '0'
+IMPORT_PROCESSES = int(os.environ.get('IMPORT_PROCESSES', 1))
+IMPORT_PARALLEL_MIN_MB = float(os.environ.get('IMPORT_PARALLEL_MIN_MB', 32))
+
+# Every process gets this many parts, so a process that finishes early can take another part
+PARTS_PER_PROCESS = 2
+
+# Columns app needs from the CSV file (same names as in the Kaggle file)
+CSV_COLUMNS = ['gender', 'age', 'hypertension', 'ever_married', 'work_type',
+               'Residence_type', 'avg_glucose_level', 'bmi', 'smoking_status']
+# Columns that are read when the file has them (older files without heart_disease still work, it's 0 then)
+OPTIONAL_CSV_COLUMNS = ['heart_disease']
+
+# Patient number in the CSV file - used to find the same row again when the file changes
+SOURCE_ID_COLUMN = 'id'
+
+# Collection where the last imported file is remembered
+IMPORT_STATE_COLLECTION = 'import_state'
+
+# Columns read as categories - they have only a few different values
+CATEGORY_COLUMNS = ['gender', 'work_type', 'Residence_type', 'smoking_status']
+
+# Patient is the same if these values are the same (unique index patients_dedupe_key in db_setup.py)
+DEDUPE_FIELDS = ['gender', 'age', 'hypertension', 'avg_glucose_level']
+
+# MongoDB error code for a patient rejected by a unique index
+DUPLICATE_KEY_ERROR = 11000
+
+# Allowed text values, everything else becomes "Unknown"
+ALLOWED_VALUES = {
+    'gender': ['Male', 'Female'],
+    'ever_married': ['Yes', 'No'],
+    'work_type': ['Private', 'Self-employed', 'Govt_job', 'children', 'Never_worked'],
+    'residence_type': ['Urban', 'Rural'],
+    'smoking_status': ['never smoked', 'formerly smoked', 'smokes', 'Unknown'],
+}
+
+
+# Text column check - empty or not allowed values are changed to "Unknown"
+def _clean_text(column, allowed):
+    values = column.astype('string')
+    return values.where(values.isin(allowed), 'Unknown').astype(object)
+
+
+# Number column check - returns numbers and mask of rows where value was there but was not a number
+# (the old loop skipped those rows with an error, so I do the same)
+def _clean_number(column):
+    numbers = pd.to_numeric(column, errors='coerce')
+    broken = numbers.isna() & column.notna()
+    return numbers, broken
+
+
+# Check and fix all data from CSV at once, the same rules as the old row by row loop:
+# Gender, marriage, work, residence and smoking must be known values
+# Age must be between 0 and 120, glucose between 0 and 500
+# Hypertension and heart disease must be 0 or 1, BMI under 10 is replaced with 25
+# Returns clean patients and number of rows that could not be read
+def clean_dataset(df):
+    missing = [name for name in CSV_COLUMNS if name not in df.columns]
+    if missing:
+        raise ValueError(f"Missing columns: {', '.join(missing)}")
+
+    age, bad_age = _clean_number(df['age'])
+    hypertension, bad_hypertension = _clean_number(df['hypertension'])
+    heart_disease, bad_heart_disease = _clean_number(df['heart_disease'] if 'heart_disease' in df.columns
+                                                     else pd.Series(0, index=df.index))
+    glucose, bad_glucose = _clean_number(df['avg_glucose_level'])
+    bmi, bad_bmi = _clean_number(df['bmi'])
+    broken = (bad_age | bad_hypertension | bad_heart_disease | bad_glucose | bad_bmi).to_numpy()
+
+    age = np.array(age.fillna(0.0), dtype=float)
+    age[(age < 0) | (age > 120)] = 0.0
+
+    hypertension = np.trunc(np.array(hypertension.fillna(0), dtype=float))
+    hypertension[(hypertension != 0) & (hypertension != 1)] = 0
+
+    heart_disease = np.trunc(np.array(heart_disease.fillna(0), dtype=float))
+    heart_disease[(heart_disease != 0) & (heart_disease != 1)] = 0
+
+    glucose = np.array(glucose.fillna(0.0), dtype=float)
+    glucose[(glucose < 0) | (glucose > 500)] = 0.0
+
+    bmi = np.array(bmi.fillna(0.0), dtype=float)
+    bmi[bmi < 10] = 25.0
+
+    clean = pd.DataFrame({
+        'gender': _clean_text(df['gender'], ALLOWED_VALUES['gender']),
+        'age': age,
+        'hypertension': hypertension.astype(np.int64),
+        'heart_disease': heart_disease.astype(np.int64),
+        'ever_married': _clean_text(df['ever_married'], ALLOWED_VALUES['ever_married']),
+        'work_type': _clean_text(df['work_type'], ALLOWED_VALUES['work_type']),
+        'residence_type': _clean_text(df['Residence_type'], ALLOWED_VALUES['residence_type']),
+        'avg_glucose_level': glucose,
+        'bmi': bmi,
+        'smoking_status': _clean_text(df['smoking_status'], ALLOWED_VALUES['smoking_status']),
+    }, index=df.index)
+
+    # Risk for the whole file at once (the same calculation as in add_patient_route)
+    clean['stroke_risk'] = score_patients(clean)
+
+    return clean[~broken], int(broken.sum())
+
+
+# Save patients in batches - one unordered insert_many for every batch.
+# I don't ask MongoDB first if the patient exists - the unique index patients_dedupe_key (db_setup.py)
+# rejects duplicates, and because the insert is unordered, all other patients in the batch are still saved.
+# Rejected duplicates are counted as skipped, other rejected patients (for example by the validator) as failed.
+# progress (optional) is called after every batch with numbers for that batch (used by import_jobs.py)
+def write_patients(patients, clean, batch_size=None, progress=None):
+    batch_size = batch_size or IMPORT_BATCH_SIZE
+    inserted = skipped = failed = 0
+
+    # The same patient twice in one file is added only once
+    unique = clean.drop_duplicates(subset=DEDUPE_FIELDS)
+    skipped += len(clean) - len(unique)
+    if progress:
+        progress(skipped=skipped)
+
+    for start in range(0, len(unique), batch_size):
+        batch = unique.iloc[start:start + batch_size].to_dict('records')
+        batch_inserted = batch_skipped = batch_failed = 0
+        try:
+            result = patients.insert_many(batch, ordered=False)
+            batch_inserted = len(result.inserted_ids)
+        except BulkWriteError as e:
+            batch_inserted = e.details.get('nInserted', 0)
+            for error in e.details.get('writeErrors', []):
+                if error.get('code') == DUPLICATE_KEY_ERROR:
+                    batch_skipped += 1
+                else:
+                    batch_failed += 1
+                    print(f"Error processing record: {error.get('errmsg')}")
+        inserted += batch_inserted
+        skipped += batch_skipped
+        failed += batch_failed
+        if progress:
+            progress(inserted=batch_inserted, skipped=batch_skipped, failed=batch_failed)
+
+    return inserted, skipped, failed
+
+
+# Only bytes from the start of the file to end can be read from it - used to read one part of the file
+class _FilePart(io.RawIOBase):
+    def __init__(self, f, end):
+        self.f = f
+        self.end = end
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self.end - self.f.tell())
+        if size <= 0:
+            return 0
+        data = self.f.read(size)
+        buffer[:len(data)] = data
+        return len(data)
+
+
+# Read the CSV file piece by piece - only columns the app needs, text columns as categories.
+# start_byte - start reading in the middle of the file (at the start of a line), header is taken from the first line
+# end_byte - stop reading there (end of a line), None - read to the end
+def read_dataset_chunks(csv_path, chunk_size=None, start_byte=0, end_byte=None):
+    chunk_size = IMPORT_CHUNK_SIZE if chunk_size is None else chunk_size
+    options = {
+        'usecols': lambda name: name in CSV_COLUMNS or name in OPTIONAL_CSV_COLUMNS or name == SOURCE_ID_COLUMN,
+        'dtype': {name: 'category' for name in CATEGORY_COLUMNS},
+    }
+    with open(csv_path, 'rb') as f:
+        if start_byte:
+            options['names'] = csv_header(csv_path)
+            options['header'] = None
+            f.seek(start_byte)
+            if not f.read(1) or (end_byte is not None and start_byte >= end_byte):
+                return
+            f.seek(start_byte)
+        source = io.BufferedReader(_FilePart(f, end_byte)) if end_byte is not None else f
+        if not chunk_size:
+            yield pd.read_csv(source, **options)
+            return
+        with pd.read_csv(source, chunksize=chunk_size, **options) as reader:
+            yield from reader
+
+
+def csv_header(csv_path):
+    return list(pd.read_csv(csv_path, nrows=0).columns)
+
+
+# Split bytes start..end of the file into about count parts, every part ends at the end of a line
+def split_file(csv_path, start, end, count):
+    bounds = [start]
+    with open(csv_path, 'rb') as f:
+        for number in range(1, count):
+            position = max(start + (end - start) * number // count, bounds[-1])
+            f.seek(position)
+            f.readline()
+            position = min(f.tell(), end)
+            if position > bounds[-1]:
+                bounds.append(position)
+    if end > bounds[-1]:
+        bounds.append(end)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+# Size, change time and SHA-256 of the file. If the previous state is given,
+# it also checks if the old file is still the beginning of the new one (rows were only added at the end)
+def file_fingerprint(csv_path, previous=None):
+    stat = os.stat(csv_path)
+    digest = hashlib.sha256()
+    prefix_size = previous['size'] if previous and previous['size'] < stat.st_size else None
+    prefix_sha256 = None
+    read = 0
+    last_prefix_byte = b''
+    with open(csv_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            if prefix_size is not None and read < prefix_size <= read + len(block):
+                cut = prefix_size - read
+                digest.update(block[:cut])
+                prefix_sha256 = digest.hexdigest()
+                last_prefix_byte = block[cut - 1:cut]
+                digest.update(block[cut:])
+            else:
+                digest.update(block)
+            read += len(block)
+    return {
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'sha256': digest.hexdigest(),
+        # Rows were only added if the old file is the start of the new one and it ended with a full line
+        'appended': bool(previous and prefix_sha256 == previous['sha256'] and last_prefix_byte == b'\n'),
+    }
+
+
+# Hash of every cleaned row (one number per row) - if it is different, the patient was changed in the file.
+# Cleaned values are hashed, not the CSV text, so a bad value somewhere else in the chunk can't change the hash
+def row_hashes(clean):
+    columns = {}
+    for name in clean.columns:
+        if name in ('stroke_risk', 'source', 'source_id', 'row_hash'):
+            continue
+        column = clean[name]
+        columns[name] = column.astype(float) if pd.api.types.is_numeric_dtype(column) else column.astype(str)
+    return pd.util.hash_pandas_object(pd.DataFrame(columns), index=False).to_numpy().view(np.int64)
+
+
+# CSV id of every row. A file without the id column has no stable id (row numbers move when a line is added
+# or removed), so the row hash is the id - a changed row is then a new patient and nothing is overwritten
+def _source_ids(chunk, clean):
+    if SOURCE_ID_COLUMN in chunk.columns:
+        return chunk.loc[clean.index, SOURCE_ID_COLUMN]
+    return clean['row_hash']
+
+
+# Update patients whose CSV row changed - one unordered bulk_write for every batch
+def update_patients(patients, changed, batch_size=None, progress=None):
+    batch_size = batch_size or IMPORT_BATCH_SIZE
+    updated = failed = 0
+    records = changed.to_dict('records')
+    for start in range(0, len(records), batch_size):
+        operations = [UpdateOne({'source': record['source'], 'source_id': record['source_id']}, {'$set': record})
+                      for record in records[start:start + batch_size]]
+        batch_updated = batch_failed = 0
+        try:
+            result = patients.bulk_write(operations, ordered=False)
+            batch_updated = result.matched_count
+        except BulkWriteError as e:
+            batch_updated = e.details.get('nMatched', 0)
+            batch_failed = len(e.details.get('writeErrors', []))
+            for error in e.details.get('writeErrors', []):
+                print(f"Error processing record: {error.get('errmsg')}")
+        updated += batch_updated
+        failed += batch_failed
+        if progress:
+            progress(updated=batch_updated, failed=batch_failed)
+    return updated, failed
+
+
+# Save new rows and update changed rows of one chunk, rows that didn't change are not written.
+# Only patients saved earlier from the same source are looked at
+def _write_chunk(patients, clean, source, batch_size, progress):
+    ids = clean['source_id'].tolist()
+    known = {doc['source_id']: doc.get('row_hash')
+             for doc in patients.find({'source': source, 'source_id': {'$in': ids}},
+                                      {'_id': 0, 'source_id': 1, 'row_hash': 1})}
+    position = pd.Index(list(known)).get_indexer(clean['source_id'])
+    is_new = position < 0
+    stored_hash = np.array(list(known.values()) or [0], dtype=np.int64)[position]
+    is_changed = ~is_new & (stored_hash != clean['row_hash'].to_numpy())
+
+    unchanged = int((~is_new & ~is_changed).sum())
+    if progress and unchanged:
+        progress(unchanged=unchanged)
+    inserted, skipped, failed = write_patients(patients, clean[is_new], batch_size, progress)
+    updated, update_failed = update_patients(patients, clean[is_changed], batch_size, progress)
+    return inserted, updated, unchanged, skipped, failed + update_failed
+
+
+# Import one part of the file (or all of it) - returns the numbers for this part
+def _import_part(patients, csv_path, source, start_byte, end_byte, batch_size, progress, chunk_size):
+    numbers = dict.fromkeys(['rows', 'inserted', 'updated', 'unchanged', 'skipped', 'failed'], 0)
+    for chunk in read_dataset_chunks(csv_path, chunk_size, start_byte, end_byte):
+        clean, broken = clean_dataset(chunk)
+        clean['row_hash'] = row_hashes(clean)
+        clean['source_id'] = _source_ids(chunk, clean)
+        clean['source'] = source
+        if progress:
+            progress(rows_read=len(chunk), failed=broken)
+        inserted, updated, unchanged, skipped, failed = _write_chunk(patients, clean, source, batch_size, progress)
+        numbers['rows'] += len(chunk)
+        numbers['inserted'] += inserted
+        numbers['updated'] += updated
+        numbers['unchanged'] += unchanged
+        numbers['skipped'] += skipped
+        numbers['failed'] += failed + broken
+    return numbers
+
+
+# Runs in an import process - every process needs its own MongoClient (clients can't be shared between processes)
+def _import_part_in_process(mongo_uri, db_name, collection_name, csv_path, source, start_byte, end_byte,
+                            batch_size, chunk_size):
+    client = MongoClient(mongo_uri)
+    try:
+        return _import_part(client[db_name][collection_name], csv_path, source, start_byte, end_byte,
+                            batch_size, None, chunk_size)
+    finally:
+        client.close()
+
+
+# Runs once in every import process. Processes start empty (spawn), so without this they would score with the rule
+def _start_import_process(model_artifact):
+    if model_artifact is not None:
+        from risk_model import RiskModel
+        set_risk_model(RiskModel(model_artifact))
+
+
+# Pool of import processes with the risk model that is used here.
+# spawn - new clean processes, forking a process that has threads and MongoDB connections is not safe
+def import_executor(processes):
+    model = current_risk_model()
+    return ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn'),
+                               initializer=_start_import_process, initargs=(model.artifact if model else None,))
+
+
+# Import bytes start..end of the file with many processes and add up the numbers of all parts.
+# The progress of a part is shown when the part is finished
+def _import_parallel(patients, csv_path, source, start, end, processes, mongo_uri, batch_size, progress, chunk_size):
+    if start == 0:
+        with open(csv_path, 'rb') as f:
+            f.readline()
+            start = f.tell()
+    parts = split_file(csv_path, start, end, processes * PARTS_PER_PROCESS)
+
+    totals = dict.fromkeys(['rows', 'inserted', 'updated', 'unchanged', 'skipped', 'failed'], 0)
+    with import_executor(processes) as executor:
+        futures = [executor.submit(_import_part_in_process, mongo_uri, patients.database.name, patients.name,
+                                   csv_path, source, part_start, part_end, batch_size, chunk_size)
+                   for part_start, part_end in parts]
+        for future in as_completed(futures):
+            numbers = future.result()
+            for key, value in numbers.items():
+                totals[key] += value
+            if progress:
+                progress(rows_read=numbers['rows'], inserted=numbers['inserted'], updated=numbers['updated'],
+                         unchanged=numbers['unchanged'], skipped=numbers['skipped'], failed=numbers['failed'])
+    return totals
+
+
+# Full import: read file chunk by chunk, clean it, save it and measure how fast it was.
+# incremental=False reads and checks the whole file even if it didn't change
+# processes - how many processes import the file (default IMPORT_PROCESSES), they connect to mongo_uri
+# (default MONGO_URI from db_setup.py), so it only works with a real MongoDB server
+# source - name of the data source, rows are matched to patients from the same source (default: full file path)
+def import_dataset(patients, csv_path, batch_size=None, progress=None, chunk_size=None, incremental=None,
+                   processes=None, mongo_uri=None, source=None):
+    started = time.perf_counter()
+    # Patients that are already saved are only skipped because of the unique index - without it they'd be saved twice
+    if not has_dedupe_index(patients):
+        raise RuntimeError(f"Index {DEDUPE_INDEX} is missing, run 'flask --app main_app init-db' before importing")
+    incremental = IMPORT_INCREMENTAL if incremental is None else incremental
+    processes = IMPORT_PROCESSES if processes is None else processes
+
+    state = patients.database[IMPORT_STATE_COLLECTION]
+    state_id = os.path.abspath(csv_path)
+    source = source or state_id
+    previous = state.find_one({'_id': state_id}) if incremental else None
+    stat = os.stat(csv_path)
+
+    mode = 'full'
+    start_byte = 0
+    rows_before = 0
+    if previous and previous['size'] == stat.st_size and previous['mtime_ns'] == stat.st_mtime_ns:
+        mode = 'unchanged'
+        fingerprint = previous
+    else:
+        fingerprint = file_fingerprint(csv_path, previous)
+        if previous and fingerprint['sha256'] == previous['sha256']:
+            mode = 'unchanged'
+        elif fingerprint['appended']:
+            mode = 'append'
+            start_byte = previous['size']
+            rows_before = previous['rows']
+
+    numbers = dict.fromkeys(['rows', 'inserted', 'updated', 'unchanged', 'skipped', 'failed'], 0)
+    parallel = False
+    total_rows = previous['rows'] if mode == 'unchanged' else rows_before
+    if mode != 'unchanged':
+        parallel = processes > 1 and stat.st_size - start_byte >= IMPORT_PARALLEL_MIN_MB * 1024 * 1024
+        if parallel:
+            numbers = _import_parallel(patients, csv_path, source, start_byte, stat.st_size, processes,
+                                       mongo_uri or MONGO_URI, batch_size, progress, chunk_size)
+        else:
+            numbers = _import_part(patients, csv_path, source, start_byte, None, batch_size, progress, chunk_size)
+        total_rows += numbers['rows']
+
+    state.replace_one({'_id': state_id}, {
+        'size': fingerprint['size'],
+        'mtime_ns': stat.st_mtime_ns,
+        'sha256': fingerprint['sha256'],
+        'rows': total_rows,
+        'imported_at': time.time(),
+    }, upsert=True)
+
+    seconds = time.perf_counter() - started
+    return {
+        'mode': mode,
+        **numbers,
+        'processes': processes if parallel else 1,
+        'seconds': seconds,
+        'rows_per_sec': numbers['rows'] / seconds if seconds > 0 else 0.0,
+    }
@@ -3,8 +3,17 @@
 # I made sure my database operations are safe: by turn passwords into secret code, check for errors and always close databases properly.
 
    
-from werkzeug.security import generate_password_hash, check_password_hash # For keeping passwords safe, I use "werkzeug.security" - it turns passwords into secret code. 
-from db_setup import get_db_connection, get_mongodb_connection # From db_setup I get functions that help me connect to my databases.
+import time
+from password_hashing import hash_password, check_password # For keeping passwords safe, I use "werkzeug.security" (in password_hashing.py) - it turns passwords into secret code. 
+from db_setup import get_db_connection, close_db_connection, get_mongodb_connection # From db_setup I get functions that help me connect to my databases.
+from db_setup import PATIENT_SCHEMA
+from risk_scoring import risk_expression
+import insert_buffer
+from patient_validation import validate_patients
+from bson.objectid import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+import pandas as pd
 
 # User Operations (SQLite)
 def add_user(name, email, password):
@@ -13,7 +22,7 @@ def add_user(name, email, password):
     conn = get_db_connection()
     cursor = conn.cursor()
     try:
-        hashed_password = generate_password_hash(password)
+        hashed_password = hash_password(password)
         cursor.execute(
             'INSERT INTO users (name, email, password) VALUES (?, ?, ?)',
             (name, email, hashed_password)
@@ -23,7 +32,7 @@ def add_user(name, email, password):
     except Exception as e:
         return False, str(e)
     finally:
-        conn.close() # Database connection closes even if something goes wrong  
+        close_db_connection(conn) # Database connection closes even if something goes wrong  
 
 def verify_user(email, password):
 
@@ -37,20 +46,54 @@ def verify_user(email, password):
             (email,)
         ).fetchone()
         
-        if user and check_password_hash(user['password'], password):
-            return True, user['id']
+        if user:
+            password_ok, new_hash = check_password(user['password'], password)
+            if new_hash:
+                # Saved with an old hashing method - save the new hash
+                cursor.execute('UPDATE users SET password = ? WHERE id = ?', (new_hash, user['id']))
+                conn.commit()
+            if password_ok:
+                return True, user['id']
         return False, None
     finally:
-        conn.close()
+        close_db_connection(conn)
+
+# Patient change notifications
+# Some parts of the app keep results calculated from patients (for example the dashboard cache).
+# They register a function here, and every place that adds, edits, deletes or imports patients
+# calls patients_changed(), so nobody keeps old data.
+# ids - list of changed patient _ids, or None when it is not known which patients changed
+_change_listeners = []
+
+def on_patients_changed(listener):
+    _change_listeners.append(listener)
+    return listener
+
+def patients_changed(ids=None):
+    for listener in _change_listeners:
+        try:
+            listener(ids)
+        except Exception as e:
+            print(f"Error in patient change listener: {str(e)}")
 
 # Patient Operations (MongoDB)
+def insert_patient(patient_data):
+
+# Function saves one new patient and returns its _id (errors like DuplicateKeyError are raised).
+# With INSERT_BUFFER=1 the patient goes through the insert buffer (insert_buffer.py) and is saved together
+# with other patients sent at the same time, otherwise with its own insert_one
+    if insert_buffer.INSERT_BUFFER:
+        buffer = insert_buffer.make_insert_buffer(lambda: get_mongodb_connection().patients, patients_changed)
+        return buffer.insert(patient_data)
+    result = get_mongodb_connection().patients.insert_one(patient_data)
+    patients_changed([result.inserted_id])
+    return result.inserted_id
+
 def add_patient(patient_data):
 
 # Function adds new patient to database, Data gets checked in data_check.py before coming here
-    db = get_mongodb_connection()
     try:
-        result = db.patients.insert_one(patient_data)
-        return True, str(result.inserted_id)
+        return True, str(insert_patient(patient_data))
     except Exception as e:
         return False, str(e)
 
@@ -72,4 +115,257 @@ def get_all_patients():
         patients = list(db.patients.find())
         return patients
     except Exception as e:
-        return []
\ No newline at end of file
+        return []
+
+def rescore_patients(collection=None):
+
+# Function calculates stroke_risk again for all patients, after the risk rule in risk_scoring.py was changed.
+# It's one update_many with a pipeline, so MongoDB does everything itself and no patient is sent to Python.
+# Only patients whose risk is different are matched, so the others are not written at all.
+# Returns (number of patients changed, seconds)
+    if collection is None:
+        collection = get_mongodb_connection().patients
+    started = time.perf_counter()
+    risk = risk_expression()
+    result = collection.update_many({'$expr': {'$ne': ['$stroke_risk', risk]}}, [{'$set': {'stroke_risk': risk}}])
+    if result.modified_count:
+        patients_changed()
+    return result.modified_count, time.perf_counter() - started
+
+# Columns shown in the patient table - only these are sent from MongoDB for the list page
+PATIENT_LIST_FIELDS = {
+    '_id': 1,
+    'age': 1,
+    'avg_glucose_level': 1,
+    'smoking_status': 1,
+    'hypertension': 1,
+    'stroke_risk': 1,
+}
+
+# Ways the patient list can be sorted. Every sort ends with _id, so patients with the same value
+# always come in the same order and a page can continue exactly where the previous one stopped
+PATIENT_SORTS = {
+    'newest': [('_id', -1)],
+    'oldest': [('_id', 1)],
+    'risk_high': [('stroke_risk', -1), ('_id', -1)],
+    'risk_low': [('stroke_risk', 1), ('_id', 1)],
+    'age_high': [('age', -1), ('_id', -1)],
+    'age_low': [('age', 1), ('_id', 1)],
+}
+
+# Filters where the patient must have exactly one value. They are the first fields of the
+# patients_filter_* indexes (db_setup.py), so when one of them is used the others get all allowed values
+# from PATIENT_SCHEMA - then MongoDB can always use the index from its first field, instead of reading every patient
+EXACT_FILTERS = ['smoking_status', 'hypertension', 'gender']
+
+
+def patient_filter(risk_min=None, risk_max=None, age_min=None, age_max=None,
+                   smoking_status=None, hypertension=None, gender=None):
+
+# Function turns list filters into a MongoDB query. None means "don't filter by this".
+# risk_min/risk_max are 0-1 like stroke_risk in the database, all ranges include both ends
+    query = {}
+    for field, low, high in [('stroke_risk', risk_min, risk_max), ('age', age_min, age_max)]:
+        limits = {}
+        if low is not None:
+            limits['$gte'] = low
+        if high is not None:
+            limits['$lte'] = high
+        if limits:
+            query[field] = limits
+
+    exact = {'smoking_status': smoking_status, 'hypertension': hypertension, 'gender': gender}
+    if any(value is not None for value in exact.values()):
+        for field in EXACT_FILTERS:
+            if exact[field] is not None:
+                query[field] = exact[field]
+            else:
+                # Fields that are not required can be missing (null is in the index too, so it's still used)
+                allowed = PATIENT_SCHEMA['properties'][field]['enum']
+                query[field] = {'$in': allowed if field in PATIENT_SCHEMA['required'] else allowed + [None]}
+    return query
+
+
+# Text for Next/Previous links - the sort value and _id of the patient where the page ends.
+# For the _id sorts it's just the _id, like before sorting was added
+def encode_page_cursor(patient, sort='newest'):
+    fields = PATIENT_SORTS[sort]
+    if len(fields) == 1:
+        return str(patient['_id'])
+    return f"{patient.get(fields[0][0])!r}_{patient['_id']}"
+
+
+# Opposite of encode_page_cursor, raises ValueError (or InvalidId) for a broken cursor
+def decode_page_cursor(cursor, sort='newest'):
+    fields = PATIENT_SORTS[sort]
+    if len(fields) == 1:
+        return None, ObjectId(cursor)
+    value, _, patient_id = cursor.rpartition('_')
+    return float(value), ObjectId(patient_id)
+
+
+# Query for patients after (or before) the cursor in the chosen order
+def _keyset_query(fields, cursor, forward):
+    value, patient_id = cursor
+    descending = fields[-1][1] == -1
+    compare = '$lt' if descending == forward else '$gt'
+    if len(fields) == 1:
+        return {'_id': {compare: patient_id}}
+    field = fields[0][0]
+    # The first part lets MongoDB start reading the index at the cursor value, $or finds the exact place
+    return {field: {compare + 'e': value},
+            '$or': [{field: {compare: value}}, {'_id': {compare: patient_id}}]}
+
+
+# MongoDB query and sort for one page - shared by get_patients_page and the async version (async_db.py)
+def page_find_arguments(query, sort, cursor, forward):
+    fields = PATIENT_SORTS[sort]
+    conditions = [query] if query else []
+    if cursor is not None:
+        conditions.append(_keyset_query(fields, decode_page_cursor(cursor, sort), forward))
+    if not conditions:
+        wanted = {}
+    else:
+        wanted = conditions[0] if len(conditions) == 1 else {'$and': conditions}
+    order = fields if forward else [(field, -direction) for field, direction in fields]
+    return wanted, order
+
+
+# Page from the rows MongoDB sent (page_size + 1 of them, so it's known if there is another page)
+def page_result(rows, page_size, sort, after, before):
+    if before is not None:
+        # Going back - rows are in opposite order, turn them around
+        has_newer = len(rows) > page_size
+        rows = rows[:page_size][::-1]
+        has_older = True
+    else:
+        has_older = len(rows) > page_size
+        rows = rows[:page_size]
+        has_newer = after is not None
+
+    return {
+        'patients': rows,
+        'next_cursor': encode_page_cursor(rows[-1], sort) if rows and has_older else None,
+        'prev_cursor': encode_page_cursor(rows[0], sort) if rows and has_newer else None,
+    }
+
+
+def get_patients_page(collection=None, after=None, before=None, page_size=50, query=None, sort='newest'):
+
+# Function gets one page of the patient list, newest patients first (or in the chosen sort).
+# Instead of skipping rows (skip gets slower on every next page) it remembers where the page ended
+# (sort value and _id) and asks MongoDB only for patients after it, so every page is equally fast, even with a very big collection.
+# after - cursor of the last patient on the current page (next page)
+# before - cursor of the first patient on the current page (previous page), these patients are taken in opposite order
+# query - filters from patient_filter()
+    if collection is None:
+        collection = get_mongodb_connection().patients
+    cursor = before if before is not None else after
+    wanted, order = page_find_arguments(query, sort, cursor, forward=before is None)
+    rows = list(collection.find(wanted, PATIENT_LIST_FIELDS).sort(order).limit(page_size + 1))
+    return page_result(rows, page_size, sort, after, before)
+
+# Fields of a patient that can be sent by users, stroke_risk is always calculated by the app
+PATIENT_FIELDS = [name for name in PATIENT_SCHEMA['properties'] if name != 'stroke_risk']
+
+
+def check_patient_fields(data, partial=False):
+
+# Function checks patient fields (from a form or JSON) with the same rules MongoDB uses.
+# partial=True - only the fields that were sent are checked (for changing some fields of many patients)
+# Returns (fields ready for MongoDB, None) or (None, list of errors)
+    if not isinstance(data, dict):
+        return None, ['Send the patient as a JSON object']
+    unknown = [name for name in data if name not in PATIENT_FIELDS and name != '_id']
+    if partial and unknown:
+        return None, [f"{name} can't be changed" for name in unknown]
+    fields = {name: data[name] for name in PATIENT_FIELDS if data.get(name) is not None}
+    if partial and not fields:
+        return None, ['Nothing to change']
+    schema = {**PATIENT_SCHEMA, 'required': []} if partial else PATIENT_SCHEMA
+    df, valid, errors = validate_patients(pd.DataFrame([fields]), schema)
+    if not valid[0]:
+        return None, errors[0]
+    # Numbers from the DataFrame are NumPy numbers, MongoDB needs normal Python ones (and age must be a double)
+    fields = {name: value.item() if hasattr(value, 'item') else value for name, value in df.iloc[0].items()}
+    if 'age' in fields:
+        fields['age'] = float(fields['age'])
+    return fields, None
+
+
+# Bulk operations - many patients in one request.
+# Patients are chosen by a list of _ids or by a filter (patient_filter), and MongoDB changes all of them
+# with one delete_many / update_many, so there is one round trip instead of one for every patient.
+# All of them return counts and seconds, and tell the caches which patients changed
+# (ids=None when patients were chosen by a filter - then it's not known which ones).
+
+def _bulk_selector(ids, query):
+    if ids is not None:
+        return {'_id': {'$in': list(ids)}}
+    return query or {}
+
+
+def bulk_delete_patients(collection=None, ids=None, query=None):
+    if collection is None:
+        collection = get_mongodb_connection().patients
+    started = time.perf_counter()
+    result = collection.delete_many(_bulk_selector(ids, query))
+    if result.deleted_count:
+        patients_changed(ids)
+    return {'deleted': result.deleted_count, 'seconds': round(time.perf_counter() - started, 6)}
+
+
+# Update pipeline that sets the fields and then calculates the risk again inside MongoDB.
+# In a pipeline text starting with $ would be read as a field name (smoking_status "$age" would copy the age),
+# so every value is sent as $literal
+def _fields_and_risk(fields, risk=None):
+    return [{'$set': {name: {'$literal': value} for name, value in fields.items()}},
+            {'$set': {'stroke_risk': risk_expression() if risk is None else risk}}]
+
+
+# The same fields are set on all chosen patients, and their risk is calculated again inside MongoDB
+# (the fields may be the ones the risk depends on) - both in one update_many with a pipeline
+def bulk_update_patients(fields, collection=None, ids=None, query=None):
+    if collection is None:
+        collection = get_mongodb_connection().patients
+    started = time.perf_counter()
+    result = collection.update_many(_bulk_selector(ids, query), _fields_and_risk(fields))
+    if result.modified_count:
+        patients_changed(ids)
+    return {'matched': result.matched_count, 'modified': result.modified_count,
+            'seconds': round(time.perf_counter() - started, 6)}
+
+
+# Like rescore_patients, but only for the chosen patients (matched - patients whose risk was different)
+def bulk_rescore_patients(collection=None, ids=None, query=None):
+    if collection is None:
+        collection = get_mongodb_connection().patients
+    started = time.perf_counter()
+    risk = risk_expression()
+    result = collection.update_many({**_bulk_selector(ids, query), '$expr': {'$ne': ['$stroke_risk', risk]}}, [{'$set': {'stroke_risk': risk}}])
+    if result.modified_count:
+        patients_changed(ids)
+    return {'matched': result.matched_count, 'modified': result.modified_count,
+            'seconds': round(time.perf_counter() - started, 6)}
+
+
+# Different fields for every patient (for example fixing values after a bad import): one UpdateOne for every
+# patient, all sent in one unordered bulk_write (pymongo splits it into batches MongoDB accepts).
+# changes - {patient _id: fields}. A patient rejected by MongoDB (for example a duplicate) doesn't stop the others
+def bulk_edit_patients(changes, collection=None):
+    if collection is None:
+        collection = get_mongodb_connection().patients
+    started = time.perf_counter()
+    ids = list(changes)
+    risk = risk_expression()
+    operations = [UpdateOne({'_id': patient_id}, _fields_and_risk(fields, risk)) for patient_id, fields in changes.items()]
+    errors = []
+    try:
+        result = collection.bulk_write(operations, ordered=False).bulk_api_result
+    except BulkWriteError as e:
+        result = e.details
+        errors = [{'_id': str(ids[error['index']]), 'error': error['errmsg']} for error in result['writeErrors']]
+    if result['nModified']:
+        patients_changed(ids)
+    return {'matched': result['nMatched'], 'modified': result['nModified'], 'failed': len(errors), 'errors': errors,
+            'seconds': round(time.perf_counter() - started, 6)}
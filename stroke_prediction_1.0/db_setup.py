@@ -2,12 +2,31 @@
 # All information about databases and how I use them is in main_app.py
 
 import sqlite3
-from pymongo import MongoClient
+import threading
+import time
+from flask import g, has_app_context
+from pymongo import MongoClient, IndexModel, ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+from pymongo.monitoring import ConnectionPoolListener
+from metrics import Gauge, register, mongo_command_timer, observe_sqlite
 import os
 
+# Where the databases are - can be changed with environment variables
+SQLITE_PATH = os.environ.get('SQLITE_PATH', '../database/user_base.db')
+MONGO_URI = os.environ.get('MONGO_URI', 'mongodb://localhost:27017/')
+MONGO_DB_NAME = os.environ.get('MONGO_DB_NAME', 'stroke_management')
+
+# MongoDB connection pool settings, one pool is shared by the whole app (see get_mongo_client)
+MONGO_POOL_OPTIONS = {
+    'maxPoolSize': int(os.environ.get('MONGO_MAX_POOL_SIZE', 100)),
+    'minPoolSize': int(os.environ.get('MONGO_MIN_POOL_SIZE', 0)),
+    'maxIdleTimeMS': int(os.environ.get('MONGO_MAX_IDLE_TIME_MS', 60000)),
+    'waitQueueTimeoutMS': int(os.environ.get('MONGO_WAIT_QUEUE_TIMEOUT_MS', 5000)),
+}
+
 def setup_sqlite():
 # Set up SQLite database for user accounts
-    conn = sqlite3.connect('../database/user_base.db')
+    conn = _open_sqlite()
     cursor = conn.cursor()
     
     # Create users table with all needed fields
@@ -20,14 +39,96 @@ def setup_sqlite():
         created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
     )
     ''')
+
+    # Sessions saved on the server (only used with SESSION_BACKEND=sqlite, see session_store.py)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS sessions (
+        id TEXT PRIMARY KEY,
+        data TEXT NOT NULL,
+        expires REAL NOT NULL
+    )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires)')
+
+    # Progress of CSV imports (import_jobs.py), so every worker process can show it
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS import_jobs (
+        id TEXT PRIMARY KEY,
+        status TEXT NOT NULL,
+        message TEXT,
+        rows_read INTEGER NOT NULL DEFAULT 0,
+        inserted INTEGER NOT NULL DEFAULT 0,
+        updated INTEGER NOT NULL DEFAULT 0,
+        unchanged INTEGER NOT NULL DEFAULT 0,
+        skipped INTEGER NOT NULL DEFAULT 0,
+        failed INTEGER NOT NULL DEFAULT 0,
+        created REAL NOT NULL,
+        started REAL,
+        finished REAL
+    )
+    ''')
     
     conn.commit()
-    conn.close()
+    close_db_connection(conn)
+
+# Rules for patient data - these came from medical guidelines.
+# MongoDB checks every saved patient with them, and the prediction API (patient_validation.py) checks with the same rules
+PATIENT_SCHEMA = {
+    'bsonType': 'object',
+    'required': ['gender', 'age', 'hypertension', 'avg_glucose_level', 'bmi'],
+    'properties': {
+        'gender': {
+            'bsonType': 'string',
+            'enum': ['Male', 'Female', 'Other']
+        },
+        'age': {
+            'bsonType': 'double',
+            'minimum': 0,
+            'maximum': 120
+        },
+        'hypertension': {
+            'bsonType': 'int',
+            'enum': [0, 1]
+        },
+        'heart_disease': {
+            'bsonType': 'int',
+            'enum': [0, 1]
+        },
+        'ever_married': {
+            'bsonType': 'string',
+            'enum': ['Yes', 'No']
+        },
+        'work_type': {
+            'bsonType': 'string'
+        },
+        'residence_type': {
+            'bsonType': 'string',
+            'enum': ['Rural', 'Urban']
+        },
+        'avg_glucose_level': {
+            'bsonType': ['double', 'int'], # to accept both int and double ['double', 'init']
+            'minimum': 0
+        },
+        'bmi': {
+            'bsonType': ['double', 'int'], # to accept both int and double ['double', 'init']
+            'minimum': 10,
+            'maximum': 70
+        },
+        'smoking_status': {
+            'bsonType': 'string',
+            'enum': ['formerly smoked', 'never smoked', 'smokes', 'Unknown']
+        },
+        'stroke_risk': {
+            'bsonType': ['double', 'int'], # to accept both int and double ['double', 'init']
+            'minimum': 0,
+            'maximum': 1
+        }
+    }
+}
 
 def setup_mongodb():
     # Set up MongoDB for patient medical data
-    client = MongoClient('mongodb://localhost:27017/')
-    db = client['stroke_management']
+    db = get_mongodb_connection()
     
     # Create collection only if it doesn't exist
     if 'patients' not in db.list_collection_names():
@@ -41,84 +142,245 @@ def setup_mongodb():
     db.command({
         'collMod': 'patients',
         'validator': {
-            '$jsonSchema': {
-                'bsonType': 'object',
-                'required': ['gender', 'age', 'hypertension', 'avg_glucose_level', 'bmi'],
-                'properties': {
-                    'gender': {
-                        'bsonType': 'string',
-                        'enum': ['Male', 'Female', 'Other']
-                    },
-                    'age': {
-                        'bsonType': 'double',
-                        'minimum': 0,
-                        'maximum': 120
-                    },
-                    'hypertension': {
-                        'bsonType': 'int',
-                        'enum': [0, 1]
-                    },
-                    'ever_married': {
-                        'bsonType': 'string',
-                        'enum': ['Yes', 'No']
-                    },
-                    'work_type': {
-                        'bsonType': 'string'
-                    },
-                    'residence_type': {
-                        'bsonType': 'string',
-                        'enum': ['Rural', 'Urban']
-                    },
-                    'avg_glucose_level': {
-                        'bsonType': ['double', 'int'], # to accept both int and double ['double', 'init']
-                        'minimum': 0
-                    },
-                    'bmi': {
-                        'bsonType': ['double', 'int'], # to accept both int and double ['double', 'init']
-                        'minimum': 10,
-                        'maximum': 70
-                    },
-                    'smoking_status': {
-                        'bsonType': 'string',
-                        'enum': ['formerly smoked', 'never smoked', 'smokes', 'Unknown']
-                    },
-                    'stroke_risk': {
-                        'bsonType': ['double', 'int'], # to accept both int and double ['double', 'init']
-                        'minimum': 0,
-                        'maximum': 1
-                    }
-                }
-            }
+            '$jsonSchema': PATIENT_SCHEMA
         }
     })
 
-def init_databases():
+    setup_mongodb_indexes(db.patients)
+
+# Indexes for the patients collection. All my indexes start with "patients_", so setup can
+# find old versions of them and change them, without touching indexes made by somebody else.
+#
+# patients_dedupe_key - unique, the same patient (gender, age, hypertension, glucose) can be saved only once,
+#                       CSV import relies on it instead of asking MongoDB about every patient before saving
+# patients_stroke_risk - for finding patients by risk level (highest first)
+# patients_source_id - for finding patients by their file and id in the file, so re-import can see what changed
+# patients_age - patient list sorted by age
+# patients_filter_risk, patients_filter_age - patient list with filters (db_operations.patient_filter).
+#                       Fields go in this order: exact values first (smoking, hypertension, gender), then the field
+#                       that is sorted and filtered by range, then _id - MongoDB finds the patients of one page
+#                       straight from the index, without sorting in memory or reading the whole collection
+# The patient list is sorted by _id, MongoDB already has an index for it
+PATIENT_INDEX_PREFIX = 'patients_'
+DEDUPE_INDEX = 'patients_dedupe_key'
+PATIENT_INDEXES = [
+    IndexModel([('gender', ASCENDING), ('age', ASCENDING), ('hypertension', ASCENDING), ('avg_glucose_level', ASCENDING)],
+               name=DEDUPE_INDEX, unique=True),
+    IndexModel([('stroke_risk', DESCENDING), ('_id', DESCENDING)],
+               name='patients_stroke_risk'),
+    IndexModel([('source', ASCENDING), ('source_id', ASCENDING)], name='patients_source_id', sparse=True),
+    IndexModel([('age', ASCENDING), ('_id', ASCENDING)], name='patients_age'),
+    IndexModel([('smoking_status', ASCENDING), ('hypertension', ASCENDING), ('gender', ASCENDING),
+                ('stroke_risk', DESCENDING), ('_id', DESCENDING)], name='patients_filter_risk'),
+    IndexModel([('smoking_status', ASCENDING), ('hypertension', ASCENDING), ('gender', ASCENDING),
+                ('age', ASCENDING), ('_id', ASCENDING)], name='patients_filter_age'),
+]
+
+def _same_index(existing, wanted):
+    # Compare keys and unique option of index from MongoDB with my declaration
+    return (list(existing['key']) == list(wanted['key'].items())
+            and bool(existing.get('unique')) == bool(wanted.get('unique')))
+
+def setup_mongodb_indexes(collection):
+    # Make indexes in MongoDB the same as PATIENT_INDEXES:
+    # missing ones are created, changed ones are made again, old ones that I don't use anymore are removed
+    existing = collection.index_information()
+    wanted = {index.document['name']: index for index in PATIENT_INDEXES}
+
+    for name in existing:
+        if name.startswith(PATIENT_INDEX_PREFIX) and name not in wanted:
+            collection.drop_index(name)
+
+    failed = []
+    for name, index in wanted.items():
+        if name in existing:
+            if _same_index(existing[name], index.document):
+                continue
+            collection.drop_index(name)
+        try:
+            collection.create_indexes([index])
+        except OperationFailure as e:
+            # Unique index can't be made when duplicates are already saved - the other indexes are still made,
+            # but setup fails, because the import needs this index to skip patients that are already saved
+            if e.code == 11000:
+                failed.append(f"Index {name} not created, remove duplicate patients first: {e}")
+            else:
+                raise
+    if failed:
+        raise RuntimeError('; '.join(failed))
+
+def has_dedupe_index(collection):
+    # True when the unique index that stops duplicate patients exists
+    return DEDUPE_INDEX in collection.index_information()
+
+_databases_ready = False
+_init_lock = threading.Lock()
+
+def init_databases(force=False):
     # Initialize both databases and show any errors
-    try:
-        setup_sqlite()
-        print("SQLite database setup complete")
-        
-        setup_mongodb()
-        print("MongoDB setup complete")
-        
-    except Exception as e:
-        print(f"Error setting up databases: {e}")
-        raise e  # Re-raise the error so the app knows something went wrong
+    # It runs only once in a process (force=True runs it again) - every step only creates what is missing
+    global _databases_ready
+    with _init_lock:
+        if _databases_ready and not force:
+            return
+        try:
+            setup_sqlite()
+            print("SQLite database setup complete")
+            
+            setup_mongodb()
+            print("MongoDB setup complete")
+            _databases_ready = True
+            
+        except Exception as e:
+            print(f"Error setting up databases: {e}")
+            raise e  # Re-raise the error so the app knows something went wrong
     
 # Database connection functions
+#
+# Before, every function opened a new connection and the app paid for connecting on every request.
+# Now MongoDB has one client (with its own pool of connections) for the whole process,
+# and SQLite has one connection per request, kept on Flask "g" and closed when the request ends.
 
-def get_db_connection():
-    # Connect to SQLite - used for user accounts
-    conn = sqlite3.connect('../database/user_base.db')
+# Counts what happens in the MongoDB connection pool, so I can see if the pool is too small
+class PoolStats(ConnectionPoolListener):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {'created': 0, 'closed': 0, 'checked_out': 0, 'checked_in': 0, 'checkout_failed': 0}
+
+    def _add(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    def pool_created(self, event): pass
+    def pool_ready(self, event): pass
+    def pool_cleared(self, event): pass
+    def pool_closed(self, event): pass
+    def connection_created(self, event): self._add('created')
+    def connection_ready(self, event): pass
+    def connection_closed(self, event): self._add('closed')
+    def connection_check_out_started(self, event): pass
+    def connection_check_out_failed(self, event): self._add('checkout_failed')
+    def connection_checked_out(self, event): self._add('checked_out')
+    def connection_checked_in(self, event): self._add('checked_in')
+
+    def snapshot(self):
+        with self._lock:
+            counts = dict(self.counts)
+        counts['open'] = counts['created'] - counts['closed']
+        counts['in_use'] = counts['checked_out'] - counts['checked_in']
+        return counts
+
+mongo_pool_stats = PoolStats()
+sqlite_stats = {'opened': 0, 'closed': 0}
+_stats_lock = threading.Lock()
+_mongo_client = None
+_mongo_client_lock = threading.Lock()
+
+def get_mongo_client():
+    # One MongoClient for the whole process - it is thread safe and keeps its own connection pool
+    global _mongo_client
+    if _mongo_client is None:
+        with _mongo_client_lock:
+            if _mongo_client is None:
+                _mongo_client = MongoClient(MONGO_URI, event_listeners=[mongo_pool_stats, mongo_command_timer],
+                                            **MONGO_POOL_OPTIONS)
+    return _mongo_client
+
+def set_mongo_client(client, db_name=None):
+    # Use another client instead of the normal one - benchmarks.py runs the app on an in-process MongoDB this way
+    global _mongo_client, MONGO_DB_NAME
+    with _mongo_client_lock:
+        _mongo_client = client
+        if db_name:
+            MONGO_DB_NAME = db_name
+
+def close_mongo_client():
+    # Close shared client (for example when the app stops)
+    global _mongo_client
+    with _mongo_client_lock:
+        if _mongo_client is not None:
+            _mongo_client.close()
+            _mongo_client = None
+
+# SQLite connection that measures every statement (for /metrics, see metrics.py)
+class TimedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            observe_sqlite(sql, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            observe_sqlite(sql, time.perf_counter() - started)
+
+class TimedConnection(sqlite3.Connection):
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+def _open_sqlite():
+    conn = sqlite3.connect(SQLITE_PATH, factory=TimedConnection)
     conn.row_factory = sqlite3.Row
+    # WAL lets readers work while somebody is writing, busy_timeout waits for a lock instead of failing at once
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA busy_timeout=5000')
+    with _stats_lock:
+        sqlite_stats['opened'] += 1
     return conn
 
+def get_db_connection():
+    # Connect to SQLite - used for user accounts
+    # Inside a request the same connection is used by all code, it is closed in teardown_db_connection
+    if has_app_context():
+        if 'db' not in g:
+            g.db = _open_sqlite()
+        return g.db
+    return _open_sqlite()
+
+def close_db_connection(conn):
+    # Close connection, but not the one that belongs to the current request - teardown closes that one
+    if has_app_context() and g.get('db') is conn:
+        return
+    conn.close()
+    with _stats_lock:
+        sqlite_stats['closed'] += 1
+
+def teardown_db_connection(exception=None):
+    # Flask calls this when request ends (app.teardown_appcontext)
+    conn = g.pop('db', None)
+    if conn is not None:
+        conn.close()
+        with _stats_lock:
+            sqlite_stats['closed'] += 1
+
 def get_mongodb_connection():
     # Connect to MongoDB - used for patient data
-    client = MongoClient('mongodb://localhost:27017/')
-    db = client['stroke_management']
-    return db
+    return get_mongo_client()[MONGO_DB_NAME]
+
+def get_pool_stats():
+    # Numbers for monitoring - MongoDB pool and SQLite connections
+    with _stats_lock:
+        sqlite = dict(sqlite_stats)
+    sqlite['open'] = sqlite['opened'] - sqlite['closed']
+    return {
+        'mongodb': dict(mongo_pool_stats.snapshot(), max_pool_size=MONGO_POOL_OPTIONS['maxPoolSize']),
+        'sqlite': sqlite,
+    }
+
+# Pool numbers are also shown on /metrics
+def _pool_gauge_values():
+    stats = get_pool_stats()
+    return {(database, name): value for database, numbers in stats.items() for name, value in numbers.items()}
+
+register(Gauge('database_connections', 'Database connection pool numbers', _pool_gauge_values, ('database', 'stat')))
 
 # Only run database setup if this file is run directly
 if __name__ == "__main__":
-    init_databases()
\ No newline at end of file
+    init_databases()
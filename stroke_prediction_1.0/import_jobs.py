@@ -0,0 +1,156 @@
+# Background jobs for the CSV import.
+# Before, the "Update Dataset" button kept the Flask worker busy until the whole file was imported,
+# so with a big file the browser (or proxy) gave up and nobody else could use the app meanwhile.
+# Now the import runs in a small pool of background threads. Every import gets its own job ID,
+# and /import_status/<job_id> shows how many rows were read, inserted, updated, skipped and failed while it runs.
+#
+# The numbers are saved in the SQLite table import_jobs (made by setup_sqlite in db_setup.py), so with several
+# worker processes any worker can answer /import_status, not only the one running the import.
+#
+# IMPORT_WORKERS - how many imports can run at the same time in one worker process (default 2)
+# IMPORT_QUEUE_LIMIT - how many imports can wait or run at once in one worker process, more are refused (default 10)
+
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from db_setup import get_db_connection, close_db_connection
+
+IMPORT_WORKERS = int(os.environ.get('IMPORT_WORKERS', 2))
+IMPORT_QUEUE_LIMIT = int(os.environ.get('IMPORT_QUEUE_LIMIT', 10))
+
+# Finished jobs are kept for the status page, but only the newest ones
+MAX_FINISHED_JOBS = 100
+# Progress is saved to SQLite at most this often (seconds), the importer reports after every batch
+SAVE_INTERVAL = 0.5
+
+COUNT_FIELDS = ['rows_read', 'inserted', 'updated', 'unchanged', 'skipped', 'failed']
+
+_executor = ThreadPoolExecutor(max_workers=IMPORT_WORKERS, thread_name_prefix='import')
+# Jobs of this process that are not finished yet
+_jobs = {}
+_jobs_lock = threading.Lock()
+
+
+class ImportQueueFull(Exception):
+    pass
+
+
+# One import - the numbers are updated by the importer while it works and saved to SQLite
+class ImportJob:
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.status = 'queued'
+        self.message = None
+        self.rows_read = 0
+        self.inserted = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.skipped = 0
+        self.failed = 0
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self._saved = 0.0
+        self._lock = threading.Lock()
+
+    # Importer calls this after every batch with how many rows it has done since last time
+    def progress(self, rows_read=0, inserted=0, updated=0, unchanged=0, skipped=0, failed=0):
+        with self._lock:
+            self.rows_read += rows_read
+            self.inserted += inserted
+            self.updated += updated
+            self.unchanged += unchanged
+            self.skipped += skipped
+            self.failed += failed
+            if time.monotonic() - self._saved < SAVE_INTERVAL:
+                return
+        self.save()
+
+    def save(self):
+        with self._lock:
+            self._saved = time.monotonic()
+            row = (self.id, self.status, self.message, *(getattr(self, field) for field in COUNT_FIELDS),
+                   self.created, self.started, self.finished)
+        conn = get_db_connection()
+        try:
+            with conn:
+                conn.execute(f"INSERT OR REPLACE INTO import_jobs (id, status, message, {', '.join(COUNT_FIELDS)}, "
+                             "created, started, finished) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", row)
+        finally:
+            close_db_connection(conn)
+
+
+# Numbers for the status page from a saved job
+def _status(row):
+    end = row['finished'] or time.time()
+    seconds = end - row['started'] if row['started'] else 0.0
+    return {
+        'id': row['id'],
+        'status': row['status'],
+        'message': row['message'],
+        **{field: row[field] for field in COUNT_FIELDS},
+        'seconds': round(seconds, 3),
+        'rows_per_sec': round(row['rows_read'] / seconds, 1) if seconds > 0 else 0.0,
+    }
+
+
+def _run(job, import_function):
+    job.status = 'running'
+    job.started = time.time()
+    job.save()
+    try:
+        success, message = import_function(progress=job.progress)
+        job.status = 'finished' if success else 'failed'
+        job.message = message
+    except Exception as e:
+        job.status = 'failed'
+        job.message = f"Error data: {str(e)}"
+    finally:
+        job.finished = time.time()
+        job.save()
+        with _jobs_lock:
+            _jobs.pop(job.id, None)
+        _forget_old_jobs()
+
+
+# Remove the oldest finished jobs so the table doesn't grow forever
+def _forget_old_jobs():
+    conn = get_db_connection()
+    try:
+        with conn:
+            conn.execute('DELETE FROM import_jobs WHERE finished IS NOT NULL AND id NOT IN '
+                         '(SELECT id FROM import_jobs WHERE finished IS NOT NULL ORDER BY finished DESC LIMIT ?)',
+                         (MAX_FINISHED_JOBS,))
+    finally:
+        close_db_connection(conn)
+
+
+# Start import in background and return its job straight away.
+# import_function must accept progress= and return (success, message) like import_dataset_data
+def submit_import(import_function):
+    with _jobs_lock:
+        active = len(_jobs)
+        if active >= IMPORT_QUEUE_LIMIT:
+            raise ImportQueueFull(f"Too many imports running ({active}), please try again later")
+        job = ImportJob()
+        _jobs[job.id] = job
+    try:
+        job.save()
+    except Exception:
+        with _jobs_lock:
+            _jobs.pop(job.id, None)
+        raise
+    _executor.submit(_run, job, import_function)
+    return job
+
+
+# Status of a job started by any worker process, None when there is no such job
+def get_job_status(job_id):
+    conn = get_db_connection()
+    try:
+        row = conn.execute('SELECT * FROM import_jobs WHERE id = ?', (job_id,)).fetchone()
+    finally:
+        close_db_connection(conn)
+    return _status(row) if row is not None else None
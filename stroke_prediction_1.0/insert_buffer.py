@@ -0,0 +1,175 @@
+# Buffer that saves single new patients in groups (one insert_many for many patients).
+# Every new patient was one insert_one, and the request waited for MongoDB's answer before the next one could
+# use that connection - with kiosks and other systems sending patients all the time, most of the time was
+# spent waiting for answers. Now patients sent at about the same time wait a moment (INSERT_BUFFER_WAIT_MS)
+# in the buffer and are saved together. Every caller still gets its own _id, or its own error
+# (DuplicateKeyError for the same patient twice - one bad patient doesn't stop the others in the group).
+#
+# INSERT_BUFFER - 1 turns the buffer on (default 0 - every patient is saved with its own insert_one)
+# INSERT_BUFFER_SIZE - group is saved when it has this many patients (default 100)
+# INSERT_BUFFER_WAIT_MS - or when the first patient in it waited this long (default 5 ms)
+# INSERT_BUFFER_MAX_PENDING - more patients than this waiting, and new callers wait for space (default 10000)
+# INSERT_BUFFER_W / INSERT_BUFFER_JOURNAL - write concern of the group inserts, for example W=majority and
+#                  JOURNAL=1 (default: w=1, journal as set on the server). W=0 means errors are not known
+#
+# Patients still waiting are saved when the process stops (atexit), so none are lost on a normal shutdown.
+
+import os
+import time
+import atexit
+import threading
+from concurrent.futures import Future
+from pymongo import WriteConcern
+from pymongo.errors import BulkWriteError, DuplicateKeyError, WriteError, WriteConcernError
+from metrics import Histogram, register
+
+INSERT_BUFFER = os.environ.get('INSERT_BUFFER', '0') == '1'
+INSERT_BUFFER_SIZE = int(os.environ.get('INSERT_BUFFER_SIZE', 100))
+INSERT_BUFFER_WAIT_MS = float(os.environ.get('INSERT_BUFFER_WAIT_MS', 5))
+INSERT_BUFFER_MAX_PENDING = int(os.environ.get('INSERT_BUFFER_MAX_PENDING', 10000))
+INSERT_BUFFER_W = os.environ.get('INSERT_BUFFER_W', '1')
+INSERT_BUFFER_JOURNAL = os.environ.get('INSERT_BUFFER_JOURNAL')
+
+# MongoDB error code for a patient rejected by a unique index
+DUPLICATE_KEY_ERROR = 11000
+
+INSERT_BATCH_SIZE = register(Histogram('insert_buffer_batch_size', 'Patients saved by one insert_many of the insert buffer',
+                                       buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)))
+
+
+# Write concern from the settings ("majority" or a number of servers, journal 1/0 or not set)
+def write_concern(w=None, journal=None):
+    w = INSERT_BUFFER_W if w is None else w
+    journal = INSERT_BUFFER_JOURNAL if journal is None else journal
+    options = {'w': int(w) if str(w).isdigit() else w}
+    if journal not in (None, ''):
+        options['j'] = str(journal) == '1'
+    return WriteConcern(**options)
+
+
+class InsertBuffer:
+    # get_collection - function that gives the collection (called for every group, so it works in any thread)
+    # on_inserted - called with the _ids of every saved group, before callers get their _ids
+    #               (with None when the insert failed and it's not known which patients were saved)
+    def __init__(self, get_collection, on_inserted=None, max_batch=None, max_wait_ms=None,
+                 max_pending=None, concern=None):
+        self.get_collection = get_collection
+        self.on_inserted = on_inserted
+        self.max_batch = max_batch or INSERT_BUFFER_SIZE
+        self.max_wait = (INSERT_BUFFER_WAIT_MS if max_wait_ms is None else max_wait_ms) / 1000
+        self.write_concern = concern or write_concern()
+        self._pending = []
+        self._space = threading.BoundedSemaphore(max_pending or INSERT_BUFFER_MAX_PENDING)
+        self._condition = threading.Condition()
+        self._closed = False
+        self._thread = None
+
+    # Add one patient - returns a Future with its _id (or its error) when the group is saved
+    def submit(self, patient):
+        self._space.acquire()
+        future = Future()
+        with self._condition:
+            if self._closed:
+                self._space.release()
+                raise RuntimeError('Insert buffer is closed')
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='insert-buffer', daemon=True)
+                self._thread.start()
+            self._pending.append((patient, future, time.monotonic()))
+            self._condition.notify()
+        return future
+
+    # Add one patient and wait until it's saved - returns its _id, or raises its error
+    def insert(self, patient):
+        return self.submit(patient).result()
+
+    # Save everything that waits and stop the thread (called at exit)
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+
+    # Thread that takes groups from the buffer - a group is ready when it's full or its first patient waited long enough
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._closed:
+                    self._condition.wait()
+                if not self._pending:
+                    return
+                deadline = self._pending[0][2] + self.max_wait
+                while len(self._pending) < self.max_batch and not self._closed:
+                    left = deadline - time.monotonic()
+                    if left <= 0:
+                        break
+                    self._condition.wait(left)
+                batch = self._pending[:self.max_batch]
+                del self._pending[:self.max_batch]
+            try:
+                self._write(batch)
+            finally:
+                for _ in batch:
+                    self._space.release()
+
+    # One unordered insert_many for the group. Patients rejected by MongoDB get their own error,
+    # the others their _id (insert_many puts the _id into every patient before sending)
+    def _write(self, batch):
+        patients = [patient for patient, _, _ in batch]
+        errors = {}
+        concern_failed = False
+        try:
+            self.get_collection().with_options(write_concern=self.write_concern).insert_many(patients, ordered=False)
+        except BulkWriteError as e:
+            for error in e.details.get('writeErrors', []):
+                error_type = DuplicateKeyError if error.get('code') == DUPLICATE_KEY_ERROR else WriteError
+                errors[error['index']] = error_type(error.get('errmsg'), error.get('code'), error)
+            if e.details.get('writeConcernErrors'):
+                concern_failed = True
+                concern_error = e.details['writeConcernErrors'][0]
+                for position in range(len(batch)):
+                    errors.setdefault(position, WriteConcernError(concern_error.get('errmsg'), concern_error.get('code'), concern_error))
+        except Exception as e:
+            # Some patients may be saved anyway (for example the connection broke after MongoDB got the insert)
+            self._changed(None)
+            for _, future, _ in batch:
+                future.set_exception(e)
+            return
+
+        INSERT_BATCH_SIZE.observe(value=len(batch))
+        if concern_failed:
+            # Patients were written, only the write concern was not confirmed - they can be in the database
+            self._changed(None)
+        else:
+            inserted = [patient['_id'] for position, patient in enumerate(patients) if position not in errors]
+            if inserted:
+                self._changed(inserted)
+        for position, (patient, future, _) in enumerate(batch):
+            if position in errors:
+                future.set_exception(errors[position])
+            else:
+                future.set_result(patient['_id'])
+
+    def _changed(self, ids):
+        if self.on_inserted is None:
+            return
+        try:
+            self.on_inserted(ids)
+        except Exception as e:
+            print(f"Error after saving patients: {str(e)}")
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+# Buffer for the process, made the first time it's needed and saved out at exit
+def make_insert_buffer(get_collection, on_inserted=None):
+    global _buffer
+    with _buffer_lock:
+        if _buffer is None:
+            _buffer = InsertBuffer(get_collection, on_inserted)
+            atexit.register(_buffer.close)
+        return _buffer
@@ -38,27 +38,138 @@
 
 # Below in the code I will explain in short comments the functions
 
-from flask import Flask, render_template, request, redirect, url_for, flash, session
-from werkzeug.security import generate_password_hash, check_password_hash
+from flask import Flask, Blueprint, Response, stream_with_context, current_app, render_template, request, redirect, url_for, flash, session, jsonify
 import sqlite3
+import click
+import time
 from pymongo import MongoClient
+from pymongo.errors import DuplicateKeyError
 from bson.objectid import ObjectId
+from bson.errors import InvalidId
 import os
 from functools import wraps
 import pandas as pd
-from db_setup import get_db_connection, get_mongodb_connection, init_databases
+import numpy as np
+from db_setup import get_db_connection, close_db_connection, teardown_db_connection, get_mongodb_connection, get_pool_stats, init_databases
+from db_setup import PATIENT_SCHEMA
+from dataset_import import import_dataset, DEDUPE_FIELDS
+from risk_scoring import score_patients, set_risk_model
+from risk_model import load_risk_model, save_risk_model, train_risk_model, RISK_MODEL_PATH, TRAINING_CSV
+from db_operations import get_patients_page, patients_changed, rescore_patients, patient_filter, decode_page_cursor, PATIENT_SORTS
+from db_operations import insert_patient, check_patient_fields, bulk_delete_patients, bulk_update_patients, bulk_rescore_patients, bulk_edit_patients
+from pymongo.errors import PyMongoError
+from werkzeug.datastructures import MultiDict
+from analytics import get_dashboard
+from patient_validation import validate_patients
+import metrics
+from metrics import timed, HASH_TIME, render_metrics
+from import_jobs import submit_import, get_job_status, ImportQueueFull
+from password_hashing import hash_password, check_password, HashingBusy
+from session_store import SQLiteSessionInterface
+from page_cache import cached_page
+from patient_snapshot import get_snapshot, risk_statistics
+from patient_export import export_patients, csv_pieces, ndjson_pieces, EXPORT_FORMATS
 
-# start databased
-init_databases()
+# All pages of the app are in this blueprint, create_app() puts them into the Flask app
+main = Blueprint('main', __name__)
 
-# connection with mongoDB
-mongo_db = get_mongodb_connection()
-patients = mongo_db.patients
+# The most patients one page of the patient list can show
+MAX_PATIENTS_PAGE_SIZE = 500
 
+# connection with mongoDB - the client is made the first time a page needs patients,
+# so importing this file doesn't connect to any database
+def get_patients():
+   return get_mongodb_connection().patients
 
-# # I need this to keep user sessions secure
-app = Flask(__name__)
-app.secret_key = os.urandom(24)
+# Databases are set up with "flask --app main_app init-db" (or python db_setup.py), not every time the app starts.
+# Setup is safe to run many times, it only creates what is missing. If something can't be made
+# (for example the unique index when duplicate patients are saved), the command fails with exit code 1.
+@click.command('init-db')
+def init_db_command():
+   try:
+       init_databases()
+   except Exception as e:
+       raise click.ClickException(str(e))
+
+# After the risk rule in risk_scoring.py is changed, all saved patients are scored again with
+# "flask --app main_app rescore" - MongoDB does it in one update (rescore_patients in db_operations.py)
+@click.command('rescore')
+def rescore_command():
+   changed, seconds = rescore_patients(get_patients())
+   click.echo(f"Risk calculated again: {changed} patients changed in {seconds:.2f}s")
+
+# Snapshot of all patients as NumPy columns (patient_snapshot.py) - it's made the first time it's needed,
+# this command makes it straight away (for example after a big import, so the first reader doesn't wait)
+@click.command('snapshot')
+def snapshot_command():
+   started = time.perf_counter()
+   snapshot = get_snapshot(get_patients())
+   click.echo(f"Snapshot with {snapshot.rows} patients ready in {time.perf_counter() - started:.2f}s: {snapshot.path}")
+
+# Risk model trained on the dataset (risk_model.py) - "flask --app main_app train-model".
+# The app uses it after the next start, then "flask --app main_app rescore" scores saved patients with it
+@click.command('train-model')
+@click.option('--csv', 'csv_path', default=TRAINING_CSV, help='CSV file with the stroke column')
+@click.option('--output', default=RISK_MODEL_PATH, help='where to save the model (JSON)')
+@click.option('--l2', default=1.0, help='penalty for big weights')
+@click.option('--balanced/--not-balanced', default=True, help='give patients with stroke the same total weight')
+def train_model_command(csv_path, output, l2, balanced):
+   model = train_risk_model(csv_path, l2=l2, balanced=balanced)
+   save_risk_model(model, output)
+   click.echo(f"Model {model.version} trained in {model.artifact['training_seconds']:.3f}s, saved to {output}")
+   for name, results in model.artifact['test_results'].items():
+       click.echo(f"{name}: " + ', '.join(f"{key} {value}" for key, value in results.items()))
+
+# This builds the app (application factory). It doesn't touch the databases,
+# so a new worker process starts fast - the time it took is saved in STARTUP_SECONDS
+def create_app(config=None):
+   started = time.perf_counter()
+
+   # # I need this to keep user sessions secure
+   # The key must be the same in every worker process, otherwise a session made by one worker
+   # is refused by the others - so it comes from config or the SECRET_KEY environment variable.
+   # Without it a random key is made, that's fine only for one process (python main_app.py)
+   app = Flask(__name__)
+   app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY')
+   # cookie - session is in the signed cookie, sqlite - session is saved on the server (session_store.py)
+   app.config['SESSION_BACKEND'] = os.environ.get('SESSION_BACKEND', 'cookie')
+
+   # How many patients are shown on one page of the patient list
+   app.config['PATIENTS_PAGE_SIZE'] = int(os.environ.get('PATIENTS_PAGE_SIZE', 50))
+   # The most patients one bulk request can list by _id (with a filter there is no limit)
+   app.config['BULK_MAX_PATIENTS'] = int(os.environ.get('BULK_MAX_PATIENTS', 10000))
+   # The most patients one call of the prediction API can score
+   app.config['PREDICT_MAX_RECORDS'] = int(os.environ.get('PREDICT_MAX_RECORDS', 100000))
+   if config:
+       app.config.update(config)
+   if not app.config['SECRET_KEY']:
+       app.logger.warning('SECRET_KEY is not set, using a random key - sessions only work with one worker process')
+       app.config['SECRET_KEY'] = os.urandom(24)
+   if app.config['SESSION_BACKEND'] == 'sqlite':
+       app.session_interface = SQLiteSessionInterface()
+
+   # Trained risk model is read once here, without the file the rule in risk_scoring.py is used
+   app.config.setdefault('RISK_MODEL_PATH', RISK_MODEL_PATH)
+   model = load_risk_model(app.config['RISK_MODEL_PATH'])
+   set_risk_model(model)
+   app.config['RISK_MODEL_VERSION'] = model.version if model else None
+   app.logger.info('Risk model %s', f'version {model.version}' if model else 'not found, using the rule')
+
+   # SQLite connection opened during a request is closed when the request ends
+   app.teardown_appcontext(teardown_db_connection)
+
+   # Time of every request, MongoDB command, SQLite statement and template for /metrics
+   metrics.init_app(app)
+
+   app.register_blueprint(main)
+   app.cli.add_command(init_db_command)
+   app.cli.add_command(rescore_command)
+   app.cli.add_command(snapshot_command)
+   app.cli.add_command(train_model_command)
+
+   app.config['STARTUP_SECONDS'] = time.perf_counter() - started
+   app.logger.info('App created in %.1f ms', app.config['STARTUP_SECONDS'] * 1000)
+   return app
 
 # This is my security check - it makes sure nobody can register twice
 # App check both username and email 
@@ -68,7 +179,7 @@ def user_exists(username, email):
    cursor.execute("SELECT * FROM users WHERE name = ? AND email = ?", (username, email))
    result = cursor.fetchone()
    cursor.close()
-   conn.close()
+   close_db_connection(conn)
    return result is not None
 
 # This decorator is really useful as it checks if a user is logged in before displaying any pages, 
@@ -78,18 +189,29 @@ def login_required(f):
    def decorated_function(*args, **kwargs):
        if 'user_id' not in session:
            flash('Please login first')
-           return redirect(url_for('user_login'))
+           return redirect(url_for('main.user_login'))
+       return f(*args, **kwargs)
+   return decorated_function
+
+# The same check for API pages - instead of sending to the login page, they answer with an error in JSON
+def api_login_required(f):
+   @wraps(f)
+   def decorated_function(*args, **kwargs):
+       if 'user_id' not in session:
+           return jsonify({'error': 'Please login first'}), 401
        return f(*args, **kwargs)
    return decorated_function
 
 # Routes to the home page
-@app.route('/')
+@main.route('/')
 def home_page():
    return render_template('home_page.html')
 
 # Page where users log in
 # App check if their email exists and if their password is correct
-@app.route('/user_login', methods=['GET', 'POST'])
+# Password is checked in the hashing process pool (password_hashing.py), and if it was saved
+# with an old hashing method or cost, the new hash is saved now
+@main.route('/user_login', methods=['GET', 'POST'])
 def user_login():
    if request.method == 'POST':
        email = request.form['email']
@@ -97,24 +219,42 @@ def user_login():
        
        conn = get_db_connection()
        user = conn.execute('SELECT * FROM users WHERE email = ?', (email,)).fetchone()
-       conn.close()
        
-       if user and check_password_hash(user['password'], password):
+       try:
+           with timed(HASH_TIME, 'check', component='hashing'):
+               password_ok, new_hash = check_password(user['password'], password) if user is not None else (False, None)
+       except HashingBusy as e:
+           close_db_connection(conn)
+           flash(str(e))
+           return render_template('user_login.html'), 503
+       if new_hash:
+           conn.execute('UPDATE users SET password = ? WHERE id = ?', (new_hash, user['id']))
+           conn.commit()
+       close_db_connection(conn)
+       if password_ok:
+           # Server-side sessions get a new id, so an id from before the login can't be used (session fixation)
+           if hasattr(session, 'regenerate'):
+               session.regenerate()
            session['user_id'] = user['id']
            session['user_name'] = user['name']
            flash('Logged in successfully!')
-           return redirect(url_for('home_page'))
+           return redirect(url_for('main.home_page'))
        flash('Invalid email or password')
    return render_template('user_login.html')
 
 # This is apge where new users can make an account
 # App make sure to check if their email is already used and hash their password before saving it
-@app.route('/user_register', methods=['GET', 'POST'])
+@main.route('/user_register', methods=['GET', 'POST'])
 def user_register():
    if request.method == 'POST':
        name = request.form['name']
        email = request.form['email']
-       password = generate_password_hash(request.form['password'])
+       try:
+           with timed(HASH_TIME, 'generate', component='hashing'):
+               password = hash_password(request.form['password'])
+       except HashingBusy as e:
+           flash(str(e))
+           return render_template('user_register.html'), 503
        
        conn = get_db_connection()
        try:
@@ -122,22 +262,89 @@ def user_register():
                        (name, email, password))
            conn.commit()
            flash('Registration successful! Please login.')
-           return redirect(url_for('user_login'))
+           return redirect(url_for('main.user_login'))
        except sqlite3.IntegrityError:
            flash('Email already exists!')
        finally:
-           conn.close()
+           close_db_connection(conn)
    return render_template('user_register.html')
 
+# Filters of the patient list from the address, for example
+# /patients_list?smoking_status=smokes&age_min=60&risk_min=50&sort=risk_high
+# risk_min/risk_max are in % like in the table. Wrong values are ignored.
+# Returns (MongoDB query, sort name, filters used - to keep them in Next/Previous links)
+def list_filters_from_args(args):
+   used = {}
+   numbers = {}
+   for name, limit in [('risk_min', 100), ('risk_max', 100), ('age_min', 120), ('age_max', 120)]:
+       value = args.get(name, type=float)
+       if value is not None and 0 <= value <= limit:
+           used[name] = args[name]
+           numbers[name] = value / 100 if name.startswith('risk') else value
+
+   exact = {}
+   for name in ['smoking_status', 'gender', 'hypertension']:
+       allowed = PATIENT_SCHEMA['properties'][name]['enum']
+       value = args.get(name, type=int) if name == 'hypertension' else args.get(name)
+       if value in allowed:
+           used[name] = args[name]
+           exact[name] = value
+
+   sort = args.get('sort', 'newest')
+   if sort not in PATIENT_SORTS:
+       sort = 'newest'
+   elif sort != 'newest':
+       used['sort'] = sort
+   return patient_filter(**numbers, **exact), sort, used
+
 # Here is page with all patients
 # App sort them by ID in reverse so newest ones are at the top, It's easier for users to find patients they just added
-@app.route('/patients_list')
+# Patients can be filtered by risk, age, smoking, hypertension and gender, and sorted by risk or age -
+# MongoDB does it with indexes (see PATIENT_INDEXES in db_setup.py), so it's fast with many patients
+# The list is split into pages (PATIENTS_PAGE_SIZE patients on one page), Next/Previous links remember
+# where the page ended, so the page loads equally fast with 100 or 100 000 patients
+# Finished pages are cached until patients change (page_cache.py)
+@main.route('/patients_list')
 @login_required
+@cached_page('patients_list')
 def patients_list():
+   page_size = request.args.get('page_size', current_app.config['PATIENTS_PAGE_SIZE'], type=int)
+   page_size = max(1, min(page_size, MAX_PATIENTS_PAGE_SIZE))
+   query, sort, filters = list_filters_from_args(request.args)
 
-   # id sorted, new added on the top list
-   patient_list = list(patients.find().sort('_id', -1))
-   return render_template('patient_base.html', patients=patient_list)
+   after = request.args.get('after') or None
+   before = request.args.get('before') or None
+   try:
+       for cursor in (after, before):
+           if cursor is not None:
+               decode_page_cursor(cursor, sort)
+   except (InvalidId, ValueError):
+       after = before = None
+
+   page = get_patients_page(get_patients(), after=after, before=before, page_size=page_size, query=query, sort=sort)
+   return render_template('patient_base.html',
+                          patients=page['patients'],
+                          next_cursor=page['next_cursor'],
+                          prev_cursor=page['prev_cursor'],
+                          page_size=page_size,
+                          filters=filters)
+   
+# Export of patients for analytics: /export_patients?format=csv (or ndjson) with the same filters as the list.
+# The file is sent while MongoDB is read (patient_export.py), so memory stays the same for any number of patients
+@main.route('/export_patients')
+@login_required
+def export_patients_route():
+   export_format = request.args.get('format', 'csv')
+   if export_format not in EXPORT_FORMATS:
+       flash('Export format must be csv or ndjson', 'error')
+       return redirect(url_for('main.patients_list'))
+   query, sort, filters = list_filters_from_args(request.args)
+
+   patients = export_patients(get_patients(), query, sort)
+   pieces = csv_pieces(patients) if export_format == 'csv' else ndjson_pieces(patients)
+   mimetype, extension = EXPORT_FORMATS[export_format]
+   return Response(stream_with_context(pieces), mimetype=mimetype,
+                   headers={'Content-Disposition': f'attachment; filename=patients.{extension}'})
    
 # This function helps me load lots of patients directly from data folder a CSV file.
 # Because of this users can easily import their data
@@ -152,113 +359,26 @@ def patients_list():
 # Don't add the same patient twice
 # If one patient has bad data, others can still be added
 #
+# All checking and saving is done in dataset_import.py, column by column and in batches, so big files are fast
+# Only new and changed rows are saved - the same file twice does nothing
+#
 # This helps keep my database clean and my risk calculations accurate
-def import_dataset_data():
+def import_dataset_data(batch_size=None, progress=None):
    try:
        # patch to csv file
        csv_path = os.path.join(os.path.dirname(__file__), 'data', 'dataset.csv')
-       
-       # read CSV
-       df = pd.read_csv(csv_path)
-       
-       # count added patients
-       added_count = 0
-       
-       # check each row from CSV
-       for _, row in df.iterrows():
-           try:
-               # Check and fix all data before adding to patient_data:
-               
-               # Check gender - must be "Male" or "Female"
-               gender = str(row['gender']) if pd.notna(row['gender']) else "Unknown"
-               if gender not in ["Male", "Female"]:
-                   gender = "Unknown"
-               
-               # Check age - must be realistic
-               age = float(row['age']) if pd.notna(row['age']) else 0.0
-               if age < 0 or age > 120:
-                   age = 0.0
-               
-               # Check hypertension - must be 0 or 1
-               hypertension = int(row['hypertension']) if pd.notna(row['hypertension']) else 0
-               if hypertension not in [0, 1]:
-                   hypertension = 0
-                   
-               # Check marriage status
-               ever_married = str(row['ever_married']) if pd.notna(row['ever_married']) else "Unknown"
-               if ever_married not in ["Yes", "No"]:
-                   ever_married = "Unknown"
-                   
-               # Check work type
-               work_type = str(row['work_type']) if pd.notna(row['work_type']) else "Unknown"
-               if work_type not in ["Private", "Self-employed", "Govt_job", "children", "Never_worked"]:
-                   work_type = "Unknown"
-                   
-               # Check residence type
-               residence_type = str(row['Residence_type']) if pd.notna(row['Residence_type']) else "Unknown"
-               if residence_type not in ["Urban", "Rural"]:
-                   residence_type = "Unknown"
-                   
-               # Check glucose - must be realistic medical value
-               glucose = float(row['avg_glucose_level']) if pd.notna(row['avg_glucose_level']) else 0.0
-               if glucose < 0 or glucose > 500:  # normal values are between 0 and 500
-                   glucose = 0.0
-                   
-               # BMI check
-               bmi = float(row['bmi']) if pd.notna(row['bmi']) else 0.0
-               if bmi < 10:
-                   bmi = 25.0
-                   
-               # Check smoking status
-               smoking = str(row['smoking_status']) if pd.notna(row['smoking_status']) else "Unknown"
-               if smoking not in ["never smoked", "formerly smoked", "smokes", "Unknown"]:
-                   smoking = "Unknown"
-
-               # Create patient data with all checked values
-               patient_data = {
-                   'gender': gender,
-                   'age': age,
-                   'hypertension': hypertension,
-                   'ever_married': ever_married,
-                   'work_type': work_type,
-                   'residence_type': residence_type,
-                   'avg_glucose_level': glucose,
-                   'bmi': bmi,
-                   'smoking_status': smoking
-               }
-               
-               # Calculate risk factors
-               risk_factors = 0
-               if patient_data['hypertension'] == 1:
-                   risk_factors += 0.3
-               if patient_data['age'] > 60:
-                   risk_factors += 0.3
-               if patient_data['avg_glucose_level'] > 200:
-                   risk_factors += 0.2
-               if patient_data['smoking_status'] == 'smokes':
-                   risk_factors += 0.2
-                   
-               patient_data['stroke_risk'] = min(risk_factors, 1.0)
-               
-               # Check if patient already exists
-               existing_patient = patients.find_one({
-                   'gender': patient_data['gender'],
-                   'age': patient_data['age'],
-                   'hypertension': patient_data['hypertension'],
-                   'avg_glucose_level': patient_data['avg_glucose_level']
-               })
-               
-               # Add only new patients
-               if not existing_patient:
-                   patients.insert_one(patient_data)
-                   added_count += 1
-                   
-           except Exception as e:
-               print(f"Error processing record: {str(e)}")
-               continue
-           
-       return True, f"Successfully imported {added_count} new patient records"
-       
+
+       summary = import_dataset(get_patients(), csv_path, batch_size, progress)
+       if summary['mode'] == 'unchanged':
+           return True, "Dataset has not changed since the last import, nothing to do"
+       if summary['inserted'] or summary['updated']:
+           patients_changed()
+
+       return True, (f"Successfully imported {summary['inserted']} new and {summary['updated']} changed patient records "
+                     f"({summary['unchanged']} unchanged, {summary['skipped']} already in database, "
+                     f"{summary['failed']} with errors) "
+                     f"in {summary['seconds']:.2f}s - {summary['rows_per_sec']:.0f} rows/sec")
+
    except FileNotFoundError:
        return False, "No file"
    except pd.errors.EmptyDataError:
@@ -266,26 +386,35 @@ def import_dataset_data():
    except Exception as e:
        return False, f"Error data: {str(e)}"
 
-# This is the button that uses my import function. If something goes wrong, app show an error message
-@app.route('/import_dataset', methods=['GET'])
+# This is the button that uses my import function.
+# Import runs in background (import_jobs.py), so the page comes back straight away
+# and the patient list shows how the import is going. If something goes wrong, app show an error message
+@main.route('/import_dataset', methods=['POST'])
 @login_required
 def import_dataset_route():
-    success, message = import_dataset_data()
-    if success:
-        flash(message)
-    else:
-        flash(message, 'error')
-    return redirect(url_for('patients_list'))
+    try:
+        job = submit_import(import_dataset_data)
+    except ImportQueueFull as e:
+        flash(str(e), 'error')
+        return redirect(url_for('main.patients_list'))
+    session['import_job_id'] = job.id
+    flash('Import started, you can follow it below the buttons.')
+    return redirect(url_for('main.patients_list'))
+
+# Progress of one import: rows read, inserted, skipped, failed and rows per second
+@main.route('/import_status/<string:job_id>')
+@login_required
+def import_status(job_id):
+    status = get_job_status(job_id)
+    if status is None:
+        return jsonify({'error': 'Import job not found'}), 404
+    return jsonify(status)
 
 # # This is where app add new patients and check their stroke risk
-# I got these risk values from the American Stroke Association and CDC resources:
-# High blood pressure adds 0.3 to risk
-# Being over 60 adds 0.3
-# High glucose adds 0.2
-# Smoking adds 0.2
-# The most someone can get is 1.0 (100% risk)
-
-@app.route('/add_patient', methods=['GET', 'POST'])
+# The risk values (from the American Stroke Association and CDC resources) are in risk_scoring.py,
+# the same calculation is used here, in edit_patient and in the CSV import
+
+@main.route('/add_patient', methods=['GET', 'POST'])
 @login_required
 def add_patient_route():
     if request.method == 'POST':
@@ -301,20 +430,16 @@ def add_patient_route():
             'bmi': float(request.form['bmi']),
             'smoking_status': request.form['smoking_status']
         }
-        risk_factors = 0.0
-        if patient_data['hypertension'] == 1:
-            risk_factors += 0.3
-        if patient_data['age'] > 60:
-            risk_factors += 0.3
-        if patient_data['avg_glucose_level'] > 200:
-            risk_factors += 0.2
-        if patient_data['smoking_status'].lower() == 'smokes':
-            risk_factors += 0.2
-            
-        stroke_risk = float(min(risk_factors, 1.0))
+        stroke_risk = score_patients(patient_data)
         patient_data['stroke_risk'] = stroke_risk
         
-        patients.insert_one(patient_data)
+        # The unique index in MongoDB stops the same patient being added twice.
+        # insert_patient also tells the caches, and with INSERT_BUFFER=1 saves patients in groups
+        try:
+            insert_patient(patient_data)
+        except DuplicateKeyError:
+            flash('This patient is already in the database.')
+            return redirect(url_for('main.patients_list'))
         
         flash('Patient added successfully!')
         return render_template('patient_result.html', 
@@ -324,32 +449,115 @@ def add_patient_route():
                              glucose=patient_data['avg_glucose_level'],
                              smoking=patient_data['smoking_status'])
     
-    return redirect(url_for('patients_list'))
+    return redirect(url_for('main.patients_list'))
 
 # When someone clicks on a patient info button, this shows all their details
-
-@app.route('/patient_info/<string:patient_id>')
+# The page is cached until this patient changes (page_cache.py)
+@main.route('/patient_info/<string:patient_id>')
 @login_required
+@cached_page('patient_info', patient_id='patient_id')
 def patient_info(patient_id):
-    patient = patients.find_one({'_id': ObjectId(patient_id)})
+    patient = get_patients().find_one({'_id': ObjectId(patient_id)})
     if patient:
         return render_template('patient_info.html', patient=patient)
     flash('Patient not found!')
-    return redirect(url_for('patients_list'))
+    return redirect(url_for('main.patients_list'))
+# Risk prediction for many patients at once, nothing is saved to the database.
+# Other systems can send a JSON list of patients (or {"patients": [...]}) or a CSV file (form field "file").
+# Every patient is checked with the same rules MongoDB uses (patient_validation.py),
+# then all correct patients are scored together. Answer has risk or errors for every patient and how fast it was.
+@main.route('/api/predict', methods=['POST'])
+@api_login_required
+def predict_api():
+    started = time.perf_counter()
+    try:
+        if 'file' in request.files:
+            df = pd.read_csv(request.files['file']).rename(columns={'Residence_type': 'residence_type'})
+        else:
+            data = request.get_json(silent=True)
+            if isinstance(data, dict):
+                data = data.get('patients')
+            if not isinstance(data, list) or not all(isinstance(record, dict) for record in data):
+                return jsonify({'error': 'Send a list of patients as JSON or a CSV file'}), 400
+            df = pd.DataFrame.from_records(data)
+    except (pd.errors.EmptyDataError, pd.errors.ParserError, UnicodeDecodeError) as e:
+        return jsonify({'error': f'Could not read CSV file: {str(e)}'}), 400
+
+    max_records = current_app.config['PREDICT_MAX_RECORDS']
+    if len(df) > max_records:
+        return jsonify({'error': f'Too many patients, the limit is {max_records} in one request'}), 413
+
+    df, valid, errors = validate_patients(df)
+    risk = np.full(len(df), np.nan)
+    if valid.any():
+        risk[valid] = score_patients(df[valid])
+
+    results = [{'index': row, 'errors': errors[row]} if row in errors else {'index': row, 'stroke_risk': float(risk[row])}
+               for row in range(len(df))]
+    seconds = time.perf_counter() - started
+    return jsonify({
+        'count': len(df),
+        'valid': int(valid.sum()),
+        'invalid': len(errors),
+        'results': results,
+        'seconds': round(seconds, 6),
+        'records_per_sec': round(len(df) / seconds, 1) if seconds > 0 else 0.0,
+    })
+
+# Risk statistics for the whole patient base (mean, percentiles, distribution, by smoking, outdated risk).
+# Calculated from the columnar snapshot (patient_snapshot.py), so MongoDB only sends patients that changed
+@main.route('/api/risk_statistics')
+@api_login_required
+def risk_statistics_api():
+    started = time.perf_counter()
+    stats = risk_statistics(get_snapshot(get_patients()))
+    stats['seconds'] = round(time.perf_counter() - started, 6)
+    return jsonify(stats)
+
+# Dashboard with risk numbers for all patients - MongoDB calculates them (analytics.py),
+# and they are cached until patients change
+@main.route('/dashboard')
+@login_required
+def dashboard():
+    stats = get_dashboard(get_patients())
+    return render_template('dashboard.html', stats=stats)
+
+# The same as "flask rescore", but from the dashboard - all patients get risk from the current rule
+@main.route('/rescore_patients', methods=['POST'])
+@login_required
+def rescore_patients_route():
+    try:
+        changed, seconds = rescore_patients(get_patients())
+        flash(f'Risk calculated again: {changed} patients changed in {seconds:.2f}s')
+    except Exception as e:
+        flash(f'Error: {str(e)}', 'error')
+    return redirect(url_for('main.dashboard'))
+
+# Numbers for monitoring in Prometheus text format (metrics.py) - request times, database times, pool numbers
+@main.route('/metrics')
+def metrics_page():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+# Connection pool numbers for monitoring (MongoDB pool and SQLite connections)
+@main.route('/pool_stats')
+@login_required
+def pool_stats():
+    return jsonify(get_pool_stats())
+
 # This is how users log out. I use session.clear() to remove all their data
-@app.route('/logout')
+@main.route('/logout')
 def logout():
     session.clear()
     flash('Logged out successfully!')
-    return redirect(url_for('home_page'))
+    return redirect(url_for('main.home_page'))
 
-@app.route('/edit_patient/<string:patient_id>', methods=['GET', 'POST'])
+@main.route('/edit_patient/<string:patient_id>', methods=['GET', 'POST'])
 @login_required
 def edit_patient(patient_id):
-    patient = patients.find_one({'_id': ObjectId(patient_id)})
+    patient = get_patients().find_one({'_id': ObjectId(patient_id)})
     if not patient:
         flash('Patient not found!')
-        return redirect(url_for('patients_list'))
+        return redirect(url_for('main.patients_list'))
         
     if request.method == 'POST':
         try:
@@ -358,6 +566,7 @@ def edit_patient(patient_id):
                 'gender': request.form['gender'],
                 'age': float(request.form['age']),
                 'hypertension': int(request.form['hypertension']),
+                'heart_disease': int(request.form['heart_disease']),
                 'ever_married': request.form['ever_married'],
                 'work_type': request.form['work_type'],
                 'residence_type': request.form['residence_type'],
@@ -367,46 +576,157 @@ def edit_patient(patient_id):
             }
             
             # Risk Factor Calculator
-            risk_factors = 0.0
-            if updated_data['hypertension'] == 1:
-                risk_factors += 0.3
-            if updated_data['age'] > 60:
-                risk_factors += 0.3
-            if updated_data['avg_glucose_level'] > 200:
-                risk_factors += 0.2
-            if updated_data['smoking_status'].lower() == 'smokes':
-                risk_factors += 0.2
-                
-            updated_data['stroke_risk'] = min(risk_factors, 1.0)
+            updated_data['stroke_risk'] = score_patients(updated_data)
             
             # Update Patient infi in database
-            result = patients.update_one(
+            result = get_patients().update_one(
                 {'_id': ObjectId(patient_id)},
                 {'$set': updated_data}
             )
             
             if result.modified_count > 0:
+                patients_changed([ObjectId(patient_id)])
                 flash('Patient updated successfully!')
             else:
                 flash('No changes were made.')
                 
-            return redirect(url_for('patients_list'))
+            return redirect(url_for('main.patients_list'))
             
         except ValueError as e:
             flash('Invalid data format. Please check your inputs.')
+        except DuplicateKeyError:
+            flash('Another patient with the same data is already in the database.')
         except Exception as e:
             flash(f'Error updating patient: {str(e)}')
             
     return render_template('edit_patient.html', patient=patient)
 
-@app.route('/delete_patient/<string:patient_id>')
+@main.route('/delete_patient/<string:patient_id>')
 @login_required
 def delete_patient(patient_id):
-    patients.delete_one({'_id': ObjectId(patient_id)})
+    get_patients().delete_one({'_id': ObjectId(patient_id)})
+    patients_changed([ObjectId(patient_id)])
     flash('Patient deleted successfully!')
-    return redirect(url_for('patients_list'))
+    return redirect(url_for('main.patients_list'))
+
+# Patients for a bulk operation - a list of _ids, or all patients that match the list filters.
+# Returns (ids or None, query, error)
+def bulk_selection(ids, filters):
+    if ids is None:
+        query, _, _ = list_filters_from_args(filters)
+        return None, query, None
+    if len(ids) > current_app.config['BULK_MAX_PATIENTS']:
+        return None, None, f"Too many patients, the limit is {current_app.config['BULK_MAX_PATIENTS']} in one request"
+    try:
+        return [ObjectId(patient_id) for patient_id in ids], None, None
+    except (InvalidId, TypeError):
+        return None, None, 'Wrong patient id'
+
+# One bulk operation on the chosen patients: delete, update (the same fields for all) or rescore.
+# Returns counts from db_operations, errors are raised as ValueError.
+# Fields of the unique patient key (DEDUPE_FIELDS) can't get the same value on many patients - the second patient
+# would be a duplicate, and update_many stops there with only some patients changed. For ticked patients they are
+# sent as one change per patient (bulk_edit_patients, unordered), so every patient that can be changed is changed
+# and the duplicates come back in errors. For a filter it's not known which patients would be changed, so it's refused
+def run_bulk_action(action, ids, query, fields=None):
+    if action == 'delete':
+        return bulk_delete_patients(get_patients(), ids=ids, query=query)
+    if action == 'rescore':
+        return bulk_rescore_patients(get_patients(), ids=ids, query=query)
+    if action == 'update':
+        fields, errors = check_patient_fields(fields, partial=True)
+        if errors:
+            raise ValueError('; '.join(errors))
+        key_fields = [field for field in DEDUPE_FIELDS if field in fields]
+        if key_fields and query is not None:
+            raise ValueError(f"{', '.join(key_fields)} can't be set to the same value for all matching patients, "
+                             "they identify the patient - tick the patients to change instead")
+        if key_fields:
+            return bulk_edit_patients({patient_id: fields for patient_id in ids}, get_patients())
+        return bulk_update_patients(fields, get_patients(), ids=ids, query=query)
+    raise ValueError('Unknown action')
 
-@app.route('/edit_user', methods=['GET', 'POST'])
+# Bulk changes from the patient list: the ticked patients, or all patients matching the filters (scope=filter),
+# are deleted, get a new value of one field, or get their risk calculated again - one MongoDB command for all
+@main.route('/bulk_patients', methods=['POST'])
+@login_required
+def bulk_patients():
+    action = request.form.get('action')
+    _, _, filters = list_filters_from_args(request.form)
+    by_filter = request.form.get('scope') == 'filter'
+    ids, query, error = bulk_selection(None if by_filter else request.form.getlist('patient_ids'), request.form)
+    if not error and not by_filter and not ids:
+        error = 'No patients were selected.'
+    if not error and by_filter and action == 'delete' and not query:
+        error = 'Choose a filter before deleting all matching patients.'
+    if error:
+        flash(error)
+        return redirect(url_for('main.patients_list', **filters))
+
+    field = request.form.get('field')
+    try:
+        counts = run_bulk_action(action, ids, query, {field: request.form.get('value')} if field else {})
+    except (ValueError, PyMongoError) as e:
+        flash(f'Error: {str(e)}')
+        return redirect(url_for('main.patients_list', **filters))
+
+    if action == 'delete':
+        flash(f"{counts['deleted']} patients deleted in {counts['seconds']:.2f}s")
+    else:
+        flash(f"{counts['matched']} patients matched, {counts['modified']} changed in {counts['seconds']:.2f}s")
+        if counts.get('failed'):
+            flash(f"{counts['failed']} patients not changed, they would be the same as another patient")
+    return redirect(url_for('main.patients_list', **filters))
+
+# The same for other systems, in JSON:
+# {"action": "delete" | "update" | "rescore", "ids": [...] or "filter": {"smoking_status": "smokes", ...},
+#  "fields": {...} for update}
+# {"action": "edit", "patients": [{"_id": ..., fields to change}, ...]} - different fields for every patient,
+#  sent to MongoDB as one bulk_write
+# Answer has the counts (deleted, or matched and modified) and how long it took
+@main.route('/api/bulk_patients', methods=['POST'])
+@api_login_required
+def bulk_patients_api():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Send the bulk operation as a JSON object'}), 400
+    action = data.get('action')
+
+    try:
+        if action == 'edit':
+            patients = data.get('patients')
+            if not isinstance(patients, list) or not all(isinstance(patient, dict) for patient in patients):
+                return jsonify({'error': 'Send a list of patients with their _id'}), 400
+            # Without this a missing _id would become ObjectId(None), which is a new random id
+            if any(patient.get('_id') is None for patient in patients):
+                return jsonify({'error': 'Every patient needs its _id'}), 400
+            ids, _, error = bulk_selection([patient.get('_id') for patient in patients], None)
+            if error:
+                return jsonify({'error': error}), 400
+            changes = {}
+            for patient_id, patient in zip(ids, patients):
+                fields, errors = check_patient_fields(patient, partial=True)
+                if errors:
+                    return jsonify({'error': f'Patient {patient_id}: ' + '; '.join(errors)}), 400
+                changes[patient_id] = fields
+            counts = bulk_edit_patients(changes, get_patients())
+        else:
+            if 'ids' in data and not isinstance(data['ids'], list):
+                return jsonify({'error': 'ids must be a list'}), 400
+            by_filter = 'ids' not in data
+            ids, query, error = bulk_selection(data.get('ids'), MultiDict(data.get('filter') or {}))
+            if error:
+                return jsonify({'error': error}), 400
+            if by_filter and action == 'delete' and not query:
+                return jsonify({'error': 'Send ids or a filter to delete patients'}), 400
+            counts = run_bulk_action(action, ids, query, data.get('fields'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except PyMongoError as e:
+        return jsonify({'error': str(e)}), 500
+    return jsonify({'action': action, **counts})
+
+@main.route('/edit_user', methods=['GET', 'POST'])
 @login_required
 def edit_user():
     conn = get_db_connection()
@@ -418,22 +738,27 @@ def edit_user():
                      (name, email, session['user_id']))
         conn.commit()
         flash('User information updated successfully!')
-        return redirect(url_for('home_page'))
+        return redirect(url_for('main.home_page'))
     user = conn.execute('SELECT * FROM users WHERE id = ?', (session['user_id'],)).fetchone()
-    conn.close()
+    close_db_connection(conn)
     return render_template('edit_user.html', user=user)
 
-@app.route('/delete_user', methods=['POST'])
+@main.route('/delete_user', methods=['POST'])
 @login_required
 def delete_user():
     conn = get_db_connection()
     conn.execute('DELETE FROM users WHERE id = ?', (session['user_id'],))
     conn.commit()
-    conn.close()
+    close_db_connection(conn)
     session.clear()
     flash('Your account has been deleted.')
-    return redirect(url_for('home_page'))
+    return redirect(url_for('main.home_page'))
+
+# App used by tests and "flask --app main_app run" - making it doesn't connect to databases
+app = create_app()
 
 # This runs my app; (debug=True) - shows me errors when something goes wrong
+# When I run it myself I also set up databases first (safe, only creates what is missing)
 if __name__ == '__main__':
+    init_databases()
     app.run(debug=True)
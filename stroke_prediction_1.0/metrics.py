@@ -0,0 +1,232 @@
+# Measuring where the time goes in every request.
+# When a page is slow I want to know if it is MongoDB, SQLite, password hashing or making the HTML page.
+# This file has simple counters and histograms, and /metrics (main_app.py) shows them in Prometheus text format,
+# so they can be collected by Prometheus or just opened in a browser.
+#
+# What is measured:
+# every request - count by page and status, and how long it took
+# every MongoDB command - how long it took, by command and collection (MongoCommandTimer, used in db_setup.py)
+# every SQLite statement - how long it took (TimedConnection in db_setup.py)
+# password hashing and template rendering
+#
+# Slow request log (off by default): with SLOW_REQUEST_MS=500 every request slower than 500 ms
+# is written to the app log, together with time spent in MongoDB, SQLite, hashing and templates.
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+from flask import g, request, current_app, has_app_context, before_render_template, template_rendered
+from pymongo import monitoring
+
+# The same time ranges Prometheus uses by default (seconds)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+SLOW_REQUEST_MS = float(os.environ.get('SLOW_REQUEST_MS', 0))
+
+
+def _label_text(names, values):
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+# Number that only goes up (for example number of requests)
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_label_text(self.labels, label_values)} {value}')
+        return lines
+
+
+# How long things take - counts values in time ranges (buckets), plus sum and count
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, *label_values, value):
+        with self._lock:
+            counts, total, count = self._values.get(label_values, ([0] * len(self.buckets), 0.0, 0))
+            for position, limit in enumerate(self.buckets):
+                if value <= limit:
+                    counts[position] += 1
+            self._values[label_values] = (counts, total + value, count + 1)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for label_values, (counts, total, count) in sorted(self._values.items()):
+                for limit, bucket_count in zip(self.buckets, counts):
+                    labels = _label_text(self.labels + ('le',), label_values + (limit,))
+                    lines.append(f'{self.name}_bucket{labels} {bucket_count}')
+                labels = _label_text(self.labels + ('le',), label_values + ('+Inf',))
+                lines.append(f'{self.name}_bucket{labels} {count}')
+                lines.append(f'{self.name}_sum{_label_text(self.labels, label_values)} {total}')
+                lines.append(f'{self.name}_count{_label_text(self.labels, label_values)} {count}')
+        return lines
+
+
+# Number that goes up and down - read from a function when /metrics is opened
+class Gauge:
+    def __init__(self, name, help_text, read_values, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.read_values = read_values
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} gauge']
+        for label_values, value in sorted(self.read_values().items()):
+            lines.append(f'{self.name}{_label_text(self.labels, label_values)} {value}')
+        return lines
+
+
+_registry = []
+
+def register(metric):
+    _registry.append(metric)
+    return metric
+
+
+REQUESTS = register(Counter('http_requests_total', 'HTTP requests', ('method', 'endpoint', 'status')))
+REQUEST_TIME = register(Histogram('http_request_duration_seconds', 'Time to answer a request', ('method', 'endpoint')))
+SLOW_REQUESTS = register(Counter('http_slow_requests_total', 'Requests slower than SLOW_REQUEST_MS', ('endpoint',)))
+MONGO_TIME = register(Histogram('mongodb_command_duration_seconds', 'Time of MongoDB commands', ('command', 'collection')))
+MONGO_FAILURES = register(Counter('mongodb_command_failures_total', 'Failed MongoDB commands', ('command', 'collection')))
+SQLITE_TIME = register(Histogram('sqlite_statement_duration_seconds', 'Time of SQLite statements', ('statement',)))
+HASH_TIME = register(Histogram('password_hash_duration_seconds', 'Time of password hashing', ('operation',)))
+RENDER_TIME = register(Histogram('template_render_duration_seconds', 'Time to render a template', ('template',)))
+
+
+# Add time to the current request, so the slow request log can show where the time went
+def _add_request_time(component, seconds):
+    if has_app_context() and 'request_started' in g:
+        g.request_timings[component] = g.request_timings.get(component, 0.0) + seconds
+
+
+# Used with "with" - measures time of everything inside
+@contextmanager
+def timed(histogram, *label_values, component=None):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        histogram.observe(*label_values, value=seconds)
+        if component:
+            _add_request_time(component, seconds)
+
+
+def observe_sqlite(statement, seconds):
+    words = statement.split(None, 1)
+    SQLITE_TIME.observe(words[0].upper() if words else 'EMPTY', value=seconds)
+    _add_request_time('sqlite', seconds)
+
+
+# pymongo calls this for every command sent to MongoDB
+class MongoCommandTimer(monitoring.CommandListener):
+    def __init__(self):
+        self._collections = {}
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        with self._lock:
+            self._collections[(event.connection_id, event.request_id)] = collection if isinstance(collection, str) else ''
+
+    def _finish(self, event):
+        with self._lock:
+            return self._collections.pop((event.connection_id, event.request_id), '')
+
+    def succeeded(self, event):
+        seconds = event.duration_micros / 1000000
+        MONGO_TIME.observe(event.command_name, self._finish(event), value=seconds)
+        _add_request_time('mongodb', seconds)
+
+    def failed(self, event):
+        seconds = event.duration_micros / 1000000
+        collection = self._finish(event)
+        MONGO_TIME.observe(event.command_name, collection, value=seconds)
+        MONGO_FAILURES.inc(event.command_name, collection)
+        _add_request_time('mongodb', seconds)
+
+
+mongo_command_timer = MongoCommandTimer()
+
+
+# All metrics in Prometheus text format
+def render_metrics():
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def _before_request():
+    g.request_started = time.perf_counter()
+    g.request_timings = {}
+
+
+def _after_request(response):
+    if 'request_started' not in g:
+        return response
+    seconds = time.perf_counter() - g.request_started
+    endpoint = request.endpoint or 'unknown'
+    REQUESTS.inc(request.method, endpoint, response.status_code)
+    REQUEST_TIME.observe(request.method, endpoint, value=seconds)
+
+    slow_ms = g.get('slow_request_ms')
+    if slow_ms and seconds * 1000 >= slow_ms:
+        SLOW_REQUESTS.inc(endpoint)
+        parts = ', '.join(f'{name} {value * 1000:.1f} ms' for name, value in sorted(g.request_timings.items()))
+        current_app.logger.warning('Slow request %s %s: %.1f ms (%s)', request.method, request.path,
+                              seconds * 1000, parts or 'no database time')
+    return response
+
+
+def _render_started(sender, template, context, **extra):
+    g.render_started = time.perf_counter()
+
+
+def _render_finished(sender, template, context, **extra):
+    started = g.pop('render_started', None)
+    if started is not None:
+        seconds = time.perf_counter() - started
+        RENDER_TIME.observe(template.name or 'string', value=seconds)
+        _add_request_time('templates', seconds)
+
+
+# Connect measuring to the app (called from create_app)
+def init_app(app):
+    app.config.setdefault('SLOW_REQUEST_MS', SLOW_REQUEST_MS)
+
+    @app.before_request
+    def start_timing():
+        _before_request()
+        g.slow_request_ms = app.config['SLOW_REQUEST_MS']
+
+    app.after_request(_after_request)
+    before_render_template.connect(_render_started, app)
+    template_rendered.connect(_render_finished, app)
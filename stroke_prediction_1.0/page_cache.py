@@ -0,0 +1,225 @@
+# Cache for finished HTML of the patient list and patient info pages.
+# Most visits only read patients, but every visit asked MongoDB again and made the whole page again.
+# Now a page is made once and the same HTML is sent until patients change.
+#
+# Keys have version numbers: every change of patients (patients_changed in db_operations.py - add, edit,
+# delete, import, rescore) makes a new version, so old pages are never found again and are pushed out later.
+# Changed patients get a new version of their own info page, lists always get a new version.
+# Pages are saved for every user and address separately, and pages with messages (flash) are never saved.
+# Every changed patient keeps its own version, so when there are more than PAGE_CACHE_MAX_VERSIONS (default 100000)
+# they are all forgotten and "all" gets a new version instead - every key changes, so no old page is found.
+#
+# PAGE_CACHE_BACKEND - memory (default): LRU in this process, PAGE_CACHE_MAX_ENTRIES pages and PAGE_CACHE_MAX_BYTES at most
+#                      sqlite: shared by all worker processes on this machine (file PAGE_CACHE_SQLITE_PATH),
+#                      needed with several workers, otherwise one worker doesn't know that another changed patients
+#                      off: no caching
+
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import request, session, Response
+from db_operations import on_patients_changed
+from metrics import Counter, register
+
+PAGE_CACHE_BACKEND = os.environ.get('PAGE_CACHE_BACKEND', 'memory')
+PAGE_CACHE_MAX_ENTRIES = int(os.environ.get('PAGE_CACHE_MAX_ENTRIES', 1000))
+PAGE_CACHE_MAX_BYTES = int(os.environ.get('PAGE_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+PAGE_CACHE_SQLITE_PATH = os.environ.get('PAGE_CACHE_SQLITE_PATH', '../database/page_cache.db')
+PAGE_CACHE_MAX_VERSIONS = int(os.environ.get('PAGE_CACHE_MAX_VERSIONS', 100000))
+
+# Versions that are never forgotten
+MAIN_VERSIONS = ('all', 'lists')
+
+PAGE_CACHE_REQUESTS = register(Counter('page_cache_requests_total', 'Page cache hits and misses', ('page', 'result')))
+PAGE_CACHE_EVICTIONS = register(Counter('page_cache_evictions_total', 'Pages removed from the cache to make space'))
+
+
+# Least recently used cache in memory - when it's full, pages not used for the longest time are removed
+class LRUCache:
+    def __init__(self, max_entries, max_bytes, max_versions=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_versions = max_versions or PAGE_CACHE_MAX_VERSIONS
+        self._pages = OrderedDict()
+        self._bytes = 0
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            page = self._pages.get(key)
+            if page is not None:
+                self._pages.move_to_end(key)
+            return page
+
+    def set(self, key, page):
+        size = len(page)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._pages.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old)
+            self._pages[key] = page
+            self._bytes += size
+            while len(self._pages) > self.max_entries or self._bytes > self.max_bytes:
+                _, removed = self._pages.popitem(last=False)
+                self._bytes -= len(removed)
+                PAGE_CACHE_EVICTIONS.inc()
+
+    def version(self, name):
+        with self._lock:
+            return self._versions.get(name, 0)
+
+    def new_versions(self, names):
+        with self._lock:
+            for name in names:
+                self._versions[name] = self._versions.get(name, 0) + 1
+            if len(self._versions) > self.max_versions:
+                self._versions = {name: self._versions.get(name, 0) for name in MAIN_VERSIONS}
+                self._versions['all'] += 1
+                # No saved page can be found anymore
+                self._pages.clear()
+                self._bytes = 0
+
+    def clear(self):
+        with self._lock:
+            self._pages.clear()
+            self._bytes = 0
+
+
+# The same cache in a SQLite file, so all worker processes share pages and versions.
+# When it's too big, the pages saved longest ago are removed
+class SQLiteCache:
+    def __init__(self, path, max_entries, max_bytes, max_versions=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_versions = max_versions or PAGE_CACHE_MAX_VERSIONS
+        self._local = threading.local()
+
+    # One connection for every thread, made when the thread first needs it
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS pages (key TEXT PRIMARY KEY, page TEXT, size INTEGER, saved REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS pages_saved ON pages (saved)')
+            conn.execute('CREATE TABLE IF NOT EXISTS versions (name TEXT PRIMARY KEY, version INTEGER)')
+            conn.commit()
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        row = self._connection().execute('SELECT page FROM pages WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, page):
+        if len(page) > self.max_bytes:
+            return
+        conn = self._connection()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO pages (key, page, size, saved) VALUES (?, ?, ?, ?)',
+                         (key, page, len(page), time.time()))
+            count, total = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM pages').fetchone()
+            if count > self.max_entries or total > self.max_bytes:
+                # Remove the oldest tenth, so this doesn't run on every save
+                removed = conn.execute('DELETE FROM pages WHERE key IN (SELECT key FROM pages ORDER BY saved LIMIT ?)',
+                                       (max(1, count // 10, count - self.max_entries),)).rowcount
+                PAGE_CACHE_EVICTIONS.inc(amount=removed)
+
+    def version(self, name):
+        row = self._connection().execute('SELECT version FROM versions WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else 0
+
+    def new_versions(self, names):
+        conn = self._connection()
+        with conn:
+            conn.executemany('INSERT INTO versions (name, version) VALUES (?, 1) '
+                             'ON CONFLICT(name) DO UPDATE SET version = version + 1', [(name,) for name in names])
+            if conn.execute('SELECT COUNT(*) FROM versions').fetchone()[0] > self.max_versions:
+                conn.execute('DELETE FROM versions WHERE name NOT IN (?, ?)', MAIN_VERSIONS)
+                conn.execute("INSERT INTO versions (name, version) VALUES ('all', 1) "
+                             'ON CONFLICT(name) DO UPDATE SET version = version + 1')
+                conn.execute('DELETE FROM pages')
+
+    def clear(self):
+        conn = self._connection()
+        with conn:
+            conn.execute('DELETE FROM pages')
+
+
+def _make_cache(backend):
+    if backend == 'sqlite':
+        return SQLiteCache(PAGE_CACHE_SQLITE_PATH, PAGE_CACHE_MAX_ENTRIES, PAGE_CACHE_MAX_BYTES)
+    if backend == 'memory':
+        return LRUCache(PAGE_CACHE_MAX_ENTRIES, PAGE_CACHE_MAX_BYTES)
+    return None
+
+
+page_cache = _make_cache(PAGE_CACHE_BACKEND)
+
+
+# Change the cache (used by tests and benchmarks), None turns caching off
+def set_page_cache(cache):
+    global page_cache
+    page_cache = cache
+
+
+# Patients changed - lists get a new version, and so do info pages of the changed patients.
+# ids=None means it's not known which patients changed, so every page gets a new version
+def _patients_changed(ids):
+    if page_cache is None:
+        return
+    if ids is None:
+        page_cache.new_versions(['all'])
+    else:
+        page_cache.new_versions(['lists'] + [f'patient:{patient_id}' for patient_id in ids])
+
+on_patients_changed(_patients_changed)
+
+
+# Versions of all patients as text, for other caches that must know about changes made by any worker process
+# (the dashboard cache in analytics.py). None when caching is off
+def patient_versions():
+    if page_cache is None:
+        return None
+    return f"{page_cache.version('all')}.{page_cache.version('lists')}"
+
+
+def _page_key(page, patient_id):
+    versions = [page_cache.version('all')]
+    if patient_id is None:
+        versions.append(page_cache.version('lists'))
+    else:
+        versions.append(page_cache.version(f'patient:{patient_id}'))
+    # The page shows user name and the import status, so they are part of the key too
+    return '|'.join([page, '.'.join(map(str, versions)), str(session.get('user_id')),
+                     str(session.get('import_job_id')), request.full_path])
+
+
+# Decorator for GET pages that only show patients. patient_id - name of the view argument with the patient _id,
+# for pages of one patient. Only HTML made by render_template (text) is saved, redirects are not
+def cached_page(page, patient_id=None):
+    def decorator(view):
+        @wraps(view)
+        def decorated_function(*args, **kwargs):
+            if page_cache is None or request.method != 'GET' or session.get('_flashes'):
+                return view(*args, **kwargs)
+            key = _page_key(page, kwargs.get(patient_id) if patient_id else None)
+            html = page_cache.get(key)
+            if html is not None:
+                PAGE_CACHE_REQUESTS.inc(page, 'hit')
+                return Response(html, mimetype='text/html')
+            PAGE_CACHE_REQUESTS.inc(page, 'miss')
+            result = view(*args, **kwargs)
+            if isinstance(result, str) and not session.get('_flashes'):
+                page_cache.set(key, result)
+            return result
+        return decorated_function
+    return decorator
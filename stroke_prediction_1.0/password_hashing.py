@@ -0,0 +1,117 @@
+# Password hashing in a separate pool of processes.
+# Hashing is slow on purpose (so stolen hashes are hard to crack), but before it ran inside the request,
+# so when many people logged in at the same time every worker was busy hashing and pages waited.
+# Now hashing runs in a small process pool (it uses all CPU cores, the Python GIL doesn't stop it),
+# and the request thread only waits for the result.
+#
+# PASSWORD_HASH_METHOD - werkzeug method with its cost, default scrypt:32768:8:1 (werkzeug default),
+#                        for example pbkdf2:sha256:600000 is cheaper and scrypt:65536:8:1 is twice as expensive
+# PASSWORD_HASH_WORKERS - processes for hashing in every server worker, 0 - hash in the request thread.
+#                         Every gunicorn worker has its own pool, so the default is CPU cores divided by
+#                         WEB_CONCURRENCY (gunicorn's number of workers, 1 when not set) - together they use all cores once
+# PASSWORD_HASH_QUEUE_LIMIT - how many hashes can wait for the pool, more wait up to
+#                             PASSWORD_HASH_TIMEOUT seconds and then HashingBusy is raised (the page says try again)
+#
+# When somebody logs in and their saved hash was made with another method or cost, the password is hashed again
+# with the current one and saved (check_password returns the new hash), so changing the setting upgrades users slowly.
+
+import os
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from werkzeug.security import generate_password_hash, check_password_hash, DEFAULT_PBKDF2_ITERATIONS
+
+PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+WEB_CONCURRENCY = int(os.environ.get('WEB_CONCURRENCY', 1))
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', max(1, (os.cpu_count() or 1) // max(1, WEB_CONCURRENCY))))
+PASSWORD_HASH_QUEUE_LIMIT = int(os.environ.get('PASSWORD_HASH_QUEUE_LIMIT', 64))
+PASSWORD_HASH_TIMEOUT = float(os.environ.get('PASSWORD_HASH_TIMEOUT', 10))
+
+
+# Method with all cost numbers, the same as werkzeug writes at the start of the hash
+# ("scrypt" -> "scrypt:32768:8:1"), so it can be compared with saved hashes
+def full_method(method):
+    parts = method.split(':')
+    if parts[0] == 'scrypt':
+        defaults = ['scrypt', str(2 ** 15), '8', '1']
+    elif parts[0] == 'pbkdf2':
+        defaults = ['pbkdf2', 'sha256', str(DEFAULT_PBKDF2_ITERATIONS)]
+    else:
+        return method
+    return ':'.join(parts + defaults[len(parts):])
+
+
+_settings = {'method': full_method(PASSWORD_HASH_METHOD), 'workers': PASSWORD_HASH_WORKERS}
+_executor = None
+_executor_lock = threading.Lock()
+_waiting = threading.BoundedSemaphore(PASSWORD_HASH_QUEUE_LIMIT)
+
+
+class HashingBusy(Exception):
+    pass
+
+
+# Start of a werkzeug hash ("method$salt$hash") - method with all cost numbers
+def _hash_method(password_hash):
+    return password_hash.split('$', 1)[0]
+
+
+# Run in the pool - the functions must be on module level, so other processes can find them
+def _generate(password, method):
+    return generate_password_hash(password, method=method)
+
+
+def _check(password_hash, password, method):
+    if not check_password_hash(password_hash, password):
+        return False, None
+    if _hash_method(password_hash) != method:
+        return True, _generate(password, method)
+    return True, None
+
+
+# Change method or number of processes (used by benchmarks and tests), the old pool is closed
+def configure_hashing(method=None, workers=None):
+    global _executor
+    with _executor_lock:
+        if method is not None:
+            _settings['method'] = full_method(method)
+        if workers is not None:
+            _settings['workers'] = workers
+        old, _executor = _executor, None
+    if old is not None:
+        old.shutdown(wait=True)
+
+
+def current_method():
+    return _settings['method']
+
+
+# Pool is made the first time it's needed, so every server worker process gets its own.
+# spawn - forking a worker that already has threads (and MongoDB connections) is not safe
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=_settings['workers'], mp_context=multiprocessing.get_context('spawn'))
+        return _executor
+
+
+def _run(function, *args):
+    if _settings['workers'] <= 0:
+        return function(*args)
+    if not _waiting.acquire(timeout=PASSWORD_HASH_TIMEOUT):
+        raise HashingBusy('Too many logins at the same time, please try again')
+    try:
+        return _get_executor().submit(function, *args).result()
+    finally:
+        _waiting.release()
+
+
+def hash_password(password):
+    return _run(_generate, password, _settings['method'])
+
+
+# Returns (password is correct, new hash to save or None).
+# New hash is only made when the password is correct and the saved hash uses an old method or cost
+def check_password(password_hash, password):
+    return _run(_check, password_hash, password, _settings['method'])
@@ -0,0 +1,74 @@
+# Export of patients as CSV or NDJSON (one JSON patient on every line).
+# Before, the only way to get the data out was the patient list page, and that is not made for it.
+# The export is sent while it is read from MongoDB: the cursor gets EXPORT_BATCH_SIZE patients at a time,
+# they are written as text and sent, and then the next batch is read. So the first bytes go out straight away
+# and the worker never keeps more than one batch in memory, even with a million patients.
+#
+# The same filters and sorts as the patient list can be used (list_filters_from_args in main_app.py).
+
+import os
+import io
+import csv
+import json
+from db_operations import PATIENT_SORTS
+
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 1000))
+
+# Columns of the export, in this order
+EXPORT_FIELDS = ['_id', 'gender', 'age', 'hypertension', 'heart_disease', 'ever_married', 'work_type',
+                 'residence_type', 'avg_glucose_level', 'bmi', 'smoking_status', 'stroke_risk']
+
+# How the export is sent to the browser - content type and file name ending
+EXPORT_FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+}
+
+
+# Patients one by one, MongoDB sends them in batches
+def export_patients(collection, query=None, sort='newest', batch_size=None):
+    projection = {field: 1 for field in EXPORT_FIELDS}
+    cursor = collection.find(query or {}, projection).sort(PATIENT_SORTS[sort]).batch_size(batch_size or EXPORT_BATCH_SIZE)
+    try:
+        for patient in cursor:
+            patient['_id'] = str(patient['_id'])
+            yield patient
+    finally:
+        cursor.close()
+
+
+# Text of the export in pieces - one piece for every batch_size patients.
+# start(buffer) writes the beginning of the file and returns the function that writes one patient
+def _in_pieces(patients, start, batch_size):
+    batch_size = batch_size or EXPORT_BATCH_SIZE
+    buffer = io.StringIO()
+    write_patient = start(buffer)
+    count = 0
+    for patient in patients:
+        write_patient(patient)
+        count += 1
+        if count % batch_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def csv_pieces(patients, batch_size=None):
+    def start(buffer):
+        writer = csv.DictWriter(buffer, EXPORT_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        return writer.writerow
+
+    return _in_pieces(patients, start, batch_size)
+
+
+def ndjson_pieces(patients, batch_size=None):
+    def start(buffer):
+        def write_patient(patient):
+            buffer.write(json.dumps(patient, default=str))
+            buffer.write('\n')
+        return write_patient
+
+    return _in_pieces(patients, start, batch_size)
@@ -0,0 +1,313 @@
+# Snapshot of all patients as columns in NumPy files, for analytics over the whole patient base.
+# Reading every patient from MongoDB as a Python dict is slow and needs a lot of memory, so the patients
+# are saved once as one .npy file per column (age, stroke_risk, ...) plus meta.json. The files are opened
+# with memory mapping, so reading them costs almost nothing and many processes share the same memory.
+#
+# Text columns (gender, smoking_status, ...) are saved as small numbers (codes), the texts are in meta.json.
+# Numbers that are missing are NaN, missing codes and yes/no values are -1.
+#
+# The snapshot is refreshed only when somebody reads it (get_snapshot):
+# - patients_changed(ids) writes the changed _ids to a small file, so every worker process knows about them,
+#   and the next read only takes these patients from MongoDB and puts them into the columns
+# - patients_changed() without ids (import, rescore) means the whole snapshot is made again
+# - changes made while the whole snapshot is being made (building.json) are kept too and put into it
+#   as soon as it is switched in, because the build may have read these patients before they changed
+# Every new snapshot is written to a new folder and then current.json is switched to it, so a reader never
+# sees half-written files. Only one process at a time refreshes the snapshot (lock file snapshot.lock).
+#
+# SNAPSHOT_DIR - folder for the snapshot (default ../database/snapshot)
+
+import os
+import json
+import time
+import shutil
+import threading
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+from bson.objectid import ObjectId
+from db_operations import on_patients_changed
+from risk_scoring import score_patients
+from analytics import RISK_BUCKETS, HIGH_RISK
+
+try:
+    import fcntl
+except ImportError:
+    # No fcntl on Windows - there the app runs as one process (flask run), so the thread lock is enough
+    fcntl = None
+
+SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR', '../database/snapshot')
+SNAPSHOT_BATCH_SIZE = int(os.environ.get('SNAPSHOT_BATCH_SIZE', 100000))
+
+# Columns and their types - float columns use NaN for missing values, int8 columns use -1
+NUMBER_COLUMNS = {
+    'age': 'float64',
+    'avg_glucose_level': 'float64',
+    'bmi': 'float64',
+    'stroke_risk': 'float64',
+    'hypertension': 'int8',
+    'heart_disease': 'int8',
+}
+TEXT_COLUMNS = ['gender', 'ever_married', 'work_type', 'residence_type', 'smoking_status']
+
+CURRENT_FILE = 'current.json'
+CHANGES_FILE = 'changes.txt'
+# Exists while the whole snapshot is being made, has the time the build started
+BUILD_FILE = 'building.json'
+# Written to the changes file when it is not known which patients changed
+ALL_PATIENTS = '*'
+LOCK_FILE = 'snapshot.lock'
+
+_lock = threading.Lock()
+_loaded = None
+
+
+# One snapshot - columns are memory mapped NumPy arrays (read only)
+class Snapshot:
+    def __init__(self, path, meta, columns):
+        self.path = path
+        self.meta = meta
+        self.columns = columns
+        self.rows = meta['rows']
+
+    # Codes for text columns, numbers for the others
+    def column(self, name):
+        return self.columns[name]
+
+    def categories(self, name):
+        return self.meta['categories'][name]
+
+    # Columns as a DataFrame - number columns are not copied, text columns become categories
+    def frame(self, names=None):
+        data = {}
+        for name in names or list(NUMBER_COLUMNS) + TEXT_COLUMNS:
+            if name in TEXT_COLUMNS:
+                data[name] = pd.Categorical.from_codes(self.columns[name], self.categories(name))
+            else:
+                data[name] = self.columns[name]
+        return pd.DataFrame(data, copy=False)
+
+
+# Patients from MongoDB (dicts) into arrays. categories are lists of texts for every text column,
+# new texts are added at the end, so codes already saved keep their meaning
+def _to_arrays(patients, categories):
+    arrays = {'_id': np.array([patient['_id'].binary for patient in patients], dtype='S12')}
+    for name, dtype in NUMBER_COLUMNS.items():
+        values = pd.to_numeric(pd.Series([patient.get(name) for patient in patients], dtype=object), errors='coerce')
+        if dtype == 'int8':
+            arrays[name] = np.array(values.fillna(-1), dtype=np.int8)
+        else:
+            arrays[name] = np.array(values, dtype=np.float64)
+    for name in TEXT_COLUMNS:
+        values = pd.Series([patient.get(name) for patient in patients], dtype=object)
+        new = [value for value in pd.unique(values.dropna()) if value not in categories[name]]
+        categories[name].extend(str(value) for value in new)
+        arrays[name] = pd.Index(categories[name]).get_indexer(values.astype(object)).astype(np.int16)
+    return arrays
+
+
+def _projection():
+    return {name: 1 for name in list(NUMBER_COLUMNS) + TEXT_COLUMNS}
+
+
+# Save arrays into a new folder and make it the current snapshot
+def _write_snapshot(arrays, categories):
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    name = f'snapshot-{time.time_ns()}-{os.getpid()}'
+    path = os.path.join(SNAPSHOT_DIR, name)
+    os.makedirs(path)
+    for column, values in arrays.items():
+        np.save(os.path.join(path, f'{column}.npy'), values)
+    meta = {'rows': len(arrays['_id']), 'created': time.time(), 'categories': categories,
+            'types': {column: str(values.dtype) for column, values in arrays.items()}}
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    current = os.path.join(SNAPSHOT_DIR, CURRENT_FILE)
+    with open(current + f'.{os.getpid()}', 'w') as f:
+        json.dump({'folder': name}, f)
+    os.replace(current + f'.{os.getpid()}', current)
+    _remove_old_snapshots(keep=name)
+    return _open_snapshot(name)
+
+
+# Older folders are removed - but the previous one stays, somebody may still be reading it
+def _remove_old_snapshots(keep):
+    folders = sorted(folder for folder in os.listdir(SNAPSHOT_DIR)
+                     if folder.startswith('snapshot-') and folder != keep)
+    for folder in folders[:-1]:
+        shutil.rmtree(os.path.join(SNAPSHOT_DIR, folder), ignore_errors=True)
+
+
+def _open_snapshot(name):
+    path = os.path.join(SNAPSHOT_DIR, name)
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    columns = {column: np.load(os.path.join(path, f'{column}.npy'), mmap_mode='r') for column in meta['types']}
+    return Snapshot(path, meta, columns)
+
+
+# Current snapshot from disk (the one already open if it didn't change), None when there is none yet
+def load_snapshot():
+    global _loaded
+    try:
+        with open(os.path.join(SNAPSHOT_DIR, CURRENT_FILE)) as f:
+            name = json.load(f)['folder']
+    except (FileNotFoundError, ValueError):
+        return None
+    if _loaded is None or os.path.basename(_loaded.path) != name:
+        _loaded = _open_snapshot(name)
+    return _loaded
+
+
+# The whole snapshot from MongoDB, read in batches sorted by _id
+def build_snapshot(collection):
+    categories = {name: [] for name in TEXT_COLUMNS}
+    parts = []
+    batch = []
+    for patient in collection.find({}, _projection()).sort('_id', 1).batch_size(SNAPSHOT_BATCH_SIZE):
+        batch.append(patient)
+        if len(batch) >= SNAPSHOT_BATCH_SIZE:
+            parts.append(_to_arrays(batch, categories))
+            batch = []
+    if batch or not parts:
+        parts.append(_to_arrays(batch, categories))
+    arrays = {column: np.concatenate([part[column] for part in parts]) for column in parts[0]}
+    return _write_snapshot(arrays, categories)
+
+
+# Only changed patients are read from MongoDB: their old rows are removed and the new ones added
+# (deleted patients are not found anymore, so they are just removed)
+def _apply_changes(snapshot, collection, ids):
+    categories = {name: list(values) for name, values in snapshot.meta['categories'].items()}
+    object_ids = [ObjectId(patient_id) for patient_id in ids]
+    patients = []
+    for start in range(0, len(object_ids), 10000):
+        patients.extend(collection.find({'_id': {'$in': object_ids[start:start + 10000]}}, _projection()))
+
+    changed = np.array(sorted(patient_id.binary for patient_id in object_ids), dtype='S12')
+    keep = ~np.isin(snapshot.column('_id'), changed)
+    new = _to_arrays(patients, categories)
+    arrays = {column: np.concatenate([snapshot.column(column)[keep], new[column]]) for column in new}
+    order = np.argsort(arrays['_id'], kind='stable')
+    arrays = {column: values[order] for column, values in arrays.items()}
+    return _write_snapshot(arrays, categories)
+
+
+# Remember changed patients in the changes file (every worker process writes to the same file).
+# Without a snapshot and without a build in progress there is nothing to keep up to date
+def _remember_changes(ids):
+    if not any(os.path.exists(os.path.join(SNAPSHOT_DIR, name)) for name in (CURRENT_FILE, BUILD_FILE)):
+        return
+    lines = [ALL_PATIENTS] if ids is None else [str(patient_id) for patient_id in ids]
+    with open(os.path.join(SNAPSHOT_DIR, CHANGES_FILE), 'a') as f:
+        f.write(''.join(line + '\n' for line in lines))
+
+on_patients_changed(_remember_changes)
+
+
+# Take the changes file away (renamed first, so new changes go to a new file) - returns (everything changed, ids)
+def _take_changes():
+    path = os.path.join(SNAPSHOT_DIR, CHANGES_FILE)
+    taken = f'{path}.{os.getpid()}.{threading.get_ident()}'
+    try:
+        os.replace(path, taken)
+    except FileNotFoundError:
+        return False, set()
+    with open(taken) as f:
+        lines = {line.strip() for line in f if line.strip()}
+    os.remove(taken)
+    return ALL_PATIENTS in lines, lines - {ALL_PATIENTS}
+
+
+def _put_back_changes(everything, ids):
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    with open(os.path.join(SNAPSHOT_DIR, CHANGES_FILE), 'a') as f:
+        f.write(''.join(line + '\n' for line in ([ALL_PATIENTS] if everything else []) + sorted(ids)))
+
+
+# One thread of one worker process refreshes the snapshot at a time. Without it two processes could take
+# different changes, and the one that switches current.json last would drop the patients the other one added
+@contextmanager
+def _refresh_lock():
+    with _lock:
+        if fcntl is None:
+            yield
+            return
+        os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+        with open(os.path.join(SNAPSHOT_DIR, LOCK_FILE), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+# The whole snapshot again. Patients changed since the build started are put in right after it's switched in -
+# when everything changed again (an import during the build), the changes stay for the next read
+def _build_and_replay(collection):
+    path = os.path.join(SNAPSHOT_DIR, BUILD_FILE)
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({'started': time.time()}, f)
+    try:
+        snapshot = build_snapshot(collection)
+    finally:
+        os.remove(path)
+    everything, ids = _take_changes()
+    try:
+        if everything:
+            _put_back_changes(everything, ids)
+        elif ids:
+            snapshot = _apply_changes(snapshot, collection, ids)
+    except Exception:
+        _put_back_changes(everything, ids)
+        raise
+    return snapshot
+
+
+# Snapshot that is up to date with MongoDB - made the first time, then refreshed with changes since last time
+def get_snapshot(collection):
+    with _refresh_lock():
+        everything, ids = _take_changes()
+        try:
+            snapshot = load_snapshot()
+            if snapshot is None or everything:
+                return _build_and_replay(collection)
+            if ids:
+                return _apply_changes(snapshot, collection, ids)
+            return snapshot
+        except Exception:
+            _put_back_changes(everything, ids)
+            raise
+
+
+# Risk numbers for all patients, calculated from the snapshot arrays without asking MongoDB
+def risk_statistics(snapshot):
+    risk = np.asarray(snapshot.column('stroke_risk'))
+    known = ~np.isnan(risk)
+    values = risk[known]
+    counts, _ = np.histogram(values, bins=RISK_BUCKETS)
+
+    stats = {
+        'patients': snapshot.rows,
+        'with_risk': int(known.sum()),
+        'mean': float(values.mean()) if len(values) else 0.0,
+        'percentiles': {f'p{q}': float(np.percentile(values, q)) if len(values) else 0.0 for q in (50, 90, 99)},
+        'high_risk': int((values >= HIGH_RISK).sum()),
+        'distribution': [{'from': RISK_BUCKETS[i], 'to': min(RISK_BUCKETS[i + 1], 1.0), 'patients': int(count)}
+                         for i, count in enumerate(counts)],
+    }
+
+    # Average risk for every smoking status - bincount adds risk of all patients with the same code
+    codes = np.asarray(snapshot.column('smoking_status'))[known]
+    names = snapshot.categories('smoking_status')
+    totals = np.bincount(codes + 1, weights=values, minlength=len(names) + 1)
+    patients = np.bincount(codes + 1, minlength=len(names) + 1)
+    stats['by_smoking_status'] = {(['Missing'] + names)[i]: {'patients': int(patients[i]), 'avg_risk': float(totals[i] / patients[i])}
+                                  for i in range(len(patients)) if patients[i]}
+
+    # Patients whose saved risk is not what the current rule or model gives (they need "flask rescore")
+    current = score_patients(snapshot.frame())
+    stats['outdated_risk'] = int((known & (current != risk)).sum())
+    return stats
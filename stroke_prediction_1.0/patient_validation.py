@@ -0,0 +1,71 @@
+# Checking many patients at once with the same rules that MongoDB uses (PATIENT_SCHEMA in db_setup.py).
+# I use it in the prediction API, where patients are scored but not saved, so MongoDB can't check them for me.
+# Every rule is checked for the whole column at once, Python only goes through patients that have errors.
+
+import numpy as np
+import pandas as pd
+from db_setup import PATIENT_SCHEMA
+
+NUMBER_TYPES = {'double', 'int'}
+
+
+# True for every value that is text
+def _is_text(column):
+    if pd.api.types.is_string_dtype(column) and not pd.api.types.is_object_dtype(column):
+        return column.notna()
+    return column.map(lambda value: isinstance(value, str)).astype(bool)
+
+
+# Check all patients (DataFrame, one row = one patient) against the schema.
+# Returns:
+# patients - the same data, numbers changed from text where needed
+# valid - True/False for every patient
+# errors - {row number: [error messages]} only for patients with errors
+def validate_patients(df, schema=PATIENT_SCHEMA):
+    df = df.copy()
+    count = len(df)
+    problems = []
+
+    for field in schema.get('required', []):
+        if field not in df.columns:
+            problems.append((np.ones(count, dtype=bool), f"{field} is required"))
+        else:
+            problems.append((df[field].isna().to_numpy(), f"{field} is required"))
+
+    for field, rules in schema.get('properties', {}).items():
+        if field not in df.columns:
+            continue
+        column = df[field]
+        present = column.notna()
+        types = rules['bsonType'] if isinstance(rules['bsonType'], list) else [rules['bsonType']]
+
+        if set(types) <= NUMBER_TYPES:
+            numbers = pd.to_numeric(column, errors='coerce')
+            not_number = present & (numbers.isna() | (_is_text(column) if column.dtype == object else False))
+            problems.append((not_number.to_numpy(), f"{field} must be a number"))
+            if types == ['int']:
+                not_whole = present & numbers.notna() & (numbers % 1 != 0)
+                problems.append((not_whole.to_numpy(), f"{field} must be a whole number"))
+            if 'minimum' in rules:
+                problems.append(((numbers < rules['minimum']).to_numpy(), f"{field} must be at least {rules['minimum']}"))
+            if 'maximum' in rules:
+                problems.append(((numbers > rules['maximum']).to_numpy(), f"{field} must be at most {rules['maximum']}"))
+            df[field] = numbers
+        else:
+            not_text = present & ~_is_text(column)
+            problems.append((not_text.to_numpy(), f"{field} must be text"))
+
+        if 'enum' in rules:
+            not_allowed = present & ~df[field].isin(rules['enum'])
+            allowed = ', '.join(str(value) for value in rules['enum'])
+            problems.append((not_allowed.to_numpy(), f"{field} must be one of: {allowed}"))
+
+    invalid = np.zeros(count, dtype=bool)
+    errors = {}
+    for mask, message in problems:
+        mask = np.asarray(mask, dtype=bool)
+        invalid |= mask
+        for row in np.flatnonzero(mask):
+            errors.setdefault(int(row), []).append(message)
+
+    return df, ~invalid, errors
@@ -0,0 +1,270 @@
+# Stroke risk from a logistic regression model trained on data/data.csv.xls (only NumPy, no ML library).
+# The rule in risk_scoring.py only looks at hypertension, age, glucose and smoking with fixed thresholds,
+# the model also uses heart disease, BMI, gender, marriage, work and residence, and its weights come from
+# the "stroke" column of the dataset.
+#
+# Training: flask --app main_app train-model (writes models/risk_model.json)
+# The file is small JSON with the weights, a version (time of training) and test results of the model and the rule.
+# create_app() loads it once (RISK_MODEL_PATH) and gives it to risk_scoring.py - from then on score_patients()
+# uses the model everywhere (add/edit patient, import, API). Without the file the old rule is used.
+#
+# Patients are scored the same way as the rule: whole columns at once for many patients, and a short
+# Python loop for one patient (a few microseconds). The model can also be written as a MongoDB expression,
+# so "flask rescore" scores saved patients inside MongoDB.
+#
+# Stroke is rare in the dataset (about 5% of patients), so by default both classes get the same total weight
+# when training. Risk is then spread between 0 and 1 like with the rule (0.5 and more is high risk),
+# but it's a risk score, not the real chance of a stroke.
+
+import os
+import json
+import math
+import time
+import numpy as np
+import pandas as pd
+from dataset_import import clean_dataset
+from risk_scoring import risk_from_arrays
+
+# Format of the JSON file - a file with another format is refused
+MODEL_FORMAT = 1
+RISK_MODEL_PATH = os.environ.get('RISK_MODEL_PATH', 'models/risk_model.json')
+TRAINING_CSV = 'data/data.csv.xls'
+LABEL_COLUMN = 'stroke'
+
+# Features: numbers are standardized (missing - average from training), flags are 1 or 0,
+# text columns get one feature for every value seen in training (compared without big/small letters)
+NUMBER_FEATURES = ['age', 'avg_glucose_level', 'bmi']
+FLAG_FEATURES = ['hypertension', 'heart_disease']
+TEXT_FEATURES = ['gender', 'ever_married', 'work_type', 'residence_type', 'smoking_status']
+
+# Saved risk is rounded, so Python and MongoDB give the same number
+RISK_DECIMALS = 6
+
+
+def _sigmoid(z):
+    return 1.0 / (1.0 + np.exp(-z))
+
+
+# Column from a DataFrame or dict of columns, missing columns are all NaN
+def _column(data, name, size):
+    if name in data:
+        return data[name]
+    return np.full(size, np.nan)
+
+
+# Numbers as a float array, text that isn't a number becomes NaN (number columns are not converted at all)
+def _numbers(values):
+    if pd.api.types.is_numeric_dtype(getattr(values, 'dtype', None)) and not isinstance(values.dtype, pd.CategoricalDtype):
+        return np.asarray(values, dtype=float)
+    return pd.to_numeric(pd.Series(values, dtype=object), errors='coerce').to_numpy(dtype=float)
+
+
+# Text column as codes and lower-cased values. Only the different values (a few) are lower-cased, not every row
+def _texts(values):
+    codes, uniques = pd.factorize(values if isinstance(values, pd.Series) else pd.Series(values, dtype=object),
+                                  use_na_sentinel=True)
+    return codes, np.array([str(value).lower() for value in uniques] + [None], dtype=object)
+
+
+class RiskModel:
+    # artifact - dict from the JSON file
+    def __init__(self, artifact):
+        if artifact.get('format') != MODEL_FORMAT:
+            raise ValueError(f"Risk model format {artifact.get('format')} is not supported (expected {MODEL_FORMAT})")
+        self.artifact = artifact
+        self.version = artifact['version']
+        self.intercept = artifact['intercept']
+        self.terms = artifact['terms']
+        self.fields = list(dict.fromkeys(term['column'] for term in self.terms))
+
+    # Every term for all patients as a float array. Text columns are read once, for all their values
+    def _values(self, data):
+        size = len(data) if isinstance(data, pd.DataFrame) else len(next(iter(data.values())))
+        texts = {}
+        for term in self.terms:
+            column = _column(data, term['column'], size)
+            if term['kind'] == 'number':
+                values = (_numbers(column) - term['mean']) / term['scale']
+                yield np.where(np.isnan(values), 0.0, values)
+            elif term['kind'] == 'flag':
+                yield (_numbers(column) == 1).astype(float)
+            else:
+                if term['column'] not in texts:
+                    texts[term['column']] = _texts(column)
+                codes, lowered = texts[term['column']]
+                yield (lowered == term['value'])[codes].astype(float)
+
+    # Design matrix - one column for every term (used for training)
+    def matrix(self, data):
+        return np.column_stack(list(self._values(data)))
+
+    # Risk for many patients (DataFrame or dict of columns). Terms are added one by one in the same
+    # order as in score_one and expression, so all of them give the same numbers
+    def score(self, data):
+        z = None
+        for term, values in zip(self.terms, self._values(data)):
+            if z is None:
+                z = np.full(len(values), float(self.intercept))
+            z += term['weight'] * values
+        return np.round(_sigmoid(z), RISK_DECIMALS)
+
+    # Risk for one patient (dict) without pandas - this is what add/edit patient pages use
+    def score_one(self, patient):
+        z = float(self.intercept)
+        for term in self.terms:
+            value = patient.get(term['column'])
+            if term['kind'] == 'number':
+                try:
+                    x = (float(value) - term['mean']) / term['scale']
+                except (TypeError, ValueError):
+                    x = 0.0
+                x = 0.0 if x != x else x
+            elif term['kind'] == 'flag':
+                try:
+                    x = 1.0 if float(value) == 1 else 0.0
+                except (TypeError, ValueError):
+                    x = 0.0
+            else:
+                x = 1.0 if value is not None and str(value).lower() == term['value'] else 0.0
+            z += term['weight'] * x
+        return round(1.0 / (1.0 + math.exp(-z)), RISK_DECIMALS)
+
+    # The same calculation as a MongoDB aggregation expression (for rescore_patients in db_operations.py)
+    def expression(self):
+        parts = [float(self.intercept)]
+        for term in self.terms:
+            field = '$' + term['column']
+            if term['kind'] == 'number':
+                value = {'$ifNull': [field, term['mean']]}
+                parts.append({'$multiply': [term['weight'], {'$divide': [{'$subtract': [value, term['mean']]}, term['scale']]}]})
+            elif term['kind'] == 'flag':
+                parts.append({'$cond': [{'$eq': [field, 1]}, term['weight'], 0.0]})
+            else:
+                parts.append({'$cond': [{'$eq': [{'$toLower': field}, term['value']]}, term['weight'], 0.0]})
+        z = {'$add': parts}
+        return {'$round': [{'$divide': [1.0, {'$add': [1.0, {'$exp': {'$multiply': [-1.0, z]}}]}]}, RISK_DECIMALS]}
+
+
+# Model from the JSON file, None when there is no file (then the rule is used)
+def load_risk_model(path=None):
+    path = path or RISK_MODEL_PATH
+    try:
+        with open(path) as f:
+            return RiskModel(json.load(f))
+    except FileNotFoundError:
+        return None
+
+
+def save_risk_model(model, path=None):
+    path = path or RISK_MODEL_PATH
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(model.artifact, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+# Terms of a new model from the training patients - numbers get their average and spread
+def _new_terms(clean):
+    terms = []
+    for name in NUMBER_FEATURES:
+        values = pd.to_numeric(clean[name], errors='coerce')
+        terms.append({'column': name, 'kind': 'number', 'mean': float(values.mean()), 'scale': float(values.std() or 1.0)})
+    for name in FLAG_FEATURES:
+        terms.append({'column': name, 'kind': 'flag'})
+    for name in TEXT_FEATURES:
+        values = sorted({str(value).lower() for value in pd.unique(clean[name].dropna())})
+        # The first value is left out - it's what the intercept means (otherwise the features add up to 1)
+        terms.extend({'column': name, 'kind': 'text', 'value': value} for value in values[1:])
+    return terms
+
+
+# Logistic regression with Newton's method (a few steps are enough) and L2 penalty, so weights stay small
+def fit_logistic(X, y, sample_weight=None, l2=1.0, max_steps=50, tolerance=1e-8):
+    X = np.column_stack([np.ones(len(X)), X])
+    weight = np.ones(len(y)) if sample_weight is None else sample_weight
+    penalty = np.full(X.shape[1], l2)
+    penalty[0] = 0.0
+    beta = np.zeros(X.shape[1])
+    for _ in range(max_steps):
+        p = _sigmoid(X @ beta)
+        gradient = X.T @ (weight * (p - y)) + penalty * beta
+        hessian = (X * (weight * p * (1 - p))[:, None]).T @ X + np.diag(penalty)
+        step = np.linalg.solve(hessian, gradient)
+        beta -= step
+        if np.abs(step).max() < tolerance:
+            break
+    return beta[0], beta[1:]
+
+
+# Area under the ROC curve - chance that a patient with stroke has higher risk than one without
+def roc_auc(y, risk):
+    ranks = pd.Series(risk).rank().to_numpy()
+    positive = y == 1
+    count = positive.sum()
+    if count == 0 or count == len(y):
+        return float('nan')
+    return float((ranks[positive].sum() - count * (count + 1) / 2) / (count * (len(y) - count)))
+
+
+def evaluate(y, risk):
+    risk = np.clip(np.asarray(risk, dtype=float), 1e-6, 1 - 1e-6)
+    predicted = risk >= 0.5
+    return {
+        'accuracy': round(float((predicted == (y == 1)).mean()), 4),
+        'recall': round(float(predicted[y == 1].mean()), 4) if (y == 1).any() else 0.0,
+        'precision': round(float((y[predicted] == 1).mean()), 4) if predicted.any() else 0.0,
+        'auc': round(roc_auc(y, risk), 4),
+        'log_loss': round(float(-np.mean(y * np.log(risk) + (1 - y) * np.log(1 - risk))), 4),
+    }
+
+
+# Patients and stroke labels from a CSV file, cleaned the same way as the import does
+def training_data(csv_path):
+    df = pd.read_csv(csv_path)
+    if LABEL_COLUMN not in df.columns:
+        raise ValueError(f"Column {LABEL_COLUMN} is missing in {csv_path}")
+    clean, _ = clean_dataset(df)
+    labels = pd.to_numeric(df.loc[clean.index, LABEL_COLUMN], errors='coerce')
+    known = labels.isin([0, 1]).to_numpy()
+    return clean[known].reset_index(drop=True), labels[known].to_numpy(dtype=float)
+
+
+# Train a model on csv_path. test_share of patients (random, but the same every time) is kept away from
+# training and used to compare the model with the rule. balanced - both classes get the same total weight
+def train_risk_model(csv_path=TRAINING_CSV, l2=1.0, balanced=True, test_share=0.2, seed=42):
+    clean, y = training_data(csv_path)
+    order = np.random.default_rng(seed).permutation(len(y))
+    test_count = int(len(y) * test_share)
+    test, train = order[:test_count], order[test_count:]
+    train_patients, test_patients = clean.iloc[train], clean.iloc[test]
+
+    started = time.perf_counter()
+    terms = _new_terms(train_patients)
+    model = RiskModel({'format': MODEL_FORMAT, 'version': '', 'intercept': 0.0, 'terms': terms})
+    sample_weight = None
+    if balanced:
+        positive = y[train].mean()
+        sample_weight = np.where(y[train] == 1, 0.5 / positive, 0.5 / (1 - positive))
+    intercept, weights = fit_logistic(model.matrix(train_patients), y[train], sample_weight, l2)
+    seconds = time.perf_counter() - started
+
+    for term, weight in zip(terms, weights):
+        term['weight'] = float(weight)
+    model = RiskModel({
+        'format': MODEL_FORMAT,
+        'version': time.strftime('%Y%m%d%H%M%S', time.gmtime()),
+        'trained': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'source': os.path.basename(csv_path),
+        'train_rows': int(len(train)),
+        'test_rows': int(len(test)),
+        'balanced': balanced,
+        'l2': l2,
+        'training_seconds': round(seconds, 4),
+        'intercept': float(intercept),
+        'terms': terms,
+    })
+    rule = risk_from_arrays(test_patients['hypertension'], test_patients['age'],
+                            test_patients['avg_glucose_level'], test_patients['smoking_status'])
+    model.artifact['test_results'] = {'model': evaluate(y[test], model.score(test_patients)),
+                                      'rule': evaluate(y[test], rule)}
+    return model
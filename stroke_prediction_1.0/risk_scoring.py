@@ -0,0 +1,116 @@
+# This file keeps my stroke risk calculation in one place.
+# Before, the same rule was copied into add_patient_route, edit_patient and the CSV import,
+# so any change had to be done three times. Now all of them call score_patients().
+#
+# I got these risk values from the American Stroke Association and CDC resources:
+# High blood pressure adds 0.3 to risk
+# Being over 60 adds 0.3
+# High glucose (over 200 mg/dL) adds 0.2
+# Smoking adds 0.2
+# The most someone can get is 1.0 (100% risk)
+#
+# The calculation works on NumPy arrays, so one patient or a million patients are scored
+# with the same few array operations and no Python loop over rows.
+# The same rule is also written as a MongoDB expression (risk_expression), so when the numbers above change
+# all saved patients can be scored again inside MongoDB, without sending them to Python (rescore_patients in db_operations.py).
+#
+# When a trained model is loaded (risk_model.py, set_risk_model is called by create_app), score_patients and
+# risk_expression use the model instead of this rule.
+
+import numpy as np
+import pandas as pd
+
+HYPERTENSION_WEIGHT = 0.3
+AGE_WEIGHT = 0.3
+AGE_THRESHOLD = 60
+GLUCOSE_WEIGHT = 0.2
+GLUCOSE_THRESHOLD = 200
+SMOKING_WEIGHT = 0.2
+SMOKING_STATUS = 'smokes'
+MAX_RISK = 1.0
+
+# Fields the rule needs from every patient
+RISK_FIELDS = ['hypertension', 'age', 'avg_glucose_level', 'smoking_status']
+
+# Trained model (risk_model.RiskModel) or None for the rule above
+_model = None
+
+
+def set_risk_model(model):
+    global _model
+    _model = model
+
+
+def current_risk_model():
+    return _model
+
+
+# Smoking status is compared without caring about big/small letters.
+# I lower-case only the different values (there are only a few), not every row.
+def _is_smoker(smoking):
+    if isinstance(getattr(smoking, 'dtype', None), pd.CategoricalDtype):
+        smoking = pd.Categorical(smoking)
+        codes, uniques = smoking.codes, smoking.categories
+    else:
+        codes, uniques = pd.factorize(np.asarray(smoking, dtype=object), use_na_sentinel=True)
+    smokers = np.array([str(value).lower() == SMOKING_STATUS for value in uniques], dtype=bool)
+    return np.append(smokers, False)[codes]
+
+
+# Risk for whole columns at once - every argument is an array with one value per patient
+def risk_from_arrays(hypertension, age, glucose, smoking):
+    hypertension = np.asarray(hypertension, dtype=float)
+    age = np.asarray(age, dtype=float)
+    glucose = np.asarray(glucose, dtype=float)
+
+    risk = np.where(hypertension == 1, HYPERTENSION_WEIGHT, 0.0)
+    risk += np.where(age > AGE_THRESHOLD, AGE_WEIGHT, 0.0)
+    risk += np.where(glucose > GLUCOSE_THRESHOLD, GLUCOSE_WEIGHT, 0.0)
+    risk += np.where(_is_smoker(smoking), SMOKING_WEIGHT, 0.0)
+    return np.minimum(risk, MAX_RISK)
+
+
+# Main function used by the app. It accepts:
+# one patient (dict) - returns one number
+# list of patients (dicts) - returns NumPy array
+# DataFrame, or dict of columns (arrays) - returns NumPy array
+def score_patients(data):
+    if _model is not None:
+        if isinstance(data, dict) and np.ndim(data.get('age')) == 0:
+            return _model.score_one(data)
+        if isinstance(data, (list, tuple)):
+            data = pd.DataFrame.from_records(data, columns=_model.fields)
+        return _model.score(data)
+
+    # Fields that are not required (smoking_status, ...) can be missing - they don't add risk then
+    if isinstance(data, dict) and np.ndim(data.get('age')) == 0:
+        risk = risk_from_arrays(*([data.get(name)] for name in RISK_FIELDS))
+        return float(risk[0])
+
+    if isinstance(data, (list, tuple)):
+        data = pd.DataFrame.from_records(data, columns=RISK_FIELDS)
+
+    return risk_from_arrays(*_rule_columns(data))
+
+
+# Columns the rule needs from a DataFrame or dict of columns, missing columns are all NaN
+def _rule_columns(data):
+    size = len(data) if isinstance(data, pd.DataFrame) else max((len(column) for column in data.values()), default=0)
+    return [data[name] if name in data else np.full(size, np.nan) for name in RISK_FIELDS]
+
+
+# The same rule as risk_from_arrays, but as a MongoDB aggregation expression.
+# Values are added in the same order as above, so MongoDB gets exactly the same numbers as Python
+def risk_expression():
+    if _model is not None:
+        return _model.expression()
+
+    def add_if(condition, weight):
+        return {'$cond': [condition, weight, 0.0]}
+
+    return {'$min': [MAX_RISK, {'$add': [
+        add_if({'$eq': ['$hypertension', 1]}, HYPERTENSION_WEIGHT),
+        add_if({'$gt': ['$age', AGE_THRESHOLD]}, AGE_WEIGHT),
+        add_if({'$gt': ['$avg_glucose_level', GLUCOSE_THRESHOLD]}, GLUCOSE_WEIGHT),
+        add_if({'$eq': [{'$toLower': '$smoking_status'}, SMOKING_STATUS]}, SMOKING_WEIGHT),
+    ]}]}
@@ -0,0 +1,14 @@
+# Settings for the servers that run the app with several workers (wsgi.py for gunicorn, asgi.py for uvicorn).
+# Called before main_app is imported, because modules read their settings when they are imported.
+
+import os
+from dotenv import load_dotenv
+
+
+# gunicorn and uvicorn don't read .env like "flask run" does, so it's read here.
+# Every worker must have the same SECRET_KEY, so a user logged in through one worker stays logged in
+# on the others - without it the server doesn't start
+def load_server_env():
+    load_dotenv()
+    if not os.environ.get('SECRET_KEY'):
+        raise RuntimeError('SECRET_KEY is not set - every worker needs the same key (environment variable or .env file)')
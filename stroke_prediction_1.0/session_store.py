@@ -0,0 +1,101 @@
+# Sessions saved on the server, in the SQLite database (table sessions, made by setup_sqlite in db_setup.py).
+# Normally Flask keeps the whole session in the cookie, signed with the secret key. That works with many
+# worker processes too, as long as all of them have the same SECRET_KEY. With SESSION_BACKEND=sqlite
+# the cookie only has a random session id, and the data stays on the server - so a session can be
+# ended on the server (logout really removes it) and nothing about the user is sent to the browser.
+#
+# All worker processes on one machine use the same SQLite file, so any worker can answer any request.
+# At login the session gets a new id (regenerate), so an id somebody got before the login can't be used after it.
+# Old sessions are removed from time to time when sessions are saved.
+
+import random
+import secrets
+import time
+from flask.sessions import SessionInterface, SessionMixin, session_json_serializer
+from itsdangerous import Signer, BadSignature
+from werkzeug.datastructures import CallbackDict
+from db_setup import get_db_connection, close_db_connection
+
+# On about 1 of 100 saved sessions, expired sessions are deleted
+CLEANUP_CHANCE = 0.01
+
+
+class SQLiteSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, session_id=None, new=False):
+        def on_update(self):
+            self.modified = True
+
+        super().__init__(initial, on_update)
+        self.session_id = session_id
+        self.old_session_id = None
+        self.new = new
+        self.modified = False
+
+    # New id for the same data, the old one is removed from the database when the session is saved
+    def regenerate(self):
+        if not self.new and self.old_session_id is None:
+            self.old_session_id = self.session_id
+        self.session_id = secrets.token_urlsafe(32)
+        self.modified = True
+
+
+class SQLiteSessionInterface(SessionInterface):
+    serializer = session_json_serializer
+
+    # Session id in the cookie is signed with the secret key, so a made-up id is refused without asking SQLite
+    def _signer(self, app):
+        return Signer(app.secret_key, salt='sqlite-session')
+
+    def open_session(self, app, request):
+        if not app.secret_key:
+            return None
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if cookie:
+            try:
+                session_id = self._signer(app).unsign(cookie).decode()
+            except BadSignature:
+                session_id = None
+            if session_id:
+                conn = get_db_connection()
+                row = conn.execute('SELECT data FROM sessions WHERE id = ? AND expires > ?',
+                                   (session_id, time.time())).fetchone()
+                close_db_connection(conn)
+                if row is not None:
+                    return SQLiteSession(self.serializer.loads(row['data']), session_id)
+        return SQLiteSession(session_id=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        conn = get_db_connection()
+        try:
+            if session.old_session_id is not None:
+                conn.execute('DELETE FROM sessions WHERE id = ?', (session.old_session_id,))
+                conn.commit()
+            if not session:
+                # Empty session (for example after logout) - remove it from the database and the browser
+                if session.modified and not session.new:
+                    conn.execute('DELETE FROM sessions WHERE id = ?', (session.session_id,))
+                    conn.commit()
+                    response.delete_cookie(name, domain=domain, path=path)
+                return
+
+            if session.accessed:
+                response.vary.add('Cookie')
+            if not self.should_set_cookie(app, session):
+                return
+
+            expires = time.time() + app.permanent_session_lifetime.total_seconds()
+            conn.execute('INSERT OR REPLACE INTO sessions (id, data, expires) VALUES (?, ?, ?)',
+                         (session.session_id, self.serializer.dumps(dict(session)), expires))
+            if random.random() < CLEANUP_CHANCE:
+                conn.execute('DELETE FROM sessions WHERE expires < ?', (time.time(),))
+            conn.commit()
+        finally:
+            close_db_connection(conn)
+
+        cookie = self._signer(app).sign(session.session_id.encode()).decode()
+        response.set_cookie(name, cookie, expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app), domain=domain, path=path,
+                            secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app))
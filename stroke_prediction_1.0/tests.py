@@ -1,12 +1,46 @@
 # I made this file to test if my app works correctly. Here I test:
 
 # I use unittest to run tests and get things I need from my main a
+import os
+import time
 import unittest
 from main_app import app
-from main_app import user_exists
+from main_app import user_exists, create_app
+from db_setup import setup_sqlite, setup_mongodb_indexes
+import pandas as pd
+from dataset_import import clean_dataset, row_hashes, split_file, import_executor, import_dataset
+from risk_scoring import score_patients, set_risk_model
+from risk_model import train_risk_model, save_risk_model, load_risk_model
+from patient_validation import validate_patients
+from db_operations import patient_filter, check_patient_fields
+from patient_export import csv_pieces, ndjson_pieces
+import password_hashing
+from page_cache import LRUCache
+import page_cache
+import import_jobs
+from db_operations import patients_changed
+from insert_buffer import InsertBuffer
+import tempfile
+import patient_snapshot
+import analytics
+import metrics
+from bson.objectid import ObjectId
+from pymongo.errors import ConnectionFailure, DuplicateKeyError, BulkWriteError
+from unittest import mock
+from server_env import load_server_env
+from db_operations import rescore_patients, bulk_update_patients, get_patients_page, encode_page_cursor, decode_page_cursor, PATIENT_SORTS
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
 
 # This prepares my app for testing - it turns on test mode and sets up test user details
 class StrokeAppTests(unittest.TestCase):
+    # App doesn't set up databases when it is imported anymore, so I make the users table here
+    @classmethod
+    def setUpClass(cls):
+       setup_sqlite()
+
     def setUp(self):
        app.config['TESTING'] = True
        self.app = app.test_client()
@@ -56,6 +90,681 @@ class StrokeAppTests(unittest.TestCase):
     def test_user_not_exists(self):
        self.assertFalse(user_exists('NonExistenUser', 'nonexistent@example.com'))
 
+        # If CSV import fixes wrong values for the whole file at once
+    def test_clean_dataset(self):
+       df = pd.DataFrame({
+           'gender': ['Male', 'Robot', None],
+           'age': [67, 200, 'abc'],
+           'hypertension': [1, 5, 0],
+           'ever_married': ['Yes', 'No', 'Yes'],
+           'work_type': ['Private', 'Pilot', 'children'],
+           'Residence_type': ['Urban', 'Rural', 'Urban'],
+           'avg_glucose_level': [228.69, 600, 90],
+           'bmi': [36.6, None, 20],
+           'smoking_status': ['smokes', 'never smoked', 'smokes'],
+       })
+       clean, broken = clean_dataset(df)
+       self.assertEqual(broken, 1)
+       self.assertEqual(len(clean), 2)
+       self.assertEqual(list(clean['gender']), ['Male', 'Unknown'])
+       self.assertEqual(list(clean['age']), [67.0, 0.0])
+       self.assertEqual(list(clean['hypertension']), [1, 0])
+       self.assertEqual(list(clean['work_type']), ['Private', 'Unknown'])
+       self.assertEqual(list(clean['avg_glucose_level']), [228.69, 0.0])
+       self.assertEqual(list(clean['bmi']), [36.6, 25.0])
+       self.assertEqual(list(clean['stroke_risk']), [1.0, 0.0])
+
+    # Test that list filters become a query where the exact fields always use the filter index
+    def test_patient_filter(self):
+       self.assertEqual(patient_filter(), {})
+       query = patient_filter(risk_min=0.5, age_min=60, smoking_status='smokes')
+       self.assertEqual(query['stroke_risk'], {'$gte': 0.5})
+       self.assertEqual(query['age'], {'$gte': 60})
+       self.assertEqual(query['smoking_status'], 'smokes')
+       self.assertEqual(query['hypertension'], {'$in': [0, 1]})
+       self.assertEqual(query['gender'], {'$in': ['Male', 'Female', 'Other']})
+
+       # Patients without smoking_status (it's not required) are found by the other filters too
+       self.assertIn(None, patient_filter(gender='Male')['smoking_status']['$in'])
+       if mongomock:
+           patients = mongomock.MongoClient().db.patients
+           patients.insert_many([{'gender': 'Male', 'age': 50.0, 'hypertension': 0, 'smoking_status': 'smokes'},
+                                 {'gender': 'Male', 'age': 60.0, 'hypertension': 1}])
+           self.assertEqual(patients.count_documents(patient_filter(gender='Male')), 2)
+
+    # Test that export is made in pieces and every patient is written once
+    def test_export_pieces(self):
+       patients = [{'_id': str(number), 'age': 50.0 + number, 'gender': 'Male'} for number in range(5)]
+       pieces = list(csv_pieces(iter(patients), batch_size=2))
+       self.assertEqual(len(pieces), 3)
+       lines = ''.join(pieces).splitlines()
+       self.assertTrue(lines[0].startswith('_id,gender,age'))
+       self.assertEqual(len(lines), 6)
+       self.assertEqual(''.join(ndjson_pieces(iter(patients))).count('\n'), 5)
+
+    # Test that a password saved with an old hashing cost gets a new hash at login
+    def test_password_hash_upgrade(self):
+       password_hashing.configure_hashing(method='pbkdf2:sha256:1000', workers=0)
+       try:
+           saved = password_hashing.hash_password('secret')
+           self.assertEqual(password_hashing.check_password(saved, 'secret'), (True, None))
+           self.assertEqual(password_hashing.check_password(saved, 'wrong'), (False, None))
+           password_hashing.configure_hashing(method='pbkdf2:sha256:2000')
+           password_ok, new_hash = password_hashing.check_password(saved, 'secret')
+           self.assertTrue(password_ok)
+           self.assertTrue(new_hash.startswith('pbkdf2:sha256:2000$'))
+       finally:
+           password_hashing.configure_hashing(method=password_hashing.PASSWORD_HASH_METHOD,
+                                              workers=password_hashing.PASSWORD_HASH_WORKERS)
+
+    # Test that two worker processes (two apps with the same key) share sessions saved in SQLite
+    def test_sqlite_sessions_shared_between_workers(self):
+       config = {'TESTING': True, 'SECRET_KEY': 'test-key', 'SESSION_BACKEND': 'sqlite'}
+       first = create_app(config).test_client()
+       second = create_app(config).test_client()
+       with first.session_transaction() as session:
+           session['user_id'] = 1
+           session['user_name'] = 'test'
+       second.set_cookie('session', first.get_cookie('session').value)
+       self.assertEqual(second.get('/import_status/missing').status_code, 404)
+       second.get('/logout')
+       self.assertEqual(first.get('/import_status/missing').status_code, 302)
+
+    # Test that a session id from before the login can't be used after it (session fixation)
+    def test_sqlite_session_new_id_at_login(self):
+       config = {'TESTING': True, 'SECRET_KEY': 'test-key', 'SESSION_BACKEND': 'sqlite'}
+       client = create_app(config).test_client()
+       password_hashing.configure_hashing(method='pbkdf2:sha256:1000', workers=0)
+       try:
+           email = f'fixation-{os.getpid()}-{time.time_ns()}@test.com'
+           client.post('/user_register', data={'name': 'Fixation', 'email': email, 'password': 'Secret123!'})
+           with client.session_transaction() as session:
+               session['visited'] = True
+           before = client.get_cookie('session').value
+           client.post('/user_login', data={'email': email, 'password': 'Secret123!'})
+       finally:
+           password_hashing.configure_hashing(method=password_hashing.PASSWORD_HASH_METHOD,
+                                              workers=password_hashing.PASSWORD_HASH_WORKERS)
+       self.assertNotEqual(client.get_cookie('session').value, before)
+       self.assertEqual(client.get('/import_status/missing').status_code, 404)
+       other = create_app(config).test_client()
+       other.set_cookie('session', before)
+       self.assertEqual(other.get('/import_status/missing').status_code, 302)
+
+    # Test that page cache removes least recently used pages when it's full
+    def test_lru_cache(self):
+       cache = LRUCache(max_entries=2, max_bytes=10)
+       cache.set('a', 'aaa')
+       cache.set('b', 'bbb')
+       cache.get('a')
+       cache.set('c', 'ccc')
+       self.assertIsNone(cache.get('b'))
+       self.assertEqual(cache.get('a'), 'aaa')
+       cache.set('d', 'dddddddd')
+       self.assertIsNone(cache.get('a'))
+       self.assertEqual(cache.get('d'), 'dddddddd')
+
+       # Versions of single patients are forgotten when there are too many, and "all" changes instead
+       with tempfile.TemporaryDirectory() as folder:
+           for cache in [LRUCache(10, 100, max_versions=5), page_cache.SQLiteCache(os.path.join(folder, 'cache.db'), 10, 100, max_versions=5)]:
+               cache.new_versions(['lists'] + [f'patient:{number}' for number in range(3)])
+               self.assertEqual(cache.version('all'), 0)
+               cache.new_versions(['lists'] + [f'patient:{number}' for number in range(3, 6)])
+               self.assertEqual(cache.version('all'), 1)
+               self.assertEqual(cache.version('lists'), 2)
+               self.assertEqual(cache.version('patient:1'), 0)
+
+    # Test that insert buffer saves patients in groups, every caller gets its own _id, and close saves the rest
+    def test_insert_buffer(self):
+       class Collection:
+           def __init__(self):
+               self.groups = []
+           def with_options(self, write_concern):
+               return self
+           def insert_many(self, patients, ordered):
+               for patient in patients:
+                   patient['_id'] = ObjectId()
+               self.groups.append(len(patients))
+
+       collection = Collection()
+       changed = []
+       buffer = InsertBuffer(lambda: collection, changed.extend, max_batch=3, max_wait_ms=1000)
+       futures = [buffer.submit({'age': float(age)}) for age in range(7)]
+       ids = [future.result() for future in futures[:6]]
+       buffer.close()
+       self.assertEqual(len(set(ids)), 6)
+       self.assertTrue(futures[6].done())
+       self.assertEqual(collection.groups, [3, 3, 1])
+       self.assertEqual(len(changed), 7)
+
+       # A failed insert may have saved some patients, so caches are told that anything could have changed
+       class BrokenCollection(Collection):
+           def insert_many(self, patients, ordered):
+               raise ConnectionFailure('connection closed')
+       calls = []
+       buffer = InsertBuffer(lambda: BrokenCollection(), calls.append, max_wait_ms=0)
+       with self.assertRaises(ConnectionFailure):
+           buffer.insert({'age': 50.0})
+       buffer.close()
+       self.assertEqual(calls, [None])
+
+    # Test that risk statistics are calculated from the snapshot columns
+    def test_snapshot_risk_statistics(self):
+       patients = [
+           {'_id': ObjectId(), 'age': 70.0, 'hypertension': 1, 'avg_glucose_level': 90.0, 'smoking_status': 'smokes', 'stroke_risk': 0.8},
+           {'_id': ObjectId(), 'age': 30.0, 'hypertension': 0, 'avg_glucose_level': 90.0, 'smoking_status': 'never smoked', 'stroke_risk': 0.0},
+           {'_id': ObjectId(), 'age': 65.0, 'hypertension': 0, 'avg_glucose_level': 90.0, 'smoking_status': 'never smoked', 'stroke_risk': 0.0},
+       ]
+       saved_dir = patient_snapshot.SNAPSHOT_DIR
+       with tempfile.TemporaryDirectory() as folder:
+           patient_snapshot.SNAPSHOT_DIR = folder
+           try:
+               categories = {name: [] for name in patient_snapshot.TEXT_COLUMNS}
+               snapshot = patient_snapshot._write_snapshot(patient_snapshot._to_arrays(patients, categories), categories)
+               stats = patient_snapshot.risk_statistics(snapshot)
+           finally:
+               patient_snapshot.SNAPSHOT_DIR = saved_dir
+       self.assertEqual(stats['patients'], 3)
+       self.assertEqual(stats['high_risk'], 1)
+       self.assertEqual(stats['outdated_risk'], 1)
+       self.assertEqual(stats['by_smoking_status']['smokes']['patients'], 1)
+
+    # Test that another process can't refresh the snapshot while this one does
+    @unittest.skipUnless(patient_snapshot.fcntl, 'no fcntl on this system')
+    def test_snapshot_refresh_lock(self):
+       saved_dir = patient_snapshot.SNAPSHOT_DIR
+       with tempfile.TemporaryDirectory() as folder:
+           patient_snapshot.SNAPSHOT_DIR = folder
+           try:
+               with patient_snapshot._refresh_lock():
+                   # Another open file behaves like another process
+                   with open(os.path.join(folder, patient_snapshot.LOCK_FILE)) as other:
+                       with self.assertRaises(BlockingIOError):
+                           patient_snapshot.fcntl.flock(other, patient_snapshot.fcntl.LOCK_EX | patient_snapshot.fcntl.LOCK_NB)
+               with open(os.path.join(folder, patient_snapshot.LOCK_FILE)) as other:
+                   patient_snapshot.fcntl.flock(other, patient_snapshot.fcntl.LOCK_EX | patient_snapshot.fcntl.LOCK_NB)
+           finally:
+               patient_snapshot.SNAPSHOT_DIR = saved_dir
+
+    # Test that a patient changed while the first snapshot is being made is in the snapshot
+    @unittest.skipUnless(mongomock, 'mongomock is not installed')
+    def test_snapshot_changes_during_build(self):
+       class Patients:
+           # Patients are read, then one of them changes before the build is finished
+           def __init__(self, collection):
+               self.collection = collection
+               self.changed = False
+           def find(self, *args):
+               read = list(self.collection.find(*args))
+               if not self.changed:
+                   self.changed = True
+                   self.collection.update_one({'_id': read[0]['_id']}, {'$set': {'age': 80.0}})
+                   patients_changed([read[0]['_id']])
+               return Cursor(read)
+       class Cursor(list):
+           def sort(self, *args):
+               return Cursor(sorted(self, key=lambda patient: patient['_id']))
+           def batch_size(self, size):
+               return self
+
+       collection = mongomock.MongoClient().db.patients
+       collection.insert_many([{'age': 50.0, 'gender': 'Male'}, {'age': 60.0, 'gender': 'Female'}])
+       saved_dir = patient_snapshot.SNAPSHOT_DIR
+       with tempfile.TemporaryDirectory() as folder:
+           patient_snapshot.SNAPSHOT_DIR = folder
+           try:
+               snapshot = patient_snapshot.get_snapshot(Patients(collection))
+               ages = sorted(snapshot.column('age'))
+               building = os.path.exists(os.path.join(folder, patient_snapshot.BUILD_FILE))
+           finally:
+               patient_snapshot.SNAPSHOT_DIR = saved_dir
+       self.assertEqual(ages, [60.0, 80.0])
+       self.assertFalse(building)
+
+    # Test that every sort walks through all patients page by page, forward and back, with equal values of the sort field
+    @unittest.skipUnless(mongomock, 'mongomock is not installed')
+    def test_keyset_pages(self):
+       patients = mongomock.MongoClient().db.patients
+       patients.insert_many([{'age': float(30 + number % 3), 'stroke_risk': (number % 4) / 4, 'gender': 'Male'} for number in range(7)])
+       for sort, fields in PATIENT_SORTS.items():
+           expected = [patient['_id'] for patient in patients.find().sort(fields)]
+           # Cursor gives back the value and _id it was made from
+           first = patients.find_one({'_id': expected[0]})
+           value, patient_id = decode_page_cursor(encode_page_cursor(first, sort), sort)
+           self.assertEqual(patient_id, first['_id'])
+           if len(fields) > 1:
+               self.assertEqual(value, first[fields[0][0]])
+
+           pages = [get_patients_page(patients, page_size=3, sort=sort)]
+           while pages[-1]['next_cursor']:
+               pages.append(get_patients_page(patients, after=pages[-1]['next_cursor'], page_size=3, sort=sort))
+           self.assertEqual([patient['_id'] for page in pages for patient in page['patients']], expected, sort)
+           self.assertEqual([len(page['patients']) for page in pages], [3, 3, 1])
+           self.assertIsNone(pages[0]['prev_cursor'])
+
+           # Going back from the last page gives the same pages again
+           back = get_patients_page(patients, before=pages[2]['prev_cursor'], page_size=3, sort=sort)
+           self.assertEqual(back['patients'], pages[1]['patients'], sort)
+           back = get_patients_page(patients, before=back['prev_cursor'], page_size=3, sort=sort)
+           self.assertEqual(back['patients'], pages[0]['patients'], sort)
+           self.assertIsNone(back['prev_cursor'])
+
+    # Test that a file is split into parts that start and end at whole lines
+    def test_split_file(self):
+       with tempfile.NamedTemporaryFile('wb', suffix='.csv', delete=False) as f:
+           f.write(b'id,age\n' + b''.join(b'%d,%d\n' % (number, number % 90) for number in range(1000)))
+       try:
+           with open(f.name, 'rb') as data:
+               content = data.read()
+           parts = split_file(f.name, 7, len(content), 4)
+           self.assertEqual(parts[0][0], 7)
+           self.assertEqual(parts[-1][1], len(content))
+           for (start, end), (next_start, _) in zip(parts, parts[1:]):
+               self.assertEqual(end, next_start)
+               self.assertEqual(content[end - 1:end], b'\n')
+       finally:
+           os.remove(f.name)
+
+    # Test that row hash only changes when the cleaned patient changes
+    def test_row_hashes(self):
+       df = pd.DataFrame({
+           'gender': ['Male', 'Female'],
+           'age': [67, 45],
+           'hypertension': [1, 0],
+           'ever_married': ['Yes', 'No'],
+           'work_type': ['Private', 'Private'],
+           'Residence_type': ['Urban', 'Rural'],
+           'avg_glucose_level': [228.69, 90],
+           'bmi': [36.6, 20],
+           'smoking_status': ['smokes', 'never smoked'],
+       })
+       before = row_hashes(clean_dataset(df)[0])
+       df['age'] = ['67', 50]
+       after = row_hashes(clean_dataset(df)[0])
+       self.assertEqual(before[0], after[0])
+       self.assertNotEqual(before[1], after[1])
+
+        # If one patient and a batch of patients get the same risk
+    def test_score_patients(self):
+       patient = {'hypertension': 1, 'age': 67.0, 'avg_glucose_level': 228.69, 'smoking_status': 'Smokes'}
+       other = {'hypertension': 0, 'age': 30.0, 'avg_glucose_level': 90.0, 'smoking_status': 'never smoked'}
+       self.assertEqual(score_patients(patient), 1.0)
+       self.assertEqual(list(score_patients([patient, other])), [1.0, 0.0])
+       self.assertEqual(list(score_patients(pd.DataFrame([other, patient]))), [0.0, 1.0])
+
+        # If trained model is saved and loaded, and one patient gets the same risk as a batch
+    def test_risk_model(self):
+       model = train_risk_model('data/data.csv.xls')
+       with tempfile.TemporaryDirectory() as folder:
+           save_risk_model(model, os.path.join(folder, 'risk_model.json'))
+           loaded = load_risk_model(os.path.join(folder, 'risk_model.json'))
+       self.assertEqual(loaded.version, model.version)
+       self.assertGreater(model.artifact['test_results']['model']['auc'], 0.7)
+
+       patients = [
+           {'gender': 'Male', 'age': 67.0, 'hypertension': 1, 'heart_disease': 1, 'ever_married': 'Yes', 'work_type': 'Private',
+            'residence_type': 'Urban', 'avg_glucose_level': 228.69, 'bmi': 36.6, 'smoking_status': 'smokes'},
+           {'gender': 'Female', 'age': 20.0, 'hypertension': 0, 'heart_disease': 0, 'avg_glucose_level': 80.0, 'bmi': None},
+       ]
+       set_risk_model(loaded)
+       try:
+           batch = score_patients(patients)
+           self.assertEqual([score_patients(patient) for patient in patients], list(batch))
+       finally:
+           set_risk_model(None)
+       self.assertGreater(batch[0], batch[1])
+
+       # If import processes score patients with the same model as the app
+       set_risk_model(loaded)
+       try:
+           with import_executor(1) as executor:
+               self.assertEqual(executor.submit(score_patients, patients[0]).result(), score_patients(patients[0]))
+       finally:
+           set_risk_model(None)
+
+        # If prediction API rules are the same as MongoDB rules
+    def test_validate_patients(self):
+       df = pd.DataFrame([
+           {'gender': 'Male', 'age': 67.0, 'hypertension': 1, 'avg_glucose_level': 228.69, 'bmi': 36.6},
+           {'gender': 'Robot', 'age': 150.0, 'hypertension': 1, 'avg_glucose_level': 90.0, 'bmi': 22.0},
+       ])
+       _, valid, errors = validate_patients(df)
+       self.assertEqual(list(valid), [True, False])
+       self.assertEqual(len(errors[1]), 2)
+
+        # If fields for bulk update are checked and changed to numbers, and unknown fields are refused
+    def test_check_patient_fields(self):
+       self.assertEqual(check_patient_fields({'hypertension': '1', 'age': '70'}, partial=True), ({'hypertension': 1, 'age': 70.0}, None))
+       self.assertIsNotNone(check_patient_fields({'heart_disease': 3}, partial=True)[1])
+       self.assertIsNotNone(check_patient_fields({'stroke_risk': 1}, partial=True)[1])
+       self.assertIsNotNone(check_patient_fields({'age': 70}, partial=False)[1])
+       self.assertEqual(self.app.post('/api/bulk_patients', json={'action': 'delete', 'ids': []}).status_code, 401)
+
+        # If import only reads new rows, skips a file that didn't change, and updates only changed rows
+    @unittest.skipUnless(mongomock, 'mongomock is not installed')
+    def test_incremental_import(self):
+       class Patients:
+           # mongomock's bulk_write doesn't accept pymongo's UpdateOne, so changed rows are updated one by one here
+           def __init__(self, collection):
+               self.collection = collection
+           def __getattr__(self, name):
+               return getattr(self.collection, name)
+           def bulk_write(self, operations, ordered):
+               matched = sum(self.collection.update_one(operation._filter, operation._doc).matched_count for operation in operations)
+               return type('Result', (), {'matched_count': matched})()
+
+       with open('data/data.csv.xls') as f:
+           lines = [next(f) for _ in range(41)]
+       patients = Patients(mongomock.MongoClient().db.patients)
+       setup_mongodb_indexes(patients.collection)
+       with tempfile.TemporaryDirectory() as folder:
+           path = os.path.join(folder, 'patients.csv')
+           with open(path, 'w') as f:
+               f.writelines(lines[:31])
+           first = import_dataset(patients, path, incremental=True, processes=1)
+           self.assertEqual((first['mode'], first['rows']), ('full', 30))
+           saved = patients.count_documents({})
+           self.assertEqual(saved, first['inserted'])
+
+           again = import_dataset(patients, path, incremental=True, processes=1)
+           self.assertEqual((again['mode'], again['rows'], again['inserted']), ('unchanged', 0, 0))
+
+           with open(path, 'a') as f:
+               f.writelines(lines[31:])
+           appended = import_dataset(patients, path, incremental=True, processes=1)
+           self.assertEqual((appended['mode'], appended['rows'], appended['unchanged']), ('append', 10, 0))
+           self.assertEqual(patients.count_documents({}), saved + appended['inserted'])
+
+           # Age of the first patient changed from 67 to 68
+           lines[1] = lines[1].replace(',67,', ',68,', 1)
+           with open(path, 'w') as f:
+               f.writelines(lines)
+           changed = import_dataset(patients, path, incremental=True, processes=1)
+           self.assertEqual((changed['mode'], changed['inserted'], changed['updated']), ('full', 0, 1))
+           self.assertEqual(patients.find_one({'source_id': 9046})['age'], 68.0)
+
+           # Another file with the same ids doesn't change patients from the first file
+           other = os.path.join(folder, 'other.csv')
+           with open(other, 'w') as f:
+               f.writelines([lines[0]] + [line.replace(',Yes,', ',No,', 1) for line in lines[1:3]])
+           result = import_dataset(patients, other, incremental=True, processes=1)
+           self.assertEqual(result['updated'], 0)
+           self.assertEqual(patients.find_one({'source_id': 9046, 'source': os.path.abspath(path)})['ever_married'], 'Yes')
+
+        # If a file without the id column matches rows by their content, so a line added at the top doesn't move the others
+    @unittest.skipUnless(mongomock, 'mongomock is not installed')
+    def test_import_without_id_column(self):
+       data = pd.read_csv('data/data.csv.xls', nrows=21).drop(columns=['id'])
+       patients = mongomock.MongoClient().db.patients
+       setup_mongodb_indexes(patients)
+       with tempfile.TemporaryDirectory() as folder:
+           path = os.path.join(folder, 'patients.csv')
+           data.iloc[1:].to_csv(path, index=False)
+           first = import_dataset(patients, path, incremental=True, processes=1)
+           data.to_csv(path, index=False)
+           second = import_dataset(patients, path, incremental=True, processes=1)
+       self.assertEqual(second['updated'], 0)
+       self.assertEqual(second['unchanged'], first['inserted'])
+       self.assertEqual(second['inserted'], 1)
+
+        # If setup fails when the unique patient index can't be made, and import refuses to run without it
+    @unittest.skipUnless(mongomock, 'mongomock is not installed')
+    def test_dedupe_index_required(self):
+       patients = mongomock.MongoClient().db.patients
+       patient = {'gender': 'Male', 'age': 50.0, 'hypertension': 0, 'avg_glucose_level': 90.0}
+       patients.insert_many([dict(patient), dict(patient)])
+       with self.assertRaises(RuntimeError):
+           setup_mongodb_indexes(patients)
+       with self.assertRaises(RuntimeError):
+           import_dataset(patients, 'data/data.csv.xls', processes=1)
+       self.assertEqual(patients.count_documents({}), 2)
+
+        # If bulk update refuses fields of the patient key for many patients
+    def test_bulk_update_key_fields(self):
+       with self.app.session_transaction() as session:
+           session['user_id'] = 1
+       response = self.app.post('/api/bulk_patients', json={'action': 'update', 'filter': {'smoking_status': 'smokes'}, 'fields': {'age': 70}})
+       self.assertEqual(response.status_code, 400)
+       self.assertIn('tick the patients', response.get_json()['error'])
+
+        # If ticked patients get key fields one by one, and the ones that would be duplicates are reported
+    @unittest.skipUnless(mongomock, 'mongomock is not installed')
+    def test_bulk_update_key_fields_by_ids(self):
+       class Patients:
+           # mongomock's bulk_write doesn't accept pymongo's UpdateOne, so it's done here like an unordered bulk_write
+           def __init__(self, collection):
+               self.collection = collection
+           def __getattr__(self, name):
+               return getattr(self.collection, name)
+           def bulk_write(self, operations, ordered):
+               details = {'nMatched': 0, 'nModified': 0, 'writeErrors': []}
+               for index, operation in enumerate(operations):
+                   try:
+                       result = self.collection.update_one(operation._filter, operation._doc)
+                   except DuplicateKeyError as e:
+                       details['writeErrors'].append({'index': index, 'errmsg': str(e)})
+                       continue
+                   details['nMatched'] += result.matched_count
+                   details['nModified'] += result.modified_count
+               if details['writeErrors']:
+                   raise BulkWriteError(details)
+               return type('Result', (), {'bulk_api_result': details})()
+
+       patients = Patients(mongomock.MongoClient().db.patients)
+       setup_mongodb_indexes(patients.collection)
+       ids = patients.insert_many([{'gender': 'Male', 'age': age, 'hypertension': 0, 'avg_glucose_level': 90.0}
+                                   for age in (50.0, 60.0)]).inserted_ids
+       with self.app.session_transaction() as session:
+           session['user_id'] = 1
+       with mock.patch('main_app.get_patients', return_value=patients):
+           response = self.app.post('/api/bulk_patients', json={'action': 'update', 'ids': [str(patient_id) for patient_id in ids], 'fields': {'age': 70}})
+       self.assertEqual(response.status_code, 200)
+       counts = response.get_json()
+       self.assertEqual((counts['modified'], counts['failed']), (1, 1))
+       self.assertEqual(counts['errors'][0]['_id'], str(ids[1]))
+       self.assertEqual(sorted(patient['age'] for patient in patients.find()), [60.0, 70.0])
+
+        # If edit refuses patients without _id (they would get a new random id)
+    def test_bulk_edit_needs_id(self):
+       with self.app.session_transaction() as session:
+           session['user_id'] = 1
+       response = self.app.post('/api/bulk_patients', json={'action': 'edit', 'patients': [{'age': 70}]})
+       self.assertEqual(response.status_code, 400)
+       self.assertIn('_id', response.get_json()['error'])
+
+        # If bulk update saves text starting with $ as text, not as a field of the patient
+    @unittest.skipUnless(mongomock, 'mongomock is not installed')
+    def test_bulk_update_literal_values(self):
+       patients = mongomock.MongoClient().db.patients
+       patients.insert_one({'age': 70.0, 'hypertension': 1, 'avg_glucose_level': 90.0, 'smoking_status': 'never smoked'})
+       counts = bulk_update_patients({'smoking_status': '$age'}, patients, query={})
+       self.assertEqual(counts['modified'], 1)
+       self.assertEqual(patients.find_one()['smoking_status'], '$age')
+
+        # If a missing SECRET_KEY is reported (a random key only works with one worker)
+    def test_missing_secret_key_warning(self):
+       saved = os.environ.pop('SECRET_KEY', None)
+       try:
+           with self.assertLogs(level='WARNING') as logs:
+               create_app()
+       finally:
+           if saved is not None:
+               os.environ['SECRET_KEY'] = saved
+       self.assertTrue(any('SECRET_KEY' in line for line in logs.output))
+
+        # If import progress is saved where every worker process can read it
+    def test_import_job_status(self):
+       def import_function(progress):
+           progress(rows_read=10, inserted=8, skipped=2)
+           return True, 'done'
+       job = import_jobs.submit_import(import_function)
+       for _ in range(100):
+           status = import_jobs.get_job_status(job.id)
+           if status['status'] == 'finished':
+               break
+           time.sleep(0.05)
+       self.assertEqual((status['status'], status['rows_read'], status['inserted'], status['message']), ('finished', 10, 8, 'done'))
+       self.assertIsNone(import_jobs.get_job_status('unknown'))
+
+        # If dashboard numbers get a new cache key when patients change (also when another worker changed them)
+    def test_dashboard_cache_key(self):
+       saved = page_cache.page_cache
+       page_cache.set_page_cache(LRUCache(10, 10000))
+       try:
+           before = page_cache.patient_versions()
+           patients_changed([ObjectId()])
+           self.assertNotEqual(page_cache.patient_versions(), before)
+       finally:
+           page_cache.set_page_cache(saved)
+
+        # If the dashboard aggregation ($facet) counts patients, risk ranges and groups, and the result is cached until patients change
+    @unittest.skipUnless(mongomock, 'mongomock is not installed')
+    def test_dashboard_numbers(self):
+       patients = mongomock.MongoClient().db.patients
+       patients.insert_many([
+           {'gender': 'Male', 'age': 70.0, 'hypertension': 1, 'heart_disease': 0, 'avg_glucose_level': 210.0, 'smoking_status': 'smokes', 'work_type': 'Private', 'residence_type': 'Urban', 'stroke_risk': 0.9},
+           {'gender': 'Female', 'age': 30.0, 'hypertension': 0, 'heart_disease': 1, 'avg_glucose_level': 90.0, 'smoking_status': 'never smoked', 'work_type': 'Private', 'residence_type': 'Rural', 'stroke_risk': 0.1},
+           {'gender': 'Female', 'age': 40.0, 'hypertension': 0, 'heart_disease': 0, 'avg_glucose_level': 90.0, 'work_type': 'Govt_job', 'residence_type': 'Rural'},
+       ])
+       analytics.dashboard_cache.clear()
+       stats = analytics.get_dashboard(patients)
+       self.assertEqual(stats['total'], 3)
+       self.assertAlmostEqual(stats['avg_risk'], 0.5)
+       self.assertEqual([(row['label'], row['patients']) for row in stats['risk_distribution']],
+                        [('0-20%', 1), ('80-100%', 1), ('No risk saved', 1)])
+       self.assertEqual({row['label']: row['patients'] for row in stats['risk_factors']},
+                        {'Hypertension': 1, 'Heart disease': 1, 'Age over 60': 1, 'Glucose over 200 mg/dL': 1, 'Smoking': 1})
+       self.assertEqual([(row['label'], row['patients'], row['high_risk']) for row in stats['by_gender']],
+                        [('Female', 2, 0), ('Male', 1, 1)])
+       self.assertAlmostEqual(stats['by_work_type'][1]['avg_risk'], 0.5)
+
+       # Cached - a new patient is only counted after patients_changed
+       patients.insert_one({'gender': 'Male', 'age': 50.0, 'hypertension': 0, 'avg_glucose_level': 90.0, 'stroke_risk': 0.3})
+       self.assertEqual(analytics.get_dashboard(patients)['total'], 3)
+       patients_changed([ObjectId()])
+       self.assertEqual(analytics.get_dashboard(patients)['total'], 4)
+
+        # If /metrics shows requests and MongoDB command times in Prometheus text format
+    def test_metrics_page(self):
+       self.app.get('/')
+       # MongoDB commands are measured by pymongo's listener, here it gets the events pymongo would send
+       event = type('Event', (), {'command_name': 'find', 'command': {'find': 'patients'}, 'connection_id': ('localhost', 27017),
+                                  'request_id': 1, 'duration_micros': 30000})()
+       metrics.mongo_command_timer.started(event)
+       metrics.mongo_command_timer.succeeded(event)
+
+       response = self.app.get('/metrics')
+       self.assertEqual(response.status_code, 200)
+       self.assertTrue(response.content_type.startswith('text/plain; version=0.0.4'))
+       lines = response.get_data(as_text=True).splitlines()
+       self.assertIn('# TYPE http_requests_total counter', lines)
+       self.assertIn('# TYPE http_request_duration_seconds histogram', lines)
+       self.assertTrue(any(line.startswith('http_requests_total{method="GET",endpoint="main.home_page",status="200"} ') for line in lines))
+       self.assertTrue(any(line.startswith('http_request_duration_seconds_bucket{method="GET",endpoint="main.home_page",le="+Inf"} ') for line in lines))
+       # 30 ms is over the 0.025 bucket and in the 0.05 one (buckets count everything up to their limit)
+       find = {line.rsplit(' ', 1)[0]: float(line.rsplit(' ', 1)[1]) for line in lines
+               if line.startswith('mongodb_command_duration_seconds') and 'command="find",collection="patients"' in line}
+       bucket = 'mongodb_command_duration_seconds_bucket{command="find",collection="patients",le=%s}'
+       self.assertEqual(find[bucket % '"0.05"'] - find[bucket % '"0.025"'], 1)
+       self.assertEqual(find[bucket % '"+Inf"'], find['mongodb_command_duration_seconds_count{command="find",collection="patients"}'])
+
+        # If rescore from the dashboard gives every patient the risk of the current rule inside MongoDB, and only writes changed patients
+    @unittest.skipUnless(mongomock, 'mongomock is not installed')
+    def test_rescore_patients_route(self):
+       patients = mongomock.MongoClient().db.patients
+       saved = [
+           {'gender': 'Male', 'age': 70.0, 'hypertension': 1, 'avg_glucose_level': 210.0, 'smoking_status': 'smokes', 'stroke_risk': 0.0},
+           {'gender': 'Female', 'age': 30.0, 'hypertension': 0, 'avg_glucose_level': 90.0, 'smoking_status': 'never smoked', 'stroke_risk': 0.5},
+           {'gender': 'Female', 'age': 40.0, 'hypertension': 1, 'avg_glucose_level': 90.0},
+       ]
+       saved[2]['stroke_risk'] = score_patients(saved[2])
+       patients.insert_many(saved)
+       with self.app.session_transaction() as session:
+           session['user_id'] = 1
+       with mock.patch('main_app.get_patients', return_value=patients):
+           response = self.app.post('/rescore_patients')
+       self.assertEqual(response.status_code, 302)
+       with self.app.session_transaction() as session:
+           self.assertIn('2 patients changed', session['_flashes'][0][1])
+       for patient in patients.find():
+           self.assertAlmostEqual(patient['stroke_risk'], score_patients(patient))
+
+       # The update is a pipeline, so MongoDB calculates the risk from the fields of every patient
+       calls = []
+       class Patients:
+           def update_many(self, query, update):
+               calls.append((query, update))
+               return type('Result', (), {'modified_count': 0})()
+       rescore_patients(Patients())
+       query, update = calls[0]
+       self.assertIsInstance(update, list)
+       self.assertEqual(update[0]['$set']['stroke_risk'], query['$expr']['$ne'][1])
+
+        # If prediction API needs login
+    def test_predict_api_requires_login(self):
+       response = self.app.post('/api/predict', json=[])
+       self.assertEqual(response.status_code, 401)
+
+        # If prediction API scores patients that only have the required fields (no smoking_status)
+    def test_predict_api_minimal_patient(self):
+       with self.app.session_transaction() as session:
+           session['user_id'] = 1
+       patient = {'gender': 'Male', 'age': 67.0, 'hypertension': 1, 'avg_glucose_level': 228.69, 'bmi': 36.6}
+       response = self.app.post('/api/predict', json=[patient])
+       self.assertEqual(response.status_code, 200)
+       self.assertEqual(response.get_json()['valid'], 1)
+       self.assertAlmostEqual(score_patients(patient), 0.8)
+
+        # If wsgi.py and asgi.py refuse to start without SECRET_KEY
+    def test_server_needs_secret_key(self):
+       saved = os.environ.pop('SECRET_KEY', None)
+       try:
+           with mock.patch('server_env.load_dotenv'), self.assertRaises(RuntimeError):
+               load_server_env()
+       finally:
+           if saved is not None:
+               os.environ['SECRET_KEY'] = saved
+
+        # If async patient API needs login and other pages still come from Flask
+    def test_asgi_app(self):
+       import asyncio
+       # asgi.py doesn't start without SECRET_KEY, like wsgi.py
+       os.environ.setdefault('SECRET_KEY', 'test-secret-key')
+       import asgi
+
+       def call(path, method='GET', body=b'', headers=()):
+           sent = []
+           async def receive():
+               return {'type': 'http.request', 'body': body, 'more_body': False}
+           async def send(message):
+               sent.append(message)
+           scope = {'type': 'http', 'method': method, 'path': path, 'query_string': b'', 'headers': list(headers),
+                    'http_version': '1.1', 'scheme': 'http', 'server': ('localhost', 80), 'root_path': ''}
+           asyncio.run(asgi.app(scope, receive, send))
+           return sent[0]['status']
+
+       self.assertEqual(call('/api/patients'), 401)
+       self.assertEqual(call('/api/patients/not-an-id'), 401)
+       self.assertEqual(call('/'), 200)
+
+       # Logged in, a patient without smoking_status is scored and saved (MongoDB insert is replaced here)
+       flask_app = asgi.app.flask_app
+       cookie = flask_app.session_interface.get_signing_serializer(flask_app).dumps({'user_id': 1})
+       saved = []
+       async def insert_patient(patient):
+           saved.append(patient)
+           return ObjectId()
+       insert = asgi.async_db.insert_patient
+       asgi.async_db.insert_patient = insert_patient
+       try:
+           status = call('/api/patients', 'POST', b'{"gender": "Male", "age": 67, "hypertension": 1, "avg_glucose_level": 228.69, "bmi": 36.6}',
+                         [(b'content-type', b'application/json'),
+                          (b'cookie', f"{flask_app.config['SESSION_COOKIE_NAME']}={cookie}".encode())])
+       finally:
+           asgi.async_db.insert_patient = insert
+       self.assertEqual(status, 201)
+       self.assertEqual(len(saved), 1)
+
 # This runs all my tests when I run this file directly
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,16 @@
+# Entry point for running the app with several worker processes, for example:
+# WEB_CONCURRENCY=4 gunicorn -b 0.0.0.0:8000 wsgi:app
+#
+# Every worker must have the same SECRET_KEY (environment variable or .env file), so a user logged in
+# through one worker stays logged in on the others - without it the workers don't start.
+# SESSION_BACKEND=sqlite keeps sessions on the server.
+# Importing this file doesn't touch any database - run "flask --app main_app init-db" once before starting.
+
+from server_env import load_server_env
+
+# .env and the SECRET_KEY check - before main_app, because modules read their settings when imported
+load_server_env()
+
+from main_app import create_app
+
+app = create_app()